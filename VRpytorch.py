@@ -1,38 +1,29 @@
+import argparse
+import json
+import os
+import sys
+import time
 import torch
-import torchvision
-import torchvision.transforms as transforms
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
-# Normalize the dataset. This converts the input image into a tensor and normalizes it to a range of [-1, 1] from the RGB values of 0 to 255. This is done to improve the performance of the network
-# The mean and standard deviation are calculated from the training dataset. The mean and standard deviation are used to normalize the test dataset. This is done to ensure that the test dataset is normalized in the same way as the training dataset
-transform = transforms.Compose([
-    #randomly flips the image horizontally with a probability of 0.5. This is done to mitigate overfitting by increasing the diversity of training data
-    transforms.RandomHorizontalFlip(),
-    #randomly crops the image to 32x32 pixels. This is done to mitigate overfitting by increasing the diversity of training data. Padding is added to retain the original image size
-    transforms.RandomCrop(32, padding=4),
-    #converts the image to a tensor, a multi-dimensional numerical matrix that can be used as input to a neural network
-    transforms.ToTensor(),
-    # TheThe first tuple (0.5, 0.5, 0.5) represents the mean values for each of the three color channels (red, green, and blue) in the input image. 
-    # These values are subtracted from each pixel value in the corresponding channel of the input image to center the data around zero.
-    # The second tuple (0.5, 0.5, 0.5) represents the standard deviation values for each of the three color channels (red, green, and blue) in the input image.
-    # These values are used to scale the pixel values so that they have standard deviation of 1.
-    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-])
+from cifar_data import make_loader
+
+# Normalize the dataset. The images are converted to tensors and normalized to a range of [-1, 1] from the RGB values of 0 to 255. This is done to improve the performance of the network
+# The same mean and standard deviation (0.5 per channel) are used for the training and test datasets. This is done to ensure that the test dataset is normalized in the same way as the training dataset
+# The training data is also augmented: each image is randomly flipped horizontally and randomly cropped back to 32x32 pixels after 4 pixels of padding.
+# This is done to mitigate overfitting by increasing the diversity of training data. The test data is not augmented
+# cifar_data.py decodes CIFAR-10 once into a memory-mapped uint8 array and applies the flip, crop and normalisation to whole batches at a time,
+# so the per-image PIL decoding and transforms no longer limit how fast images reach the network
 
 # Load the CIFAR-10 dataset
 # It's also important to note that increasing the batch size does not always lead to better performance. In some cases, smaller batch sizes can lead to better generalization and lower test error
 # especially if the network is well-regularized and the dataset is not too large.
-trainset = torchvision.datasets.CIFAR10(root='./data', train=True,
-                                        download=True, transform=transform)
-trainloader = torch.utils.data.DataLoader(trainset, batch_size=100,
-                                          shuffle=True, num_workers=2)
-
-testset = torchvision.datasets.CIFAR10(root='./data', train=False,
-                                       download=True, transform=transform)
-testloader = torch.utils.data.DataLoader(testset, batch_size=100,
-                                         shuffle=False, num_workers=2)
+def get_loaders(batch_size=100, num_workers=min(4, os.cpu_count() or 1)):
+    trainloader = make_loader(train=True, batch_size=batch_size, num_workers=num_workers)
+    testloader = make_loader(train=False, batch_size=batch_size, num_workers=num_workers)
+    return trainloader, testloader
 
 # Define the classes. There are 10 classes so the finaly layer of the network needs to output 10 values
 classes = ('plane', 'car', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck')
@@ -40,7 +31,7 @@ classes = ('plane', 'car', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship'
 
 # define the convolutional neural network architecture using ReLU activation function, adjust as necessary to improve results
 class Net(nn.Module):
-    def __init__(self):
+    def __init__(self, dropout=0.0):
         super(Net, self).__init__()
         # convolutional layer 1
         # the first number, 3, corresponds to the 3 RGB input channels
@@ -57,65 +48,220 @@ class Net(nn.Module):
         self.fc1 = nn.Linear(16 * 5 * 5, 120)
         self.fc2 = nn.Linear(120, 84)        
         self.fc3 = nn.Linear(84, 10)     
-        # defining a dropout layer and its probability
-        self.dropout = nn.Dropout(p=0.25)   
+        # defining a dropout layer and its probability. 0 leaves it out, e.g. 0.25 to try it
+        self.dropout = nn.Dropout(p=dropout)   
 
     def forward(self, x):
         # ReLU activation function is used to introduce non-linearity into the network. It is commonly used in deep learning models        
         x = self.pool(F.relu(self.conv1(x)))
         x = self.pool(F.relu(self.conv2(x)))
-        x = x.view(-1, 16 * 5 * 5)
+        # flatten rather than view, so the layer also works when the feature maps are in channels-last memory format
+        x = torch.flatten(x, 1)
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         # introduce dropout layer if needed. In general, it's common to introduce dropout after the fully connected layers or after the convolutional layers.
-        # x = self.dropout(x)        
+        if self.dropout.p > 0:
+            x = self.dropout(x)
         x = self.fc3(x)
         # softmax activation function is used to convert the output of the network into a probability distribution over the 10 classes. softmax activation makes training worse here. To solve....
         #x = F.softmax(x, dim=1)
         return x
 
-net = Net()
-
 # Define the loss function and optimizer using stochastic gradient descent
 # The loss function is the cross entropy loss function. It is commonly used for multi-class classification problems like in this scenario
 criterion = nn.CrossEntropyLoss()
-#optimizer uses the PyTorch SGD optimizer. Adjust the learning rate and momentum as necessary to improve results. Increasing the number is not always better.
-optimizer = optim.SGD(net.parameters(), lr=0.001, momentum=0.9)
 
-# Train the network
-if __name__ == "__main__":
-    # Define number of epochs, adjust as necessary to improve results
-    num_epochs = 20
+# Training options that change speed but not the model, see the --help text. "compare" runs every configuration below in turn
+CONFIGURATIONS = {
+    'baseline': {},
+    'channels_last': {'channels_last': True},
+    'compile': {'compile_model': True},
+    'bf16': {'bf16': True},
+    'all': {'channels_last': True, 'compile_model': True, 'bf16': True},
+}
 
-    for epoch in range(num_epochs):
-        running_loss = 0.0
-        for i, data in enumerate(trainloader, 0):
-            inputs, labels = data
+def build_model(channels_last=False, compile_model=False, lr=0.001, momentum=0.9, dropout=0.0):
+    net = Net(dropout)
+    if channels_last:
+        # NHWC layout, which the oneDNN convolution kernels on CPU prefer
+        net = net.to(memory_format=torch.channels_last)
+    #optimizer uses the PyTorch SGD optimizer. Adjust the learning rate and momentum as necessary to improve results. Increasing the number is not always better.
+    optimizer = optim.SGD(net.parameters(), lr=lr, momentum=momentum)
+    # The compiled module shares its parameters with net, so the optimizer and any saved state_dict refer to the same weights
+    model = torch.compile(net) if compile_model else net
+    return net, model, optimizer
 
-            optimizer.zero_grad()
+def _prepare(inputs, channels_last):
+    return inputs.contiguous(memory_format=torch.channels_last) if channels_last else inputs
 
-            outputs = net(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+def train_epoch(model, trainloader, optimizer, channels_last=False, bf16=False):
+    model.train()
+    # The loss is accumulated without leaving the tensor, so there is no sync per batch
+    running_loss = torch.zeros(())
+    batches = 0
+    for inputs, labels in trainloader:
+        inputs = _prepare(inputs, channels_last)
 
-            running_loss += loss.item()
+        optimizer.zero_grad(set_to_none=True)
 
-        # Print the average loss for this epoch
-        print('Epoch %d loss: %.3f' % (epoch + 1, running_loss / (i + 1)))
+        # bfloat16 autocast runs the convolutions and linear layers in bf16 on CPUs that support it; the loss stays in fp32
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=bf16):
+            outputs = model(inputs)
+        loss = criterion(outputs.float(), labels)
+        loss.backward()
+        optimizer.step()
 
-    print('Finished Training')
+        running_loss += loss.detach()
+        batches += 1
+    return running_loss.item() / max(batches, 1)
 
-    # Test the network
+def evaluate(model, testloader, channels_last=False, bf16=False):
+    model.eval()
     correct = 0
     total = 0
-    with torch.no_grad():
-        for data in testloader:
-            images, labels = data
-            outputs = net(images)
-            _, predicted = torch.max(outputs.data, 1)
+    with torch.no_grad(), torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=bf16):
+        for images, labels in testloader:
+            outputs = model(_prepare(images, channels_last))
+            _, predicted = torch.max(outputs, 1)
             total += labels.size(0)
             correct += (predicted == labels).sum().item()
+    return 100 * correct / total
+
+def resolve_threads(threads):
+    if threads == 'auto':
+        # Cores this process may run on; one thread per core avoids oversubscription
+        return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    return int(threads) if threads else None
+
+# Writes to a temporary file first and renames it, so an interruption mid-save never leaves a corrupt checkpoint behind
+def save_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def run(args, channels_last=False, compile_model=False, bf16=False, checkpoint=None):
+    torch.manual_seed(args.seed)
+    trainloader, testloader = get_loaders(args.batch_size, args.workers)
+    net, model, optimizer = build_model(channels_last, compile_model, args.lr, args.momentum, args.dropout)
+
+    start_epoch = 0
+    best_accuracy = None
+    best_state = None
+    epochs_without_improvement = 0
+    epoch_times = []
+
+    # Resume from the last checkpoint: weights, optimizer momentum, epoch counter, early-stopping state and RNG state
+    if checkpoint and args.resume and os.path.exists(checkpoint):
+        state = torch.load(checkpoint, weights_only=False)
+        net.load_state_dict(state.get('last_model', state['model']))
+        optimizer.load_state_dict(state['optimizer'])
+        start_epoch = state['epoch']
+        best_accuracy = state['best_accuracy']
+        best_state = state['best_model']
+        epochs_without_improvement = state['epochs_without_improvement']
+        torch.set_rng_state(state['rng_state'])
+        print('Resumed from %s at epoch %d' % (checkpoint, start_epoch))
+
+    for epoch in range(start_epoch, args.epochs):
+        start = time.perf_counter()
+        loss = train_epoch(model, trainloader, optimizer, channels_last, bf16)
+        epoch_times.append(time.perf_counter() - start)
+        # Print the average loss for this epoch
+        print('Epoch %d loss: %.3f (%.1fs)' % (epoch + 1, loss, epoch_times[-1]))
+
+        # Early stopping: measure test accuracy after every epoch and stop once it has not improved by at least
+        # min_delta for patience epochs in a row. The best weights are kept and restored at the end
+        stop = False
+        if args.patience:
+            accuracy = evaluate(model, testloader, channels_last, bf16)
+            if best_accuracy is None or accuracy > best_accuracy + args.min_delta:
+                best_accuracy = accuracy
+                best_state = {k: v.detach().clone() for k, v in net.state_dict().items()}
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+            print('Epoch %d test accuracy: %.2f %% (best %.2f %%)' % (epoch + 1, accuracy, best_accuracy))
+            stop = epochs_without_improvement >= args.patience
+
+        last = stop or epoch + 1 == args.epochs
+        if checkpoint and ((epoch + 1) % args.checkpoint_every == 0 or last):
+            weights = net.state_dict()
+            save_checkpoint(checkpoint, {
+                'epoch': epoch + 1,
+                # Once training ends, 'model' holds the weights the run finishes with, which under early stopping are the
+                # best ones. The latest epoch's weights are kept in 'last_model' for --resume
+                'model': best_state if last and best_state is not None else weights,
+                'last_model': weights,
+                'optimizer': optimizer.state_dict(),
+                'best_accuracy': best_accuracy,
+                'best_model': best_state,
+                'epochs_without_improvement': epochs_without_improvement,
+                'rng_state': torch.get_rng_state(),
+            })
+
+        if stop:
+            print('Stopping early: no improvement for %d epochs' % args.patience)
+            break
+
+    print('Finished Training')
+    if best_state is not None:
+        net.load_state_dict(best_state)
+    accuracy = evaluate(model, testloader, channels_last, bf16)
+    # The first epoch includes torch.compile's compilation, so the steady-state time leaves it out when there is more than one epoch
+    steady = epoch_times[1:] or epoch_times or [0.0]
+    return {'epoch_time': sum(steady) / len(steady), 'first_epoch_time': (epoch_times or [0.0])[0], 'accuracy': accuracy,
+            'epochs': start_epoch + len(epoch_times)}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Train the CIFAR-10 network")
+    # Define number of epochs, adjust as necessary to improve results
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--lr', type=float, default=0.001, help="SGD learning rate")
+    parser.add_argument('--momentum', type=float, default=0.9, help="SGD momentum")
+    parser.add_argument('--dropout', type=float, default=0.0, help="Dropout before the last layer, 0 to disable")
+    parser.add_argument('--result-file', default=None, help="Write the final accuracy and timings to this JSON file")
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help="DataLoader worker processes")
+    parser.add_argument('--threads', default=None, help="torch.set_num_threads value, or 'auto' for one per available core")
+    parser.add_argument('--channels-last', action='store_true', help="Use channels-last memory format")
+    parser.add_argument('--compile', action='store_true', help="Compile the network with torch.compile")
+    parser.add_argument('--bf16', action='store_true', help="Use bfloat16 autocast on the CPU")
+    parser.add_argument('--compare', action='store_true',
+                        help="Train every configuration (%s) and report epoch time and accuracy" % ', '.join(CONFIGURATIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--checkpoint', default='', help="Checkpoint file, e.g. vrpytorch_checkpoint.pt. Not written by default")
+    parser.add_argument('--checkpoint-every', type=int, default=1, help="Epochs between checkpoints")
+    parser.add_argument('--resume', action='store_true', help="Continue from --checkpoint if it exists")
+    parser.add_argument('--patience', type=int, default=0,
+                        help="Stop after this many epochs without test accuracy improvement. 0 (default) trains every epoch")
+    parser.add_argument('--min-delta', type=float, default=0.1, help="Accuracy gain in percentage points that counts as improvement")
+    return parser.parse_args(argv)
+
+# Train the network
+if __name__ == "__main__":
+    args = parse_args()
+    threads = resolve_threads(args.threads)
+    if threads:
+        torch.set_num_threads(threads)
+    print('Using %d torch threads' % torch.get_num_threads())
 
-    print('Accuracy of the network on the 10000 test images: %d %%' % (100 * correct / total))
-    x = input("Press Enter to continue...")
\ No newline at end of file
+    if args.compare:
+        results = {}
+        # Checkpoints are not written here, since every configuration would overwrite the same file
+        for name, options in CONFIGURATIONS.items():
+            print('--- %s ---' % name)
+            results[name] = run(args, **options)
+        print()
+        print('%-14s %12s %12s %10s %9s' % ('config', 'epoch time', 'first epoch', 'speedup', 'accuracy'))
+        base = results['baseline']['epoch_time']
+        for name, result in results.items():
+            print('%-14s %11.1fs %11.1fs %9.2fx %8.1f%%' % (name, result['epoch_time'], result['first_epoch_time'],
+                                                         base / result['epoch_time'], result['accuracy']))
+    else:
+        result = run(args, args.channels_last, args.compile, args.bf16, checkpoint=args.checkpoint or None)
+        print('Accuracy of the network on the 10000 test images: %d %%' % result['accuracy'])
+        if args.result_file:
+            with open(args.result_file, 'w') as f:
+                json.dump(result, f)
+        if sys.stdin.isatty():
+            x = input("Press Enter to continue...")
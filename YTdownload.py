@@ -1,93 +1,89 @@
 import tkinter as tk
 from tkinter import ttk, filedialog
-from pytubefix import YouTube
-import threading
-import queue
-
-# Create the main window
-root = tk.Tk()
-root.title("YouTube Video Downloader")
-
-# Create a queue for thread communication
-status_queue = queue.Queue()
-
-# Create GUI elements
-url_label = tk.Label(root, text="Enter YouTube URL:")
-url_label.pack()
-
-url_entry = tk.Entry(root, width=50)
-url_entry.pack()
-
-select_folder_button = tk.Button(root, text="Select Output Folder")
-select_folder_button.pack()
-
-folder_label = tk.Label(root, text="No folder selected")
-folder_label.pack()
-
-download_button = tk.Button(root, text="Download")
-download_button.pack()
-
-status_label = tk.Label(root, text="")
-status_label.pack()
-
-progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
-progress_bar.pack()
-
-# Function to select output folder
-def select_folder():
-    folder = filedialog.askdirectory()
-    if folder:
-        folder_label.config(text=folder)
-
-select_folder_button.config(command=select_folder)
-
-# Progress callback function
-def on_progress(stream, chunk, bytes_remaining):
-    total_size = stream.filesize
-    bytes_downloaded = total_size - bytes_remaining
-    percentage = (bytes_downloaded / total_size) * 100
-    status_queue.put(("progress", percentage))
-
-# Function to check the queue for status and progress updates
-def check_queue():
-    if not status_queue.empty():
-        message = status_queue.get()
-        if message[0] == "progress":
-            percentage = message[1]
-            status_label.config(text=f"Downloading... {percentage:.2f}%")
-            progress_bar["value"] = percentage
-        elif message[0] == "status":
-            status_label.config(text=message[1])
-            if message[1] == "Download complete." or message[1].startswith("Error"):
-                download_button.config(state="normal")
-                progress_bar["value"] = 0  # Reset progress bar
-    root.after(100, check_queue)
-
-# Function to download the video
-def download_video(url, output_folder, status_queue):
-    try:
-        yt = YouTube(url, on_progress_callback=on_progress)
-        stream = yt.streams.get_highest_resolution()
-        stream.download(output_path=output_folder)
-        status_queue.put(("status", "Download complete."))
-    except Exception as e:
-        status_queue.put(("status", f"Error: {str(e)}"))
-
-# Function to handle download button click
-def on_download():
-    url = url_entry.get()
-    output_folder = folder_label.cget("text")
-    if not url or output_folder == "No folder selected":
-        status_label.config(text="Please enter URL and select folder.")
-        return
-    status_label.config(text="Downloading...")
-    progress_bar["value"] = 0
-    download_button.config(state="disabled")
-    thread = threading.Thread(target=download_video, args=(url, output_folder, status_queue))
-    thread.start()
-    root.after(100, check_queue)
-
-download_button.config(command=on_download)
-
-# Start the GUI event loop
-root.mainloop()
\ No newline at end of file
+
+from progress_channel import ProgressChannel, format_eta, format_speed, percent
+from ytdownload_engine import SINGLE_FILE, DownloadEngine
+
+# Single video downloader. The download itself is done by ytdownload_engine.DownloadEngine (python ytdownload_engine.py
+# for the same without a window); its thread records the latest progress in a ProgressChannel, and the window redraws it
+# FPS times per second
+FPS = 15
+
+
+class SimpleDownloaderApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("YouTube Video Downloader")
+        self.channel = ProgressChannel()
+        self.engine = None
+
+        # Create GUI elements
+        url_label = tk.Label(root, text="Enter YouTube URL:")
+        url_label.pack()
+
+        self.url_entry = tk.Entry(root, width=50)
+        self.url_entry.pack()
+
+        select_folder_button = tk.Button(root, text="Select Output Folder", command=self.select_folder)
+        select_folder_button.pack()
+
+        self.folder_label = tk.Label(root, text="No folder selected")
+        self.folder_label.pack()
+
+        self.download_button = tk.Button(root, text="Download", command=self.on_download)
+        self.download_button.pack()
+
+        self.status_label = tk.Label(root, text="")
+        self.status_label.pack()
+
+        self.progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
+        self.progress_bar.pack()
+
+        self.channel.pump(root, self.show_progress, fps=FPS)
+
+    # Function to select output folder
+    def select_folder(self):
+        folder = filedialog.askdirectory()
+        if folder:
+            self.folder_label.config(text=folder)
+
+    # Runs on the Tk thread with the latest state of the download, at most FPS times per second
+    def show_progress(self, key, state):
+        status = state.get("status")
+        if status == "downloading":
+            done = percent(state) or 0.0
+            details = ", ".join(text for text in (format_speed(state.get("speed")), format_eta(state.get("eta"))) if text)
+            self.status_label.config(text=f"Downloading... {done:.2f}%" + (f" ({details})" if details else ""))
+            self.progress_bar["value"] = done
+        elif status == "processing":
+            self.status_label.config(text="Processing...")
+        elif status in ("done", "failed", "invalid"):
+            self.status_label.config(text="Download complete." if status == "done" else f"Error: {state.get('error')}")
+            self.download_button.config(state="normal")
+            self.progress_bar["value"] = 0  # Reset progress bar
+            self.engine = None
+
+    # Function to handle download button click
+    def on_download(self):
+        url = self.url_entry.get().strip()
+        output_folder = self.folder_label.cget("text")
+        if not url or output_folder == "No folder selected":
+            self.status_label.config(text="Please enter URL and select folder.")
+            return
+        self.status_label.config(text="Downloading...")
+        self.progress_bar["value"] = 0
+        self.download_button.config(state="disabled")
+        # Start the speed estimate afresh for this download
+        self.channel.clear()
+        # One video, as a single file with video and audio, so no ffmpeg is needed
+        self.engine = DownloadEngine(output_folder, concurrency=1, expand_playlists=False, fmt=SINGLE_FILE,
+                                     on_update=self.channel.update)
+        self.engine.start([url])
+
+
+if __name__ == "__main__":
+    # Create the main window
+    root = tk.Tk()
+    app = SimpleDownloaderApp(root)
+    # Start the GUI event loop
+    root.mainloop()
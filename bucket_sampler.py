@@ -0,0 +1,153 @@
+# Length-bucketed batching for the transformer scripts (transformereg.py, pseudollama.py)
+# Sequences of similar length are grouped into the same batch, and batches are sized by a token budget rather than a fixed
+# number of sequences, so short sequences make large batches and long ones small batches with little padding either way
+#
+#   sampler = BucketBatchSampler(lengths, max_tokens=8192)
+#   loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_seq2seq)
+#   for batch in loader:
+#       logits = model(batch['src'], batch['tgt'], tgt_mask=batch['tgt_mask'],
+#                      src_key_padding_mask=batch['src_key_padding_mask'], tgt_key_padding_mask=batch['tgt_key_padding_mask'])
+#       loss = F.cross_entropy(logits.flatten(0, 1), batch['labels'].flatten(), ignore_index=-100)
+import random
+
+import torch
+from torch.utils.data import Sampler
+
+from transformereg import causal_mask
+
+# Target positions with this label are ignored by F.cross_entropy (its default ignore_index)
+IGNORE_INDEX = -100
+
+
+# Padded size of a batch. lengths may be ints, or tuples (e.g. source and target length) whose padded sizes add up
+def padded_tokens(lengths):
+    if isinstance(lengths[0], (tuple, list)):
+        return sum(max(parts) * len(lengths) for parts in zip(*lengths))
+    return max(lengths) * len(lengths)
+
+
+class BucketBatchSampler(Sampler):
+    # lengths: one length (or tuple of lengths) per dataset item
+    # max_tokens: budget of padded tokens per batch
+    # pool_batches: how many batches' worth of items are sorted together. Larger pools pad less but shuffle less
+    # num_replicas/rank split the batches between distributed processes, each getting the same number of batches
+    def __init__(self, lengths, max_tokens, pool_batches=100, shuffle=True, seed=0, drop_last=False,
+                 num_replicas=1, rank=0):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.pool_batches = pool_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # (epoch, number of batches) of the last epoch counted
+        self._num_batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _size(self, idx):
+        length = self.lengths[idx]
+        return sum(length) if isinstance(length, (tuple, list)) else length
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        # Estimate the pool size from the mean length, then sort each pool by length
+        mean_size = max(1, sum(self._size(i) for i in indices) // max(1, len(indices)))
+        pool_size = max(1, self.pool_batches * self.max_tokens // mean_size)
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=self._size)
+            batch = []
+            # Longest length in the batch so far, per part, so each item is checked in O(1) rather than by rescanning the batch
+            batch_max = None
+            for idx in pool:
+                length = self.lengths[idx]
+                parts = tuple(length) if isinstance(length, (tuple, list)) else (length,)
+                new_max = parts if batch_max is None else tuple(map(max, batch_max, parts))
+                # Close the batch when adding this item would push the padded size (as padded_tokens) over the budget
+                if batch and sum(new_max) * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    new_max = parts
+                batch.append(idx)
+                batch_max = new_max
+            if batch and not self.drop_last:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            per_replica = len(batches) // self.num_replicas
+            batches = batches[self.rank:per_replica * self.num_replicas:self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self._num_batches = (self.epoch, len(batches))
+        return iter(batches)
+
+    # Batches in the current epoch. Each epoch shuffles items into different pools, so the count changes between epochs; it
+    # is recounted after set_epoch rather than kept from the first epoch
+    def __len__(self):
+        if self._num_batches is None or self._num_batches[0] != self.epoch:
+            self._num_batches = (self.epoch, len(self._batches()))
+        return self._num_batches[1]
+
+
+def _pad(sequences, pad_value):
+    max_len = max(len(s) for s in sequences)
+    out = torch.full((len(sequences), max_len), pad_value, dtype=torch.long)
+    for i, s in enumerate(sequences):
+        out[i, :len(s)] = torch.as_tensor(s, dtype=torch.long)
+    return out
+
+
+# Collate (src, tgt) token sequences for transformereg.Transformer. tgt is shifted: the decoder input is tgt[:-1] and the
+# labels are tgt[1:], with padding labelled IGNORE_INDEX. The masks follow forward()'s keyword arguments and are all bool,
+# since PyTorch warns on every call when a float tgt_mask is mixed with bool key-padding masks.
+# num_tokens/num_padded count real and padded positions on the CPU, so reporting them never waits for the device
+def collate_seq2seq(batch, pad_token=0):
+    src = _pad([item[0] for item in batch], pad_token)
+    tgt_full = _pad([item[1] for item in batch], pad_token)
+    tgt = tgt_full[:, :-1]
+    labels = tgt_full[:, 1:].masked_fill(tgt_full[:, 1:] == pad_token, IGNORE_INDEX)
+    src_padding = src == pad_token
+    tgt_padding = tgt == pad_token
+    real = int((~src_padding).sum()) + int((~tgt_padding).sum())
+    return {
+        'src': src,
+        'tgt': tgt,
+        'labels': labels,
+        'tgt_mask': causal_mask(tgt.shape[1], tgt.device),
+        'src_key_padding_mask': src_padding,
+        'tgt_key_padding_mask': tgt_padding,
+        'num_tokens': real,
+        'num_padded': src.numel() + tgt.numel(),
+    }
+
+
+# Collate token sequences for pseudollama.train(): input_ids is the sequence without its last token, target_ids the sequence
+# shifted by one with padding labelled IGNORE_INDEX
+def collate_lm(batch, pad_token=0):
+    tokens = _pad(batch, pad_token)
+    lengths = torch.tensor([len(s) for s in batch])
+    positions = torch.arange(tokens.shape[1] - 1)
+    target_ids = tokens[:, 1:].masked_fill(positions[None, :] >= (lengths[:, None] - 1), IGNORE_INDEX)
+    return {
+        'input_ids': tokens[:, :-1],
+        'target_ids': target_ids,
+        'num_tokens': int((lengths - 1).clamp(min=0).sum()),
+        'num_padded': tokens.shape[0] * (tokens.shape[1] - 1),
+    }
+
+
+# Fraction of the computed positions that were padding
+def padding_ratio(num_tokens, num_padded):
+    return 1.0 - num_tokens / num_padded if num_padded else 0.0
@@ -0,0 +1,156 @@
+# Fast CIFAR-10 input pipeline for VRpytorch.py
+# The dataset is decoded once into a uint8 array [N, 3, 32, 32] saved next to the torchvision download and memory-mapped afterwards,
+# so no PIL decoding happens per sample. Each DataLoader item is a whole batch: the worker gathers the batch from the memory map,
+# and flip, crop and normalisation run as tensor operations on the batch at once.
+#
+# Benchmark images/sec against the original per-image torchvision transforms:
+#   python cifar_data.py --workers 4 --batch-size 100
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+# Same normalisation as the original transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)), i.e. [0, 255] -> [-1, 1]
+MEAN = 0.5
+STD = 0.5
+
+
+# Returns (images, labels) as numpy arrays, images uint8 [N, 3, 32, 32] memory-mapped from root
+def load_cifar_uint8(root='./data', train=True):
+    split = 'train' if train else 'test'
+    images_path = os.path.join(root, f'cifar10_{split}_images.npy')
+    labels_path = os.path.join(root, f'cifar10_{split}_labels.npy')
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        import torchvision
+        dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=True)
+        # torchvision keeps the images as NHWC uint8, the network wants NCHW
+        images = np.ascontiguousarray(dataset.data.transpose(0, 3, 1, 2))
+        labels = np.asarray(dataset.targets, dtype=np.int64)
+        os.makedirs(root, exist_ok=True)
+        _save_atomic(labels_path, labels)
+        _save_atomic(images_path, images)
+    return np.load(images_path, mmap_mode='r'), np.load(labels_path)
+
+
+# Writes to a temporary file and renames it, so another process checking for the cache never reads a half-written array
+def _save_atomic(path, array):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+# Random horizontal flip of each image in a uint8 batch [B, C, H, W]
+def random_flip(images, generator=None):
+    flip = torch.rand(images.shape[0], generator=generator) < 0.5
+    return torch.where(flip[:, None, None, None], images.flip(3), images)
+
+
+# Random crop of each image back to its original size after zero padding, like transforms.RandomCrop(32, padding=4),
+# done for the whole batch with one gather
+def random_crop(images, padding=4, generator=None):
+    batch, channels, height, width = images.shape
+    padded = torch.nn.functional.pad(images, (padding, padding, padding, padding))
+    off_y = torch.randint(0, 2 * padding + 1, (batch,), generator=generator)
+    off_x = torch.randint(0, 2 * padding + 1, (batch,), generator=generator)
+    rows = (off_y[:, None] + torch.arange(height))[:, None, :, None]
+    cols = (off_x[:, None] + torch.arange(width))[:, None, None, :]
+    batch_idx = torch.arange(batch)[:, None, None, None]
+    channel_idx = torch.arange(channels)[None, :, None, None]
+    return padded[batch_idx, channel_idx, rows, cols]
+
+
+def normalize(images):
+    return images.float().div_(255.0).sub_(MEAN).div_(STD)
+
+
+# Each item is a full batch: the index passed in is the list of sample indices from a BatchSampler
+class CifarBatches(Dataset):
+    def __init__(self, images, labels, augment=False):
+        self.images = images
+        self.labels = labels
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, indices):
+        # Sorted indices read the memory map more sequentially; the order inside a batch does not matter
+        indices = np.sort(np.asarray(indices))
+        images = torch.from_numpy(np.ascontiguousarray(self.images[indices]))
+        labels = torch.from_numpy(self.labels[indices])
+        if self.augment:
+            images = random_crop(random_flip(images))
+        return normalize(images), labels
+
+
+def make_loader(train=True, batch_size=100, num_workers=2, root='./data', augment=None, prefetch_factor=4):
+    images, labels = load_cifar_uint8(root, train)
+    augment = train if augment is None else augment
+    dataset = CifarBatches(images, labels, augment=augment)
+    sampler = RandomSampler(dataset) if train else SequentialSampler(dataset)
+    kwargs = {}
+    if num_workers > 0:
+        # Persistent workers keep the memory map open between epochs; prefetching keeps batches ready ahead of the model.
+        # DataLoader gives every worker its own torch seed, so the augmentations differ between workers
+        kwargs = {'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        **kwargs,
+    )
+
+
+# Images per second delivered by a loader, optionally running a model on every batch to check the loader keeps up with it
+def images_per_second(loader, epochs=1, model=None):
+    count = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for images, labels in loader:
+            if model is not None:
+                with torch.no_grad():
+                    model(images)
+            count += images.shape[0]
+    return count / (time.perf_counter() - start)
+
+
+# The original VRpytorch.py pipeline: torchvision decodes each image through PIL and transforms it on its own
+def legacy_loader(batch_size=100, num_workers=2, root='./data'):
+    import torchvision
+    import torchvision.transforms as transforms
+    transform = transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomCrop(32, padding=4),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    ])
+    trainset = torchvision.datasets.CIFAR10(root=root, train=True, download=True, transform=transform)
+    return DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CIFAR-10 input pipelines")
+    parser.add_argument('--root', default='./data')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--with-model', action='store_true', help="Run VRpytorch's Net forward on every batch")
+    args = parser.parse_args()
+
+    model = None
+    if args.with_model:
+        from VRpytorch import Net
+        model = Net().eval()
+
+    fast = make_loader(True, args.batch_size, args.workers, args.root)
+    legacy = legacy_loader(args.batch_size, args.workers, args.root)
+    fast_rate = images_per_second(fast, args.epochs, model)
+    legacy_rate = images_per_second(legacy, args.epochs, model)
+    print(f"legacy torchvision pipeline: {legacy_rate:10.0f} images/sec")
+    print(f"batched uint8 pipeline:      {fast_rate:10.0f} images/sec ({fast_rate / legacy_rate:.1f}x)")
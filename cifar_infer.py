@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Inference for the trained CIFAR-10 classifiers (Net from VRpytorch.py, cifar10_model.h5 from TensorFlowVR.py)
+#
+# Export the PyTorch network to TorchScript and ONNX, or the Keras model to ONNX (needs tf2onnx):
+#   python cifar_infer.py export --checkpoint vrpytorch_checkpoint.pt --torchscript net.pt --onnx net.onnx
+#   python cifar_infer.py export --keras cifar10_model.h5 --onnx keras.onnx
+# Benchmark a model at several batch sizes, then through the batching engine with concurrent clients:
+#   python cifar_infer.py bench --model net.onnx --batch-sizes 1 8 32 128 --clients 32 --max-latency-ms 5
+#
+# BatchingEngine groups single-image requests into batches: a batch is run as soon as it is full, or when the oldest
+# request in it has waited max_latency_ms, whichever happens first
+import argparse
+import queue
+import statistics
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+CLASSES = ('plane', 'car', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck')
+
+
+# Loads Net weights from a VRpytorch checkpoint ({'model': state_dict, ...}) or a bare state dict
+def load_pytorch_net(checkpoint):
+    import torch
+    from VRpytorch import Net
+    net = Net()
+    state = torch.load(checkpoint, map_location='cpu', weights_only=False)
+    # A VRpytorch.py checkpoint, or a bare state dict. The early-stopping best weights are preferred over the latest epoch's,
+    # which checkpoints written mid-run (or before VRpytorch.py stored the best ones as 'model') keep under 'model'
+    if 'model' in state:
+        state = state.get('best_model') or state['model']
+    net.load_state_dict(state)
+    return net.eval()
+
+
+def export_pytorch(checkpoint, torchscript_path=None, onnx_path=None):
+    import torch
+    net = load_pytorch_net(checkpoint)
+    example = torch.zeros(1, 3, 32, 32)
+    if torchscript_path:
+        torch.jit.save(torch.jit.trace(net, example), torchscript_path)
+        print('TorchScript model written to %s' % torchscript_path)
+    if onnx_path:
+        torch.onnx.export(net, example, onnx_path, input_names=['images'], output_names=['logits'],
+                          dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17)
+        print('ONNX model written to %s' % onnx_path)
+
+
+def export_keras(model_path, onnx_path):
+    import tensorflow as tf
+    import tf2onnx
+    model = tf.keras.models.load_model(model_path)
+    spec = (tf.TensorSpec((None, 32, 32, 3), tf.float32, name='images'),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, output_path=onnx_path)
+    print('ONNX model written to %s' % onnx_path)
+
+
+# Each backend takes a uint8 batch [B, 32, 32, 3] (the layout CIFAR-10 images come in) and returns class scores [B, 10]
+# The PyTorch network expects NCHW input normalised to [-1, 1], the Keras model NHWC input scaled to [0, 1]
+def _torch_input(images):
+    return (images.transpose(0, 3, 1, 2).astype(np.float32) / 127.5) - 1.0
+
+
+class TorchScriptBackend:
+    def __init__(self, path, threads=None):
+        import torch
+        if threads:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.model = torch.jit.load(path).eval()
+
+    def __call__(self, images):
+        with self.torch.inference_mode():
+            return self.model(self.torch.from_numpy(_torch_input(images))).numpy()
+
+
+class OnnxBackend:
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0]
+        # A 4D input whose last dimension is 3 is the Keras (NHWC) export, otherwise it is the PyTorch (NCHW) one
+        self.channels_last = self.input.shape[-1] == 3
+
+    def __call__(self, images):
+        if self.channels_last:
+            batch = images.astype(np.float32) / 255.0
+        else:
+            batch = _torch_input(images)
+        return self.session.run(None, {self.input.name: batch})[0]
+
+
+class KerasBackend:
+    def __init__(self, path, threads=None):
+        import tensorflow as tf
+        if threads:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+        self.model = tf.keras.models.load_model(path)
+
+    def __call__(self, images):
+        return self.model(images.astype(np.float32) / 255.0, training=False).numpy()
+
+
+def load_backend(path, threads=None):
+    if path.endswith('.onnx'):
+        return OnnxBackend(path, threads)
+    if path.endswith(('.h5', '.keras')):
+        return KerasBackend(path, threads)
+    return TorchScriptBackend(path, threads)
+
+
+class BatchingEngine:
+    def __init__(self, backend, max_batch_size=32, max_latency_ms=5.0):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+        self._stop = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    # Queues one uint8 image [32, 32, 3] and returns a Future resolving to its class scores
+    def submit(self, image):
+        future = Future()
+        self.requests.put((image, future, time.perf_counter()))
+        return future
+
+    def predict(self, image):
+        return self.submit(image).result()
+
+    def _loop(self):
+        while not self._stop:
+            try:
+                first = self.requests.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            # The deadline is counted from when the oldest request arrived, not from when the engine saw it
+            deadline = first[2] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            scores = self.backend(np.stack([item[0] for item in batch]))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.batch_sizes.append(len(batch))
+        for (_, future, _), row in zip(batch, scores):
+            future.set_result(row)
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Direct backend calls at fixed batch sizes
+def bench_batch_sizes(backend, batch_sizes, iters):
+    print('%10s %12s %14s' % ('batch', 'latency ms', 'images/sec'))
+    rng = np.random.default_rng(0)
+    for batch_size in batch_sizes:
+        images = rng.integers(0, 256, (batch_size, 32, 32, 3), dtype=np.uint8)
+        backend(images)  # warm-up
+        start = time.perf_counter()
+        for _ in range(iters):
+            backend(images)
+        elapsed = (time.perf_counter() - start) / iters
+        print('%10d %12.2f %14.0f' % (batch_size, elapsed * 1e3, batch_size / elapsed))
+
+
+# Concurrent clients each sending one image at a time through the engine
+def bench_engine(engine, clients, requests_per_client):
+    latencies = []
+    lock = threading.Lock()
+    rng = np.random.default_rng(1)
+    images = rng.integers(0, 256, (clients, 32, 32, 3), dtype=np.uint8)
+
+    def client(i):
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            engine.predict(images[i])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print('engine: %d clients, max batch %d, max latency %.1f ms' % (clients, engine.max_batch_size, engine.max_latency * 1e3))
+    print('  throughput %.0f images/sec, mean batch %.1f' % (len(latencies) / elapsed, statistics.mean(engine.batch_sizes)))
+    print('  latency p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.95) * 1e3, percentile(latencies, 0.99) * 1e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and serve the CIFAR-10 classifiers")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export = sub.add_parser('export', help="Export a trained model")
+    export.add_argument('--checkpoint', help="VRpytorch checkpoint or state dict")
+    export.add_argument('--keras', help="Keras model saved by TensorFlowVR.py")
+    export.add_argument('--torchscript', help="TorchScript output path (PyTorch only)")
+    export.add_argument('--onnx', help="ONNX output path")
+
+    bench = sub.add_parser('bench', help="Benchmark an exported model")
+    bench.add_argument('--model', required=True, help=".onnx, .h5/.keras or TorchScript file")
+    bench.add_argument('--threads', type=int, default=None)
+    bench.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128])
+    bench.add_argument('--iters', type=int, default=50)
+    bench.add_argument('--clients', type=int, default=32, help="Concurrent clients for the engine benchmark")
+    bench.add_argument('--requests', type=int, default=50, help="Requests per client")
+    bench.add_argument('--max-batch-size', type=int, default=32)
+    bench.add_argument('--max-latency-ms', type=float, default=5.0)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        if args.checkpoint:
+            export_pytorch(args.checkpoint, args.torchscript, args.onnx)
+        elif args.keras:
+            export_keras(args.keras, args.onnx)
+        else:
+            parser.error('export needs --checkpoint or --keras')
+    else:
+        backend = load_backend(args.model, args.threads)
+        bench_batch_sizes(backend, args.batch_sizes, args.iters)
+        engine = BatchingEngine(backend, args.max_batch_size, args.max_latency_ms)
+        bench_engine(engine, args.clients, args.requests)
+        engine.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Parallel hyperparameter sweep for the CIFAR-10 trainers (VRpytorch.py, TensorFlowVR.py)
+# Trials run as separate trainer processes, several at once, each pinned to its own slice of the CPU cores with a matching thread count.
+# Asynchronous successive halving (ASHA) decides how far each trial gets: every trial starts with --min-epochs, and whenever a
+# worker is free the best 1/eta of the trials that finished a rung are resumed from their checkpoint for eta times as many epochs.
+# The others are never resumed, so weak settings stop after a few epochs.
+#
+#   python cifar_sweep.py --trainer pytorch --trials 27 --workers 4 --min-epochs 1 --max-epochs 9
+#   python cifar_sweep.py --trainer tensorflow --trials 12 --workers 2
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Search spaces. ('log', low, high) samples log-uniformly, ('uniform', low, high) uniformly
+SEARCH_SPACES = {
+    'pytorch': {
+        'lr': ('log', 1e-4, 1e-1),
+        'momentum': ('uniform', 0.5, 0.99),
+        'dropout': ('uniform', 0.0, 0.5),
+    },
+    'tensorflow': {
+        'lr': ('log', 1e-4, 1e-2),
+        'dropout': ('uniform', 0.0, 0.5),
+        'l2': ('log', 1e-5, 1e-2),
+    },
+}
+
+
+def sample_params(space, rng):
+    params = {}
+    for name, (kind, low, high) in space.items():
+        if kind == 'log':
+            params[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            params[name] = rng.uniform(low, high)
+    return params
+
+
+# Command line for one trainer run. Each trial keeps its own checkpoint, so a promotion resumes where the last rung stopped
+def trainer_command(trainer, params, epochs, threads, trial_dir, result_file):
+    if trainer == 'pytorch':
+        cmd = [sys.executable, os.path.join(HERE, 'VRpytorch.py'),
+               '--epochs', str(epochs), '--threads', str(threads), '--workers', '1',
+               '--checkpoint', os.path.join(trial_dir, 'checkpoint.pt'), '--resume',
+               # Early stopping inside a trial would fight the scheduler, which already decides when trials stop
+               '--patience', '0', '--result-file', result_file]
+    else:
+        cmd = [sys.executable, os.path.join(HERE, 'TensorFlowVR.py'),
+               '--epochs', str(epochs), '--threads', str(threads),
+               '--model-file', os.path.join(trial_dir, 'model.keras'), '--save', 'yes', '--no-plot',
+               '--result-file', result_file]
+    for name, value in params.items():
+        cmd += ['--' + name.replace('_', '-'), '%.6g' % value]
+    return cmd
+
+
+class Trial:
+    def __init__(self, trial_id, params):
+        self.trial_id = trial_id
+        self.params = params
+        self.rung = -1
+        self.epochs = 0
+        self.accuracy = None
+        self.history = []
+        self.seconds = 0.0
+        self.status = 'pending'
+
+
+# ASHA bookkeeping: rung k trains to min_epochs * eta**k epochs
+class ASHA:
+    def __init__(self, min_epochs, max_epochs, eta):
+        self.eta = eta
+        self.budgets = []
+        budget = min_epochs
+        while budget < max_epochs:
+            self.budgets.append(budget)
+            budget *= eta
+        self.budgets.append(max_epochs)
+        self.completed = [[] for _ in self.budgets]
+        self.promoted = [set() for _ in self.budgets]
+
+    def record(self, trial):
+        self.completed[trial.rung].append(trial)
+
+    # The best trial of a rung that is in its top 1/eta and has not moved up yet, searching from the highest rung down
+    def promotable(self):
+        for rung in range(len(self.budgets) - 2, -1, -1):
+            done = sorted(self.completed[rung], key=lambda t: t.history[rung], reverse=True)
+            top = done[:len(done) // self.eta]
+            for trial in top:
+                if trial.trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial.trial_id)
+                    return trial
+        return None
+
+
+# Downloads and caches the trainer's dataset once, before any trial starts, so parallel trials never download it at the same
+# time. Runs in a child process so the sweep itself does not import torch or TensorFlow
+PREPARE_DATA = {
+    'pytorch': 'from cifar_data import load_cifar_uint8; load_cifar_uint8(train=True); load_cifar_uint8(train=False)',
+    'tensorflow': 'import tensorflow as tf; tf.keras.datasets.cifar10.load_data()',
+}
+
+
+def prepare_dataset(trainer):
+    subprocess.check_call([sys.executable, '-c', PREPARE_DATA[trainer]], stdin=subprocess.DEVNULL, cwd=HERE)
+
+
+def run_trial(trial, trainer, budget, threads, cores, trial_dir):
+    os.makedirs(trial_dir, exist_ok=True)
+    result_file = os.path.join(trial_dir, 'result_%d.json' % budget)
+    cmd = trainer_command(trainer, trial.params, budget, threads, trial_dir, result_file)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    start = time.perf_counter()
+    with open(os.path.join(trial_dir, 'log.txt'), 'a') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env, cwd=HERE)
+        # Pin the trial to its own cores so parallel trials do not compete for the same ones. This is set from here after the
+        # start rather than with preexec_fn, which is not safe to use from the pool's threads; the trainer starts its compute
+        # threads only after importing torch or TensorFlow, so they inherit the pinning
+        if cores and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except ProcessLookupError:
+                pass
+        returncode = proc.wait()
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        return None, elapsed
+    with open(result_file) as f:
+        return json.load(f)['accuracy'], elapsed
+
+
+def write_leaderboard(trials, path):
+    ranked = sorted(trials, key=lambda t: -1 if t.accuracy is None else t.accuracy, reverse=True)
+    names = sorted({name for t in trials for name in t.params})
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'accuracy', 'epochs', 'status', 'seconds'] + names)
+        for rank, t in enumerate(ranked, 1):
+            writer.writerow([rank, t.trial_id, '' if t.accuracy is None else '%.2f' % t.accuracy, t.epochs, t.status,
+                             '%.1f' % t.seconds] + ['%.6g' % t.params[n] for n in names])
+    return ranked
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ASHA hyperparameter sweep for the CIFAR-10 trainers")
+    parser.add_argument('--trainer', choices=sorted(SEARCH_SPACES), default='pytorch')
+    parser.add_argument('--trials', type=int, default=27, help="Number of sampled configurations")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4), help="Trials run in parallel")
+    parser.add_argument('--threads-per-trial', type=int, default=None, help="Defaults to the cores divided by --workers")
+    parser.add_argument('--min-epochs', type=int, default=1, help="Epochs in the first rung")
+    parser.add_argument('--max-epochs', type=int, default=9, help="Epochs in the last rung")
+    parser.add_argument('--eta', type=int, default=3, help="Keep the best 1/eta of each rung")
+    parser.add_argument('--out', default='sweep', help="Directory for trial checkpoints, logs and the leaderboard")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    threads = args.threads_per_trial or max(1, len(cores) // args.workers)
+    # Core slices, one per worker slot
+    slots = [cores[i * threads:(i + 1) * threads] for i in range(args.workers)]
+    free_slots = list(range(args.workers))
+
+    rng = random.Random(args.seed)
+    space = SEARCH_SPACES[args.trainer]
+    trials = [Trial(i, sample_params(space, rng)) for i in range(args.trials)]
+    new_trials = list(trials)
+    asha = ASHA(args.min_epochs, args.max_epochs, args.eta)
+    os.makedirs(args.out, exist_ok=True)
+    leaderboard_path = os.path.join(args.out, 'leaderboard.csv')
+
+    print('Preparing the %s dataset' % args.trainer)
+    prepare_dataset(args.trainer)
+    print('%d trials, %d workers x %d threads, rungs at %s epochs' % (args.trials, args.workers, threads, asha.budgets))
+    start = time.perf_counter()
+    finished_runs = 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            # Fill free worker slots: promotions first, then new trials
+            while free_slots:
+                trial = asha.promotable()
+                if trial is None and new_trials:
+                    trial = new_trials.pop(0)
+                if trial is None:
+                    break
+                slot = free_slots.pop()
+                rung = trial.rung + 1
+                trial.status = 'running'
+                trial_dir = os.path.join(args.out, 'trial_%03d' % trial.trial_id)
+                future = pool.submit(run_trial, trial, args.trainer, asha.budgets[rung], threads, slots[slot], trial_dir)
+                running[future] = (trial, rung, slot)
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial, rung, slot = running.pop(future)
+                free_slots.append(slot)
+                accuracy, elapsed = future.result()
+                trial.seconds += elapsed
+                finished_runs += 1
+                if accuracy is None:
+                    trial.status = 'failed'
+                    print('trial %d failed at rung %d, see its log.txt' % (trial.trial_id, rung))
+                    continue
+                trial.rung = rung
+                trial.epochs = asha.budgets[rung]
+                trial.accuracy = accuracy
+                trial.history.append(accuracy)
+                trial.status = 'complete' if rung == len(asha.budgets) - 1 else 'stopped'
+                asha.record(trial)
+                print('trial %d rung %d (%d epochs): %.2f%% in %.0fs' % (trial.trial_id, rung, trial.epochs, accuracy, elapsed))
+            write_leaderboard(trials, leaderboard_path)
+
+    elapsed = time.perf_counter() - start
+    ranked = write_leaderboard(trials, leaderboard_path)
+    epochs_run = sum(t.epochs for t in trials)
+    print()
+    print('%d trials (%d runs, %d epochs) in %.1f min: %.1f trials/hour' % (
+        args.trials, finished_runs, epochs_run, elapsed / 60, args.trials / elapsed * 3600))
+    print('%4s %6s %9s %7s  %s' % ('rank', 'trial', 'accuracy', 'epochs', 'params'))
+    for rank, t in enumerate(ranked[:10], 1):
+        params = ' '.join('%s=%.4g' % item for item in sorted(t.params.items()))
+        accuracy = '-' if t.accuracy is None else '%.2f%%' % t.accuracy
+        print('%4d %6d %9s %7d  %s' % (rank, t.trial_id, accuracy, t.epochs, params))
+    print('Leaderboard written to %s' % leaderboard_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Small metrics sink shared by the training scripts
+# Every call to log() writes one JSON line (step plus the metric values), and mirrors the scalars to TensorBoard when a log directory is given
+# A CSV file can be written as well; its columns are the keys of the first record logged to it
+# TensorBoard is optional: torch.utils.tensorboard is only imported when tensorboard_dir is set
+import csv
+import json
+import os
+import time
+
+
+class MetricsLogger:
+    def __init__(self, jsonl_path=None, tensorboard_dir=None, csv_path=None):
+        self.jsonl_file = None
+        self.csv_file = None
+        self.csv_writer = None
+        self.writer = None
+        if jsonl_path:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+            # Line buffered, so the file can be tailed while a run is going
+            self.jsonl_file = open(jsonl_path, 'a', buffering=1)
+        if csv_path:
+            os.makedirs(os.path.dirname(os.path.abspath(csv_path)), exist_ok=True)
+            # Appending to an existing file (a resumed run) keeps its header
+            self.csv_has_header = os.path.exists(csv_path) and os.path.getsize(csv_path) > 0
+            self.csv_file = open(csv_path, 'a', buffering=1, newline='')
+        if tensorboard_dir:
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(tensorboard_dir)
+
+    def log(self, step, metrics, prefix=''):
+        record = {'step': step, 'time': time.time()}
+        record.update(metrics)
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(record) + '\n')
+        if self.csv_file is not None:
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=list(record), extrasaction='ignore')
+                if not self.csv_has_header:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerow(record)
+        if self.writer is not None:
+            for name, value in metrics.items():
+                if isinstance(value, (int, float)):
+                    self.writer.add_scalar(prefix + name, value, step)
+
+    def close(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,88 @@
+# Checkpoints and per-generation metrics for the NEAT scripts (neatsnake.py, neatlander.py)
+# neat.Checkpointer pickles the population every few generations; start_population() resumes from the newest checkpoint that
+# loads. GenerationMetrics is a neat reporter that logs one record per generation through MetricsLogger, to JSONL and CSV:
+# best/mean fitness, species count, genome sizes and the evaluation time measured by the ChunkedEvaluator.
+#
+#   population, generation = start_population(config, 'checkpoints/snake', resume=True)
+#   evaluator.generation = generation
+#   logger = add_run_reporters(population, evaluator, 'checkpoints/snake', 5, 'runs/snake.jsonl', 'runs/snake.csv')
+#   population.run(evaluator.evaluate, generations - generation)
+#   logger.close()
+import glob
+import os
+import pickle
+import statistics
+
+import neat
+
+from metrics_logger import MetricsLogger
+
+
+def checkpoint_prefix(checkpoint_dir):
+    return os.path.join(checkpoint_dir, 'neat-checkpoint-')
+
+
+# Checkpoint files of a directory, newest generation first
+def list_checkpoints(checkpoint_dir):
+    prefix = checkpoint_prefix(checkpoint_dir)
+    found = []
+    for path in glob.glob(prefix + '*'):
+        suffix = path[len(prefix):]
+        if suffix.isdigit():
+            found.append((int(suffix), path))
+    return [path for generation, path in sorted(found, reverse=True)]
+
+
+# Returns (population, generation). With resume, the population comes from the newest readable checkpoint, falling back to older
+# ones if the last write was cut short; otherwise, or when there is none, a new population is created
+def start_population(config, checkpoint_dir=None, resume=False):
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    if resume and checkpoint_dir:
+        for path in list_checkpoints(checkpoint_dir):
+            try:
+                population = neat.Checkpointer.restore_checkpoint(path)
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+                print("Skipping unreadable checkpoint %s: %s" % (path, e))
+                continue
+            print("Resuming from %s (generation %d)" % (path, population.generation))
+            return population, population.generation
+    return neat.Population(config), 0
+
+
+class GenerationMetrics(neat.reporting.BaseReporter):
+    def __init__(self, logger, evaluator=None):
+        self.logger = logger
+        self.evaluator = evaluator
+        self.generation = 0
+
+    def start_generation(self, generation):
+        self.generation = generation
+
+    def post_evaluate(self, config, population, species, best_genome):
+        fitness = [g.fitness for g in population.values() if g.fitness is not None]
+        # genome.size() is (number of nodes, number of enabled connections)
+        sizes = [g.size() for g in population.values()]
+        best_nodes, best_connections = best_genome.size()
+        self.logger.log(self.generation, {
+            'generation': self.generation,
+            'best_fitness': best_genome.fitness,
+            'mean_fitness': statistics.mean(fitness),
+            'stdev_fitness': statistics.pstdev(fitness),
+            'population': len(population),
+            'species': len(species.species),
+            'mean_nodes': statistics.mean(n for n, c in sizes),
+            'mean_connections': statistics.mean(c for n, c in sizes),
+            'best_nodes': best_nodes,
+            'best_connections': best_connections,
+            'eval_time': self.evaluator.eval_time if self.evaluator is not None else None,
+        }, prefix='neat/')
+
+
+# Adds the checkpoint and metrics reporters to a population. Returns the MetricsLogger, to be closed after the run
+def add_run_reporters(population, evaluator, checkpoint_dir=None, checkpoint_every=5, metrics_file=None, csv_file=None):
+    if checkpoint_dir and checkpoint_every:
+        population.add_reporter(neat.Checkpointer(checkpoint_every, filename_prefix=checkpoint_prefix(checkpoint_dir)))
+    logger = MetricsLogger(jsonl_path=metrics_file, csv_path=csv_file)
+    population.add_reporter(GenerationMetrics(logger, evaluator))
+    return logger
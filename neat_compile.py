@@ -0,0 +1,316 @@
+# Batched NumPy evaluation of NEAT feed-forward genomes, for the evaluation loops of neatsnake.py and neatlander.py
+# neat.nn.FeedForwardNetwork.activate walks its node list in Python for one input vector at a time. CompiledNetworks turns a
+# list of genomes into layers of arrays and evaluates many input rows, each with any of the genomes, in one call:
+#   nets = CompiledNetworks(genomes, config)
+#   outputs = nets.activate(inputs, genome_index)    # inputs [R, num_inputs], genome_index [R] -> outputs [R, num_outputs]
+#
+# The plan follows FeedForwardNetwork.create, so the evaluated nodes, link order, bias, response and the
+# activation/aggregation functions are exactly neat's. Nodes are grouped by depth (longest path from the inputs); nodes of
+# one depth only read earlier depths, so a whole depth is computed at once for every row. Each depth is stored as arrays over
+# [genome, node, link], padded to the widest genome:
+#   src, weight, mask   which value columns feed each node, with what weight, and which links are real
+#   bias, response      per node
+#   dst                 the value column each node writes; padding writes to a scratch column
+#
+# Links are summed one at a time in neat's link order (a running np.add.accumulate) rather than with a matrix product, so the
+# sums round exactly like neat's sum(). By default (exact=True) the activations are neat's own: the built-in ones are
+# rewritten over arrays with the same clamping, where Python's min/max is np.where, and the same math.exp/tanh/sin applied
+# element by element; any other function is called per value. The outputs are then bit-for-bit those of
+# FeedForwardNetwork.activate, so fitness is the same as with neat's networks. exact=False uses NumPy's exp/tanh/sin
+# instead, which are faster on large batches but can differ in the last bit, and that can flip a close argmax and change a game.
+# The per-row layer arrays are gathered once for a genome_index and reused while the next calls pass the same one, as the
+# evaluation loops do until a game ends.
+#
+# Check both modes against FeedForwardNetwork on genomes mutated under the config, and on genomes using every vectorised
+# activation and aggregation, and compare speed:
+#   python neat_compile.py --config config-feedforward.txt --genomes 200 --rows 64
+import argparse
+import math
+import random
+import sys
+import time
+
+import neat
+import numpy as np
+
+# NumPy versions of neat.activations, same clamping and operation order
+ACTIVATIONS = {
+    'sigmoid': lambda z: 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0))),
+    'tanh': lambda z: np.tanh(np.clip(2.5 * z, -60.0, 60.0)),
+    'sin': lambda z: np.sin(np.clip(5.0 * z, -60.0, 60.0)),
+    'gauss': lambda z: np.exp(-5.0 * np.clip(z, -3.4, 3.4) ** 2),
+    'relu': lambda z: np.where(z > 0.0, z, 0.0),
+    'identity': lambda z: z,
+    'clamped': lambda z: np.clip(z, -1.0, 1.0),
+    'abs': np.abs,
+}
+
+# neat's min(hi, max(lo, z)) for floats: Python's min and max keep their first argument unless the other compares smaller
+# (larger), so NaN clamps to hi
+def _clamp(z, lo, hi):
+    z = np.where(z < hi, z, hi)
+    return np.where(z > lo, z, lo)
+
+
+# math functions applied to every element, so the results are those of neat's scalar calls
+_exp = np.frompyfunc(math.exp, 1, 1)
+_tanh = np.frompyfunc(math.tanh, 1, 1)
+_sin = np.frompyfunc(math.sin, 1, 1)
+# Python's z**2 calls C pow(), which can round differently from NumPy's z * z
+_pow = np.frompyfunc(math.pow, 2, 1)
+
+# neat.activations rewritten over arrays with the same operations in the same order, keyed by neat's function
+EXACT_ACTIVATIONS = {
+    neat.activations.sigmoid_activation: lambda z: 1.0 / (1.0 + _exp(-_clamp(5.0 * z, -60.0, 60.0)).astype(np.float64)),
+    neat.activations.tanh_activation: lambda z: _tanh(_clamp(2.5 * z, -60.0, 60.0)).astype(np.float64),
+    neat.activations.sin_activation: lambda z: _sin(_clamp(5.0 * z, -60.0, 60.0)).astype(np.float64),
+    neat.activations.gauss_activation: lambda z: _exp(-5.0 * _pow(_clamp(z, -3.4, 3.4), 2.0).astype(np.float64)).astype(np.float64),
+    neat.activations.relu_activation: lambda z: np.where(z > 0.0, z, 0.0),
+    neat.activations.identity_activation: lambda z: z,
+    neat.activations.clamped_activation: lambda z: _clamp(z, -1.0, 1.0),
+    neat.activations.abs_activation: np.abs,
+}
+
+# Aggregations computed on the padded [rows, nodes, links] products. Anything else falls back to neat's function per node
+VECTOR_AGGREGATIONS = ('sum', 'product', 'max', 'min', 'mean')
+
+
+class Layer:
+    def __init__(self, nodes, links):
+        # nodes: per genome, a list of (column, activation, aggregation, act_fn, agg_fn, bias, response, [(src_column, weight)])
+        width = max(1, max(len(n) for n in nodes))
+        fan = max(1, links)
+        g = len(nodes)
+        self.dst = np.full((g, width), -1, dtype=np.int64)
+        self.src = np.zeros((g, width, fan), dtype=np.int64)
+        self.weight = np.zeros((g, width, fan))
+        self.mask = np.zeros((g, width, fan), dtype=bool)
+        self.bias = np.zeros((g, width))
+        self.response = np.zeros((g, width))
+        self.activation = np.full((g, width), -1, dtype=np.int64)
+        self.aggregation = np.full((g, width), -1, dtype=np.int64)
+        self.activations = []
+        self.aggregations = []
+        for i, genome_nodes in enumerate(nodes):
+            for j, (column, act, agg, act_fn, agg_fn, bias, response, inputs) in enumerate(genome_nodes):
+                self.dst[i, j] = column
+                self.bias[i, j] = bias
+                self.response[i, j] = response
+                self.activation[i, j] = self._code(self.activations, (act, act_fn))
+                self.aggregation[i, j] = self._code(self.aggregations, (agg, agg_fn))
+                for k, (src, weight) in enumerate(inputs):
+                    self.src[i, j, k] = src
+                    self.weight[i, j, k] = weight
+                    self.mask[i, j, k] = True
+
+    @staticmethod
+    def _code(table, entry):
+        if entry not in table:
+            table.append(entry)
+        return table.index(entry)
+
+
+class CompiledNetworks:
+    def __init__(self, genomes, config, exact=True):
+        self.exact = exact
+        self._selected = None
+        self.num_inputs = len(config.genome_config.input_keys)
+        self.num_outputs = len(config.genome_config.output_keys)
+        plans = [self._plan(genome, config) for genome in genomes]
+
+        # Column 0 is a constant zero that padded links read, then inputs, outputs and hidden nodes; the last column is scratch
+        self.num_columns = max((columns for columns, depths in plans), default=1 + self.num_inputs + self.num_outputs) + 1
+        self.scratch = self.num_columns - 1
+        self.layers = []
+        for d in range(max((len(depths) for columns, depths in plans), default=0)):
+            nodes = [depths[d] if d < len(depths) else [] for columns, depths in plans]
+            links = max((len(node[-1]) for genome_nodes in nodes for node in genome_nodes), default=0)
+            layer = Layer(nodes, links)
+            layer.dst[layer.dst < 0] = self.scratch
+            self.layers.append(layer)
+
+    # Columns and depth-grouped nodes for one genome, with the nodes, links and functions FeedForwardNetwork.create would
+    # evaluate: the expressed connections in genome order, the nodes neat.graphs.required_for_output keeps, and layers built
+    # by feed_forward_layers' rule (a node joins once all of its sources are known). create scans every connection for every
+    # node and formats an unused string per link; here each node's links are collected once, which makes building the
+    # networks of a generation several times faster. A layer's nodes only read earlier layers, so the layer is the depth
+    def _plan(self, genome, config):
+        genome_config = config.genome_config
+        connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+        links = {}
+        for i, o in connections:
+            links.setdefault(o, []).append((i, genome.connections[i, o].weight))
+        required = neat.graphs.required_for_output(genome_config.input_keys, genome_config.output_keys, connections)
+        columns = {}
+        for key in list(genome_config.input_keys) + list(genome_config.output_keys):
+            columns[key] = len(columns) + 1
+        known = set(genome_config.input_keys)
+        pending = [node for node in required if node in links]
+        depths = []
+        while True:
+            layer = [node for node in pending if all(i in known for i, w in links[node])]
+            if not layer:
+                break
+            known.update(layer)
+            pending = [node for node in pending if node not in known]
+            nodes = []
+            for node in layer:
+                if node not in columns:
+                    columns[node] = len(columns) + 1
+                gene = genome.nodes[node]
+                nodes.append((columns[node], gene.activation, gene.aggregation,
+                              genome_config.activation_defs.get(gene.activation),
+                              genome_config.aggregation_function_defs.get(gene.aggregation), gene.bias, gene.response,
+                              [(columns[i], w) for i, w in links[node]]))
+            depths.append(nodes)
+        return len(columns) + 1, depths
+
+    # inputs: float [R, num_inputs]; genome_index: int [R], the genome each row is evaluated with (default: the first)
+    # Returns float [R, num_outputs]
+    def activate(self, inputs, genome_index=None):
+        inputs = np.asarray(inputs, dtype=np.float64)
+        rows = inputs.shape[0]
+        g = np.zeros(rows, dtype=np.int64) if genome_index is None else np.asarray(genome_index, dtype=np.int64)
+        r, selected = self._select(g)
+        values = np.zeros((rows, self.num_columns))
+        values[:, 1:1 + self.num_inputs] = inputs
+        for layer, (src, weight, mask, bias, response, dst, agg_code, act_code) in zip(self.layers, selected):
+            products = values[r[:, :, None], src] * weight
+            if len(layer.aggregations) == 1:
+                name, fn = layer.aggregations[0]
+                aggregated = self._aggregate(name, fn, products, mask, agg_code == 0)
+            else:
+                aggregated = np.zeros(agg_code.shape)
+                for code, (name, fn) in enumerate(layer.aggregations):
+                    selected_nodes = agg_code == code
+                    aggregated = np.where(selected_nodes, self._aggregate(name, fn, products, mask, selected_nodes), aggregated)
+            z = bias + response * aggregated
+            if len(layer.activations) == 1:
+                out = self._activate(*layer.activations[0], z)
+            else:
+                out = np.zeros(z.shape)
+                for code, (name, fn) in enumerate(layer.activations):
+                    selected_nodes = act_code == code
+                    out[selected_nodes] = self._activate(name, fn, z[selected_nodes])
+            values[r, dst] = out
+        return values[:, 1 + self.num_inputs:1 + self.num_inputs + self.num_outputs]
+
+    # Row indices and every layer's arrays for the genomes of the rows, kept for the next call with the same genome_index
+    def _select(self, g):
+        if self._selected is None or not np.array_equal(self._selected[0], g):
+            selected = [(layer.src[g], layer.weight[g], layer.mask[g], layer.bias[g], layer.response[g], layer.dst[g],
+                         layer.aggregation[g], layer.activation[g]) for layer in self.layers]
+            self._selected = (g.copy(), np.arange(len(g))[:, None], selected)
+        return self._selected[1:]
+
+    def _aggregate(self, name, fn, products, mask, selected):
+        if name == 'sum' or name == 'mean':
+            # A running sum in neat's link order, so every partial sum rounds as in Python's sum(). Padded links add 0.0 at the
+            # end, and the final + 0.0 turns -0.0 into 0.0 as sum() does, since it starts from the integer 0
+            total = np.add.accumulate(products, axis=2)[..., -1] + 0.0
+            if name == 'sum':
+                return total
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return total / mask.sum(axis=2)
+        if name == 'product':
+            return np.multiply.accumulate(np.where(mask, products, 1.0), axis=2)[..., -1]
+        if name == 'max':
+            return np.where(mask, products, -np.inf).max(axis=2)
+        if name == 'min':
+            return np.where(mask, products, np.inf).min(axis=2)
+        # Any other aggregation: neat's function on each selected node's link products
+        result = np.zeros(products.shape[:2])
+        for i, j in zip(*np.nonzero(selected)):
+            result[i, j] = fn(list(products[i, j, mask[i, j]]))
+        return result
+
+    def _activate(self, name, fn, z):
+        if not self.exact and name in ACTIVATIONS:
+            return ACTIVATIONS[name](z)
+        if fn in EXACT_ACTIVATIONS:
+            return EXACT_ACTIVATIONS[fn](z)
+        return np.frompyfunc(fn, 1, 1)(z).astype(np.float64)
+
+
+# Genomes as the config evolves them: hidden nodes, disabled links, and only the config's activation and aggregation options
+def config_genomes(config, count, mutations, rng):
+    gc = config.genome_config
+    genomes = []
+    for key in range(count):
+        genome = config.genome_type(key)
+        genome.configure_new(gc)
+        for _ in range(rng.randrange(mutations + 1)):
+            genome.mutate(gc)
+        genomes.append(genome)
+    return genomes
+
+
+# The same genomes with every vectorised activation and aggregation
+def random_genomes(config, count, mutations, rng):
+    gc = config.genome_config
+    activations = sorted(set(ACTIVATIONS) & set(gc.activation_defs.functions))
+    genomes = config_genomes(config, count, mutations, rng)
+    for genome in genomes:
+        for node_key, node in genome.nodes.items():
+            node.activation = rng.choice(activations)
+            fan_in = sum(1 for (i, o), c in genome.connections.items() if o == node_key and c.enabled)
+            # neat's max, min and mean fail on nodes without inputs
+            node.aggregation = rng.choice(VECTOR_AGGREGATIONS if fan_in else ('sum', 'product'))
+    return genomes
+
+
+# Bit-for-bit mismatches of exact mode and of NumPy activations against FeedForwardNetwork.activate, with timings
+def compare(config, genomes, rows, seed):
+    count = len(genomes)
+    inputs = np.random.default_rng(seed).normal(0.0, 2.0, (rows * count, len(config.genome_config.input_keys)))
+    genome_index = np.repeat(np.arange(count), rows)
+
+    start = time.perf_counter()
+    nets = [neat.nn.FeedForwardNetwork.create(genome, config) for genome in genomes]
+    expected = np.array([nets[g].activate(list(x)) for x, g in zip(inputs, genome_index)])
+    neat_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact = CompiledNetworks(genomes, config).activate(inputs, genome_index)
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    fast = CompiledNetworks(genomes, config, exact=False).activate(inputs, genome_index)
+    fast_time = time.perf_counter() - start
+
+    # Compare the bit patterns, so -0.0 against 0.0 or differing NaNs also count as mismatches
+    def mismatches(outputs):
+        return int((expected.view(np.uint64) != outputs.view(np.uint64)).any(axis=1).sum())
+
+    hidden = sum(len(g.nodes) - len(config.genome_config.output_keys) for g in genomes)
+    print("%d genomes (%d hidden nodes), %d rows" % (count, hidden, len(inputs)))
+    print("FeedForwardNetwork.activate: %8.1f ms" % (neat_time * 1e3))
+    print("compiled, exact:             %8.1f ms (%.1fx), %d rows differ in any bit" % (
+        exact_time * 1e3, neat_time / exact_time, mismatches(exact)))
+    print("compiled, NumPy activations: %8.1f ms (%.1fx), %d rows differ in any bit, %d in the chosen output, "
+          "max abs difference %.3g" % (fast_time * 1e3, neat_time / fast_time, mismatches(fast),
+                                       int((expected.argmax(axis=1) != fast.argmax(axis=1)).sum()), np.abs(expected - fast).max()))
+    return mismatches(exact), mismatches(fast)
+
+
+# Exact mode must match neat bit for bit on both genome sets. NumPy activations may differ in the last bits, and are reported
+def self_test(config, count, rows, mutations, seed):
+    rng = random.Random(seed)
+    random.seed(seed)
+    print("Genomes mutated under the config:")
+    exact = compare(config, config_genomes(config, count, mutations, rng), rows, seed)[0]
+    print("Genomes with every vectorised activation and aggregation:")
+    return exact == 0 and compare(config, random_genomes(config, count, mutations, rng), rows, seed)[0] == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check CompiledNetworks against neat's FeedForwardNetwork, bit for bit")
+    parser.add_argument('--config', default='config-feedforward.txt')
+    parser.add_argument('--genomes', type=int, default=200)
+    parser.add_argument('--rows', type=int, default=64, help="Input rows per genome")
+    parser.add_argument('--mutations', type=int, default=30, help="Up to this many mutations per genome")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet, neat.DefaultStagnation, args.config)
+    if not self_test(config, args.genomes, args.rows, args.mutations, args.seed):
+        sys.exit("compiled outputs differ from FeedForwardNetwork.activate")
@@ -0,0 +1,68 @@
+# Parallel genome evaluation for the NEAT scripts (neatsnake.py, neatlander.py)
+# Works like neat.ParallelEvaluator, with three differences:
+# - Workers receive chunks of genomes instead of single genomes, so an evaluator can run every genome in its chunk
+#   together. neatsnake.py steps one SnakeGames batch per chunk.
+# - Every genome gets a seed derived from the run seed, the generation and its key. A run with the same seed therefore
+#   evaluates each genome on the same games, whatever the worker count.
+# - The time each generation took to evaluate is reported.
+#
+#   evaluator = ChunkedEvaluator(eval_chunk, num_workers=8, seed=0)
+#   winner = population.run(evaluator.evaluate, 100)
+#   evaluator.close()
+#
+# eval_chunk(chunk, config) takes a list of (genome_id, genome, seed) and returns a list of (genome_id, fitness), or of
+# (genome_id, fitness, extra) to pass something else back per genome (neatsnake.py returns each game's trace); the extras of the
+# last generation are kept in evaluator.extras by genome key.
+# It must be a module-level function, so the worker processes can import it.
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+def genome_seed(seed, generation, genome_id):
+    return int(np.random.SeedSequence([seed, generation, genome_id]).generate_state(1)[0])
+
+
+class ChunkedEvaluator:
+    def __init__(self, eval_chunk, num_workers=None, seed=0, chunks_per_worker=1, verbose=True):
+        self.eval_chunk = eval_chunk
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.seed = seed
+        self.chunks_per_worker = chunks_per_worker
+        self.verbose = verbose
+        self.generation = 0
+        self.eval_time = 0.0
+        self.extras = {}
+        # Created on the first generation and kept for the whole run, so process start-up is paid once
+        self.pool = None
+
+    # Passed to population.run(). Fitness is written by genome key, and the genomes list itself is left untouched
+    def evaluate(self, genomes, config):
+        start = time.perf_counter()
+        items = [(genome_id, genome, genome_seed(self.seed, self.generation, genome_id)) for genome_id, genome in genomes]
+        if self.num_workers == 1:
+            results = self.eval_chunk(items, config)
+        else:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.num_workers)
+            n_chunks = min(len(items), self.num_workers * self.chunks_per_worker)
+            chunks = [items[i::n_chunks] for i in range(n_chunks)]
+            results = [r for chunk in self.pool.starmap(self.eval_chunk, [(chunk, config) for chunk in chunks]) for r in chunk]
+
+        fitness = {r[0]: r[1] for r in results}
+        self.extras = {r[0]: r[2] for r in results if len(r) > 2}
+        for genome_id, genome in genomes:
+            genome.fitness = fitness[genome_id]
+        self.eval_time = time.perf_counter() - start
+        if self.verbose:
+            print("Generation %d: evaluated %d genomes in %.3fs (%.0f genomes/sec, %d workers)" % (
+                self.generation, len(genomes), self.eval_time, len(genomes) / self.eval_time, self.num_workers))
+        self.generation += 1
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
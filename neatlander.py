@@ -1,38 +1,111 @@
+import argparse
+import functools
 import gymnasium as gym
 import neat
+import numpy as np
+import pickle
 
-# Define the fitness function for the NEAT algorithm
-def eval_genome(genome, config):
-    env = gym.make('LunarLander-v2')
-    observation = env.reset()
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
-    fitness = 0.0
+from neat_checkpoint import add_run_reporters, start_population
+from neat_compile import CompiledNetworks
+from neat_parallel import ChunkedEvaluator
+
+# gymnasium 1.0 removed LunarLander-v2; v3 has the same observations and actions
+ENV_ID = 'LunarLander-v3' if 'LunarLander-v3' in gym.envs.registry else 'LunarLander-v2'
+# Episodes per genome, averaged into its fitness, and environments stepped together in each evaluation process
+EPISODES = 3
+NUM_ENVS = 16
+
+# One vector environment per process, created on first use and reused by every later generation,
+# so environment construction happens once per worker instead of once per genome
+_envs = None
+
+def get_envs(num_envs):
+    global _envs
+    if _envs is None or _envs.num_envs != num_envs:
+        if _envs is not None:
+            _envs.close()
+        _envs = gym.vector.SyncVectorEnv([lambda: gym.make(ENV_ID) for _ in range(num_envs)])
+    return _envs
+
+# The episode seeds of a genome, derived from its evaluation seed so every run with the same --seed replays the same landings
+def episode_seeds(seed, episodes):
+    return [int(s) for s in np.random.SeedSequence(seed).generate_state(episodes)]
+
+# Plays episode i with genome genome_index[i] of nets on an environment reset with seeds[i], num_envs episodes at a time,
+# and returns each episode's total reward
+def run_episodes(nets, genome_index, seeds, envs):
+    returns = np.zeros(len(seeds))
+    actions = np.zeros(envs.num_envs, dtype=np.int64)
+    for start in range(0, len(seeds), envs.num_envs):
+        n = min(envs.num_envs, len(seeds) - start)
+        # Environments without an episode in this wave are reset unseeded and ignored
+        observations, infos = envs.reset(seed=seeds[start:start + n] + [None] * (envs.num_envs - n))
+        done = np.arange(envs.num_envs) >= n
+        while not done.all():
+            # LunarLander has 4 discrete actions: fire the engine with the highest output.
+            # All running episodes go through their networks in one call
+            running = np.flatnonzero(~done)
+            actions[running] = nets.activate(observations[running], genome_index[start + running]).argmax(axis=1)
+            observations, rewards, terminated, truncated, infos = envs.step(actions)
+            # A finished environment resets itself on the next step; rewards after the end of an episode are not counted
+            returns[start:start + n] += np.where(done, 0.0, rewards)[:n]
+            done |= terminated | truncated
+    return returns
+
+# Define the fitness function for the NEAT algorithm: the mean reward over several seeded episodes, which smooths out lucky landings
+def eval_chunk(chunk, config, episodes=EPISODES, num_envs=NUM_ENVS):
+    nets = CompiledNetworks([genome for genome_id, genome, seed in chunk], config)
+    genome_index = np.repeat(np.arange(len(chunk)), episodes)
+    seeds = [s for genome_id, genome, seed in chunk for s in episode_seeds(seed, episodes)]
+    returns = run_episodes(nets, genome_index, seeds, get_envs(num_envs)).reshape(len(chunk), episodes)
+    return [(genome_id, float(r)) for (genome_id, genome, seed), r in zip(chunk, returns.mean(axis=1))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evolve a Lunar Lander pilot with NEAT")
+    parser.add_argument('--config', default='neat_config.ini')
+    parser.add_argument('--generations', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=None, help="Evaluation processes. Defaults to the CPU count")
+    parser.add_argument('--seed', type=int, default=0, help="Seeds every genome's episodes")
+    parser.add_argument('--episodes', type=int, default=EPISODES, help="Episodes per genome, averaged")
+    parser.add_argument('--envs', type=int, default=NUM_ENVS, help="Environments per evaluation process")
+    parser.add_argument('--checkpoint-dir', default=None, help="Save the population here every --checkpoint-every generations")
+    parser.add_argument('--checkpoint-every', type=int, default=5)
+    parser.add_argument('--resume', action='store_true', help="Continue from the newest checkpoint in --checkpoint-dir")
+    parser.add_argument('--metrics-file', default=None, help="Per-generation metrics as JSON lines")
+    parser.add_argument('--csv-file', default=None, help="Per-generation metrics as CSV")
+    args = parser.parse_args()
+
+    # Load the NEAT configuration file
+    config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
+                         neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                         args.config)
+
+    # Create the NEAT population, or restore it from the last checkpoint
+    pop, start_generation = start_population(config, args.checkpoint_dir, args.resume)
+    pop.add_reporter(neat.StdOutReporter(True))
+
+    # Run the NEAT algorithm. population.run() calls its fitness function with the whole generation
+    evaluate = functools.partial(eval_chunk, episodes=args.episodes, num_envs=args.envs)
+    evaluator = ChunkedEvaluator(evaluate, num_workers=args.workers, seed=args.seed)
+    evaluator.generation = start_generation
+    logger = add_run_reporters(pop, evaluator, args.checkpoint_dir, args.checkpoint_every, args.metrics_file, args.csv_file)
+    try:
+        winner = pop.run(evaluator.evaluate, max(1, args.generations - start_generation))
+    finally:
+        evaluator.close()
+        logger.close()
+
+    # Save the winner's genome to a file
+    with open("lander_winner.pkl", "wb") as f:
+        pickle.dump(winner, f)
+
+    # Test the winning genome on the Lunar Lander environment
+    env = gym.make(ENV_ID, render_mode='human')
+    observation, info = env.reset()
+    net = CompiledNetworks([winner], config)
     done = False
     while not done:
-        action = net.activate(observation)
-        observation, reward, done, info = env.step(action)
-        fitness += reward
+        action = int(net.activate(observation[None]).argmax())
+        observation, reward, terminated, truncated, info = env.step(action)
+        done = terminated or truncated
     env.close()
-    return fitness
-
-# Load the NEAT configuration file
-config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
-                     neat.DefaultSpeciesSet, neat.DefaultStagnation,
-                     'neat_config.ini')
-
-# Create the NEAT population
-pop = neat.Population(config)
-
-# Run the NEAT algorithm
-winner = pop.run(eval_genome)
-
-# Test the winning genome on the Lunar Lander environment
-env = gym.make('LunarLander-v2')
-observation = env.reset()
-net = neat.nn.FeedForwardNetwork.create(winner, config)
-done = False
-while not done:
-    action = net.activate(observation)
-    observation, reward, done, info = env.step(action)
-    env.render()
-env.close()
\ No newline at end of file
@@ -1,133 +1,102 @@
-import pygame
-import random
+import argparse
+import functools
 import neat
 import os
 import pickle
 
-# Set up the screen
-SCREEN_WIDTH = 480
-SCREEN_HEIGHT = 480
-BLOCK_SIZE = 20
-GRID_SIZE = SCREEN_WIDTH // BLOCK_SIZE
-
-# Colors
-WHITE = (255, 255, 255)
-BLACK = (0, 0, 0)
-RED = (255, 0, 0)
-GREEN = (0, 255, 0)
-BLUE = (0, 0, 255)
-
-# Initialize Pygame
-pygame.init()
-pygame.display.set_caption("NEAT Snake")
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-clock = pygame.time.Clock()
-
-class Snake:
-    def __init__(self):
-        self.body = [(GRID_SIZE // 2, GRID_SIZE // 2)]
-        self.direction = random.choice(["up", "down", "left", "right"])
-
-    def move(self):
-        x, y = self.body[0]
-
-        if self.direction == "up":
-            y -= 1
-        elif self.direction == "down":
-            y += 1
-        elif self.direction == "left":
-            x -= 1
-        elif self.direction == "right":
-            x += 1
-
-        self.body.insert(0, (x, y))
-        self.body.pop()
-
-    def change_direction(self, direction):
-        if direction == "up" and self.direction != "down":
-            self.direction = "up"
-        elif direction == "down" and self.direction != "up":
-            self.direction = "down"
-        elif direction == "left" and self.direction != "right":
-            self.direction = "left"
-        elif direction == "right" and self.direction != "left":
-            self.direction = "right"
-
-    def draw(self):
-        for x, y in self.body:
-            rect = pygame.Rect(x * BLOCK_SIZE, y * BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE)
-            pygame.draw.rect(screen, GREEN, rect)
-
-    def collide_with_food(self, food):
-        return self.body[0] == food.position
-
-    def collide_with_wall(self):
-        x, y = self.body[0]
-        return x < 0 or x >= GRID_SIZE or y < 0 or y >= GRID_SIZE
-
-    def collide_with_self(self):
-        return self.body[0] in self.body[1:]
-
-class Food:
-    def __init__(self):
-        self.position = (random.randint(0, GRID_SIZE - 1), random.randint(0, GRID_SIZE - 1))
-
-    def draw(self):
-        rect = pygame.Rect(self.position[0] * BLOCK_SIZE, self.position[1] * BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE)
-        pygame.draw.rect(screen, RED, rect)
-
-def eval_genomes(genomes, config):
-    for genome_id, genome in genomes:
-        genome.fitness = 0.0     
-        net = neat.nn.FeedForwardNetwork.create(genome, config)
-
-        snake = Snake()
-        food = Food()
-
-        while True:
-            # Get the snake's current state
-            x, y = snake.body[0]
-            left = (x - 1 < 0 or (x - 1, y) in snake.body)
-            right = (x + 1 >= GRID_SIZE or (x + 1, y) in snake.body)
-            up = (y - 1 < 0 or (x, y - 1) in snake.body)
-            down = (y + 1 >= GRID_SIZE or (x, y + 1) in snake.body)
-
-            # Get the network's output
-            output = net.activate((left, right, up, down))
-
-            # Decide on the direction to move
-            direction = ["up", "right", "down", "left"][output.index(max(output))]
-            snake.change_direction(direction)
-
-            # Move the snake
-            snake.move()
-
-            # Check for collisions
-            if snake.collide_with_wall() or snake.collide_with_self():
-                break
-
-            if snake.collide_with_food(food):
-                genome.fitness += 1.0
-                snake.body.append(snake.body[-1])
-                food = Food()
-
-            genome.fitness += 0.1
-
-        # Remove the genome if it fails to survive
-        genomes.remove((genome_id, genome))
-
-def run(config_file):
-    # Load the NEAT configuration
+from neat_checkpoint import add_run_reporters, start_population
+from neat_compile import CompiledNetworks
+from neat_parallel import ChunkedEvaluator
+from snake_engine import DEFAULT_SENSORS, DEFAULT_SHAPING, MAX_STEPS, SENSORS, STARVATION, SnakeGames, save_trace, sensor_size
+
+# Training is headless: the games run in snake_engine and nothing here imports pygame. snake_viewer.py draws a saved winner
+# or replays a recorded trace
+#   python neatsnake.py --seed 0 --checkpoint-dir checkpoints/snake --metrics-file runs/snake.jsonl --csv-file runs/snake.csv
+#   python neatsnake.py --checkpoint-dir checkpoints/snake --resume ...    (continues a crashed run)
+#   python neatsnake.py --trace-dir traces    (saves each generation's best game as a trace)
+#   python snake_viewer.py winner.pkl
+#   python snake_viewer.py traces/best.json --fps 30
+#   python neatsnake_bench.py --generations 30    (times generations against the original eval_genomes loop)
+
+# Every game stops after max_steps moves (MAX_STEPS by default), or after starvation moves without food (STARVATION),
+# so a generation takes bounded time
+# Plays one game per genome in the chunk, all stepped together. Each game is seeded by its genome's seed
+# With record, each game's trace is returned with its fitness
+def eval_chunk(chunk, config, sensors=DEFAULT_SENSORS, max_steps=MAX_STEPS, starvation=STARVATION, shaping=None, record=False):
+    nets = CompiledNetworks([genome for genome_id, genome, seed in chunk], config)
+    games = SnakeGames([seed for genome_id, genome, seed in chunk], max_steps=max_steps, starvation=starvation, sensors=sensors,
+                       record=record)
+
+    while games.active.size:
+        # Get the current state of every snake still playing
+        obs = games.observe()
+
+        # Run each of those snakes' networks in one call and pick the direction with the highest output (up, right, down, left).
+        # The networks are exact, so each move is the one neat's FeedForwardNetwork would pick
+        actions = nets.activate(obs, games.active).argmax(axis=1)
+
+        # Move the snakes. A snake that hits a wall or itself, runs out of moves or starves stops there
+        games.step(actions)
+
+    # By default 0.1 per move survived and 1 per food eaten, see snake_engine.DEFAULT_SHAPING
+    fitness = games.fitness(shaping)
+    if record:
+        return [(genome_id, float(f), trace) for (genome_id, genome, seed), f, trace in zip(chunk, fitness, games.traces())]
+    return [(genome_id, float(f)) for (genome_id, genome, seed), f in zip(chunk, fitness)]
+
+# Saves the trace of each generation's best game as trace_dir/generation_<n>.json, and the best game so far as trace_dir/best.json
+class TraceRecorder(neat.reporting.BaseReporter):
+    def __init__(self, evaluator, trace_dir):
+        self.evaluator = evaluator
+        self.trace_dir = trace_dir
+        self.generation = 0
+        self.best_fitness = None
+        os.makedirs(trace_dir, exist_ok=True)
+
+    def start_generation(self, generation):
+        self.generation = generation
+
+    def post_evaluate(self, config, population, species, best_genome):
+        trace = dict(self.evaluator.extras[best_genome.key], genome=best_genome.key, fitness=best_genome.fitness,
+                     generation=self.generation)
+        save_trace(trace, os.path.join(self.trace_dir, 'generation_%d.json' % self.generation))
+        if self.best_fitness is None or best_genome.fitness > self.best_fitness:
+            self.best_fitness = best_genome.fitness
+            save_trace(trace, os.path.join(self.trace_dir, 'best.json'))
+
+def load_config(config_file, sensors=DEFAULT_SENSORS):
     config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet, neat.DefaultStagnation, config_file)
+    # The network needs exactly one input per sensor value
+    if config.genome_config.num_inputs != sensor_size(sensors):
+        raise ValueError("%s has num_inputs = %d but the sensors %s give %d inputs" % (
+            config_file, config.genome_config.num_inputs, ', '.join(sensors), sensor_size(sensors)))
+    return config
+
+def run(config_file, generations=100, workers=1, seed=0, sensors=DEFAULT_SENSORS, max_steps=MAX_STEPS,
+        starvation=STARVATION, shaping=None, checkpoint_dir=None, checkpoint_every=5, resume=False,
+        metrics_file=None, csv_file=None, trace_dir=None):
+    # Load the NEAT configuration
+    config = load_config(config_file, sensors)
 
-    # Create the population and add a reporter
-    population = neat.Population(config)
+    # Create the population, or restore it from the last checkpoint, and add reporters
+    population, start_generation = start_population(config, checkpoint_dir, resume)
     population.add_reporter(neat.StdOutReporter(True))
     stats = neat.StatisticsReporter()
     population.add_reporter(stats)
 
-    # Run the simulation
-    winner = population.run(eval_genomes, 100)
+    # Run the simulation, evaluating the genomes in parallel. A resumed run carries on with the same genome seeds
+    evaluate = functools.partial(eval_chunk, sensors=tuple(sensors), max_steps=max_steps, starvation=starvation, shaping=shaping,
+                                 record=trace_dir is not None)
+    evaluator = ChunkedEvaluator(evaluate, num_workers=workers, seed=seed)
+    evaluator.generation = start_generation
+    logger = add_run_reporters(population, evaluator, checkpoint_dir, checkpoint_every, metrics_file, csv_file)
+    if trace_dir is not None:
+        population.add_reporter(TraceRecorder(evaluator, trace_dir))
+    try:
+        winner = population.run(evaluator.evaluate, max(1, generations - start_generation))
+    finally:
+        evaluator.close()
+        logger.close()
 
     # Save the winner's genome to a file
     with open("winner.pkl", "wb") as f:
@@ -136,7 +105,28 @@ def run(config_file):
 if __name__ == "__main__":
     # Set up the configuration file
     local_dir = os.path.dirname(__file__)
-    config_path = os.path.join(local_dir, "config-feedforward.txt")
+    parser = argparse.ArgumentParser(description="Evolve a Snake player with NEAT")
+    parser.add_argument('--config', default=os.path.join(local_dir, "config-feedforward.txt"))
+    parser.add_argument('--generations', type=int, default=100)
+    # One process steps the whole population in a single SnakeGames batch. Splitting it over processes leaves each engine a few
+    # games per tick, where the per-tick cost of the array ops outweighs the parallelism; only large populations gain from it
+    parser.add_argument('--workers', type=int, default=1, help="Evaluation processes, each stepping its share of the population")
+    parser.add_argument('--seed', type=int, default=0, help="Seeds every genome's games")
+    parser.add_argument('--sensors', nargs='+', choices=sorted(SENSORS), default=list(DEFAULT_SENSORS),
+                        help="Sensor groups; the config's num_inputs must match their total size")
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS, help="Moves per game")
+    parser.add_argument('--starvation', type=int, default=STARVATION, help="Moves allowed without eating")
+    for term, weight in DEFAULT_SHAPING.items():
+        parser.add_argument('--%s-weight' % term, type=float, default=weight, help="Fitness weight of the %s term" % term)
+    parser.add_argument('--checkpoint-dir', default=None, help="Save the population here every --checkpoint-every generations")
+    parser.add_argument('--checkpoint-every', type=int, default=5)
+    parser.add_argument('--resume', action='store_true', help="Continue from the newest checkpoint in --checkpoint-dir")
+    parser.add_argument('--metrics-file', default=None, help="Per-generation metrics as JSON lines")
+    parser.add_argument('--csv-file', default=None, help="Per-generation metrics as CSV")
+    parser.add_argument('--trace-dir', default=None, help="Record games and save each generation's best as a replayable trace")
+    args = parser.parse_args()
+    shaping = {term: getattr(args, '%s_weight' % term) for term in DEFAULT_SHAPING}
 
     # Run the simulation
-    run(config_path)
+    run(args.config, args.generations, args.workers, args.seed, args.sensors, args.max_steps, args.starvation, shaping,
+        args.checkpoint_dir, args.checkpoint_every, args.resume, args.metrics_file, args.csv_file, args.trace_dir)
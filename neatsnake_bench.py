@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of neatsnake.py generations: the original eval_genomes loop (one list-based snake and one
+# neat.nn.FeedForwardNetwork per genome, played one after another) against the evaluation neatsnake.py runs (every game in
+# one SnakeGames batch and every network in one CompiledNetworks, through ChunkedEvaluator with one worker). Both play one
+# game per genome with the same sensors, step limits and fitness terms, on different food positions.
+# How long a generation takes depends on how long its snakes survive, so the population is evolved for --generations and
+# every generation is timed both ways
+#   python neatsnake_bench.py --generations 30
+#   python neatsnake_bench.py --pop-size 500 --generations 10
+import argparse
+import functools
+import os
+import random
+import time
+
+import neat
+
+from neat_parallel import ChunkedEvaluator, genome_seed
+from neatsnake import eval_chunk, load_config
+from snake_engine import ACTIONS, DEFAULT_SENSORS, GRID_SIZE, MAX_STEPS, SENSORS, STARVATION, legacy_inputs
+
+MOVES = {'up': (0, -1), 'right': (1, 0), 'down': (0, 1), 'left': (-1, 0)}
+OPPOSITE = {'up': 'down', 'down': 'up', 'left': 'right', 'right': 'left'}
+
+
+# The original eval_genomes with the sensors and game limits of neatsnake.py. The original also removed each genome from
+# the list it was iterating over, which skipped every other genome; here every genome is played. Returns the moves made
+def legacy_eval_genomes(genomes, config, sensors=DEFAULT_SENSORS, max_steps=MAX_STEPS, starvation=STARVATION,
+                        grid_size=GRID_SIZE):
+    moves = 0
+    for genome_id, genome in genomes:
+        genome.fitness = 0.0
+        net = neat.nn.FeedForwardNetwork.create(genome, config)
+        body = [(grid_size // 2, grid_size // 2)]
+        direction = random.choice(ACTIONS)
+        food = (random.randint(0, grid_size - 1), random.randint(0, grid_size - 1))
+        steps = last_meal = 0
+        while True:
+            # Get the network's output and turn towards the highest one, unless that is straight back
+            output = net.activate(legacy_inputs(body, food, grid_size, sensors))
+            turn = ACTIONS[output.index(max(output))]
+            if turn != OPPOSITE[direction]:
+                direction = turn
+
+            # Move the snake and check for collisions
+            x, y = body[0]
+            dx, dy = MOVES[direction]
+            body.insert(0, (x + dx, y + dy))
+            body.pop()
+            x, y = body[0]
+            if x < 0 or x >= grid_size or y < 0 or y >= grid_size or body[0] in body[1:]:
+                break
+            steps += 1
+            if body[0] == food:
+                genome.fitness += 1.0
+                body.append(body[-1])
+                food = (random.randint(0, grid_size - 1), random.randint(0, grid_size - 1))
+                last_meal = steps
+            genome.fitness += 0.1
+            if steps >= max_steps or steps - last_meal >= starvation:
+                break
+        moves += steps
+    return moves
+
+
+if __name__ == "__main__":
+    local_dir = os.path.dirname(__file__)
+    parser = argparse.ArgumentParser(description="Time neatsnake.py generations against the original eval_genomes")
+    parser.add_argument('--config', default=os.path.join(local_dir, "config-feedforward.txt"))
+    parser.add_argument('--generations', type=int, default=30)
+    parser.add_argument('--pop-size', type=int, default=None, help="Override the config's pop_size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sensors', nargs='+', choices=sorted(SENSORS), default=list(DEFAULT_SENSORS),
+                        help="Sensor groups; the config's num_inputs must match their total size")
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS)
+    parser.add_argument('--starvation', type=int, default=STARVATION)
+    args = parser.parse_args()
+
+    config = load_config(args.config, args.sensors)
+    if args.pop_size:
+        config.pop_size = args.pop_size
+    random.seed(args.seed)
+    population = neat.Population(config)
+    evaluate = functools.partial(eval_chunk, sensors=tuple(args.sensors), max_steps=args.max_steps, starvation=args.starvation)
+    evaluator = ChunkedEvaluator(evaluate, num_workers=1, seed=args.seed, verbose=False)
+    totals = {'legacy': 0.0, 'engine': 0.0, 'legacy moves': 0, 'engine moves': 0}
+
+    print(f"{'gen':>4} {'genomes':>8} {'legacy ms':>10} {'moves':>8} {'engine ms':>10} {'moves':>8} {'speedup':>8}")
+
+    # Times the original loop on the generation's genomes, then neatsnake.py's evaluation, whose fitness the population
+    # evolves on. The engine's moves are counted from a second, untimed run of the same games with traces
+    def timed_generation(genomes, config):
+        generation = evaluator.generation
+        start = time.perf_counter()
+        legacy_moves = legacy_eval_genomes(genomes, config, args.sensors, args.max_steps, args.starvation)
+        legacy = time.perf_counter() - start
+        evaluator.evaluate(genomes, config)
+        chunk = [(genome_id, genome, genome_seed(args.seed, generation, genome_id)) for genome_id, genome in genomes]
+        engine_moves = sum(trace['steps'] for genome_id, fitness, trace in evaluate(chunk, config, record=True))
+        totals['legacy'] += legacy
+        totals['engine'] += evaluator.eval_time
+        totals['legacy moves'] += legacy_moves
+        totals['engine moves'] += engine_moves
+        print(f"{generation:>4} {len(genomes):>8} {legacy * 1e3:>10.1f} {legacy_moves:>8} {evaluator.eval_time * 1e3:>10.1f} "
+              f"{engine_moves:>8} {legacy / evaluator.eval_time:>7.1f}x", flush=True)
+
+    population.run(timed_generation, args.generations)
+    print(f"{'all':>4} {'':>8} {totals['legacy'] * 1e3:>10.1f} {totals['legacy moves']:>8} {totals['engine'] * 1e3:>10.1f} "
+          f"{totals['engine moves']:>8} {totals['legacy'] / totals['engine']:>7.1f}x")
@@ -0,0 +1,110 @@
+# Progress reporting from download threads to a Tk window (ytdownadaptive.py, YTdownload.py)
+# Download threads call update() as often as their library calls them back, which can be hundreds of times per second.
+# Updates are merged into the latest state per download under a lock; nothing is queued per callback. The Tk thread collects
+# the merged states at a fixed frame rate with pump(), so the window redraws at most fps times per second whatever the download
+# speed, and no Tk call is ever made from a worker thread.
+# Speed and ETA are worked out here from the byte counts, smoothed over recent updates, so every downloader gets them.
+#
+#   channel = ProgressChannel()
+#   channel.pump(root, apply, fps=15)                          # apply(key, state) runs on the Tk thread
+#   channel.update(key, downloaded=1234, total=5678)           # from any thread
+#   channel.update(key, status='done')
+import threading
+import time
+
+# Weight of the newest sample in the smoothed speed
+SPEED_SMOOTHING = 0.3
+
+
+class ProgressChannel:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._states = {}
+        self._rates = {}
+
+    # Merges fields into the download's state. downloaded/total are byte counts; speed (bytes/sec) and eta (sec) are added
+    # to the state whenever downloaded changes
+    def update(self, key, **fields):
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.setdefault(key, {})
+            state.update(fields)
+            if fields.get('downloaded') is not None:
+                self._update_rate(key, state, fields['downloaded'], now)
+            self._pending[key] = dict(state)
+
+    def _update_rate(self, key, state, downloaded, now):
+        last = self._rates.get(key)
+        if last is None:
+            self._rates[key] = (now, downloaded, None)
+            return
+        last_time, last_bytes, speed = last
+        elapsed = now - last_time
+        # Callbacks closer together than this say little about the rate; let the bytes accumulate until the next one
+        if elapsed < 0.2:
+            return
+        sample = max(0, downloaded - last_bytes) / elapsed
+        speed = sample if speed is None else SPEED_SMOOTHING * sample + (1 - SPEED_SMOOTHING) * speed
+        self._rates[key] = (now, downloaded, speed)
+        state['speed'] = speed
+        total = state.get('total')
+        state['eta'] = (total - downloaded) / speed if total and speed > 0 else None
+
+    # The states that changed since the last call, latest only
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def forget(self, key):
+        with self._lock:
+            self._states.pop(key, None)
+            self._rates.pop(key, None)
+            self._pending.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._rates.clear()
+            self._pending.clear()
+
+    # Calls apply(key, state) on the Tk thread for every changed download, fps times per second, and then on_frame() if given
+    def pump(self, root, apply, fps=15, on_frame=None):
+        interval = max(1, int(1000 / fps))
+
+        def frame():
+            for key, state in self.drain().items():
+                apply(key, state)
+            if on_frame is not None:
+                on_frame()
+            root.after(interval, frame)
+
+        root.after(interval, frame)
+
+
+def format_bytes(n):
+    if n is None:
+        return ''
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_speed(speed):
+    return f"{format_bytes(speed)}/s" if speed else ''
+
+
+def format_eta(eta):
+    if eta is None:
+        return ''
+    minutes, seconds = divmod(int(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+# Percentage done, or None when the total is unknown
+def percent(state):
+    total = state.get('total')
+    return 100.0 * state.get('downloaded', 0) / total if total else None
@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim import AdamW
 from torch.utils.data import DataLoader
+import torch.distributed as dist
+import time
 
 # Defining the SwiGLU activation function with learnable beta parameter
 # The rest of the SwiGLU implementation is in the TransformerEncoder class
@@ -14,6 +16,45 @@ from torch.utils.data import DataLoader
 def swiglu(x, y, beta):
     return x * F.sigmoid(beta * y)
 
+# Gating step of SwiGLU, up * sigmoid(beta * gate), as a custom autograd function
+# Autograd would otherwise keep beta * gate and its sigmoid alive until the backward pass. Here only gate and up are saved
+# (they are views of the fused projection output, which is kept anyway) and the sigmoid is recomputed in backward
+class SwiGLUGate(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, gate, up, beta):
+        ctx.save_for_backward(gate, up, beta)
+        return up * torch.sigmoid(beta * gate)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        gate, up, beta = ctx.saved_tensors
+        sig = torch.sigmoid(beta * gate)
+        grad_up = grad_out * sig
+        # d/dz sigmoid(z) = sigmoid(z) * (1 - sigmoid(z)), reusing sig in place once grad_up has been taken
+        grad_z = grad_out * up * sig.mul_(1 - sig)
+        grad_gate = grad_z * beta
+        grad_beta = (grad_z * gate).sum().reshape(beta.shape)
+        return grad_gate, grad_up, grad_beta
+
+# SwiGLU feed-forward block: one fused linear projects to both the gate and the up branch (2 * hidden_dim), the gate is applied,
+# and a final linear projects back down to dim. This replaces the earlier stacked Linear -> Linear -> slice, which doubled the FFN FLOPs
+class SwiGLU(nn.Module):
+    def __init__(self, dim, hidden_dim):
+        super().__init__()
+        self.hidden_dim = hidden_dim
+        self.gate_up = nn.Linear(dim, hidden_dim * 2)
+        self.down = nn.Linear(hidden_dim, dim)
+        self.beta = nn.Parameter(torch.ones(1))
+
+    def forward(self, x):
+        gate, up = self.gate_up(x).chunk(2, dim=-1)
+        if gate.requires_grad:
+            hidden = SwiGLUGate.apply(gate, up, self.beta)
+        else:
+            # Inference: nothing is saved for backward, so the gate is computed in place in the projection buffer
+            hidden = gate.mul_(self.beta).sigmoid_().mul_(up)
+        return self.down(hidden)
+
 # Defining the RMSNorm layer
 class RMSNorm(nn.Module):
     def __init__(self, dim, eps=1e-8):
@@ -43,14 +84,14 @@ class RotaryEmbedding(nn.Module):
 
     def forward(self, x):
         seq_len = x.shape[1]
-        t = torch.arange(seq_len).type_as(self.inv_freq)
+        t = torch.arange(seq_len, device=self.inv_freq.device).type_as(self.inv_freq)
         freqs = torch.einsum('i,j->ij', t, self.inv_freq)
         emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
         return emb[None, :, :]
 
 # Defining the Transformer Encoder layer
 class TransformerEncoder(nn.Module):
-    def __init__(self, dim, heads, mlp_dim):
+    def __init__(self, dim, heads, mlp_dim, compile_ffn=False):
         super().__init__()
         self.dim = dim
         self.heads = heads
@@ -61,34 +102,37 @@ class TransformerEncoder(nn.Module):
         self.norm2 = RMSNorm(dim)
 
         # Self-attention layer with rotary embeddings
-        self.attn = nn.MultiheadAttention(dim, heads)
-        self.rotary_emb = RotaryEmbedding(dim // 2)
-
-        # Feed-forward layer with SwiGLU activation
-        self.ffn = nn.Sequential(
-            nn.Linear(dim, mlp_dim * 4),
-            nn.Linear(mlp_dim * 4, mlp_dim * 4),
-            lambda x: swiglu(x[:, :, :mlp_dim * 2], x[:, :, mlp_dim * 2:], self.beta),
-            nn.Linear(mlp_dim * 2, dim),
-        )
-        self.beta = nn.Parameter(torch.ones(1))
+        # batch_first=True because the embeddings are laid out as [batch, seq, dim]
+        self.attn = nn.MultiheadAttention(dim, heads, batch_first=True)
+        # The positional embedding is added to x, so it has to span the full model dimension
+        self.rotary_emb = RotaryEmbedding(dim)
+
+        # Feed-forward layer with SwiGLU activation, gated at mlp_dim * 2 like the original block, so its capacity is unchanged
+        self.ffn = SwiGLU(dim, mlp_dim * 2)
+        # Optionally compile the block with torch.compile so the gate is fused with the surrounding ops
+        # The compiled forward is kept as a plain attribute so it shares the parameters of self.ffn without registering them twice
+        self.compiled_ffn = torch.compile(self.ffn.forward) if compile_ffn else None
 
     def forward(self, x):
         # Adding rotary embeddings to the input
         pos_emb = self.rotary_emb(x)
         x = x + pos_emb
 
-        # Applying pre-normalization and self-attention
-        x = x + self.attn(self.norm1(x), self.norm1(x), self.norm1(x))[0]
+        # Applying pre-normalization and causal self-attention, so each token only attends to the tokens before it
+        seq_len = x.shape[1]
+        causal_mask = torch.triu(torch.ones(seq_len, seq_len, dtype=torch.bool, device=x.device), diagonal=1)
+        h = self.norm1(x)
+        x = x + self.attn(h, h, h, attn_mask=causal_mask, need_weights=False)[0]
 
         # Applying pre-normalization and feed-forward
-        x = x + self.ffn(self.norm2(x))
+        ffn = self.compiled_ffn or self.ffn
+        x = x + ffn(self.norm2(x))
 
         return x
 
 # Defining the Transformer Encoder module
 class Transformer(nn.Module):
-    def __init__(self, vocab_size, dim, depth, heads, mlp_dim):
+    def __init__(self, vocab_size, dim, depth, heads, mlp_dim, compile_ffn=False):
         super().__init__()
         self.vocab_size = vocab_size
         self.dim = dim
@@ -100,7 +144,10 @@ class Transformer(nn.Module):
         # Encoder layers
         self.layers = nn.ModuleList([])
         for _ in range(depth):
-            self.layers.append(TransformerEncoder(dim, heads, mlp_dim))
+            self.layers.append(TransformerEncoder(dim, heads, mlp_dim, compile_ffn=compile_ffn))
+
+        # Output head projecting the hidden states back to vocabulary logits for next-token prediction
+        self.lm_head = nn.Linear(dim, vocab_size, bias=False)
 
     def forward(self, x):
         # Getting the token embeddings
@@ -110,7 +157,7 @@ class Transformer(nn.Module):
         for layer in self.layers:
             x = layer(x)
 
-        return x
+        return self.lm_head(x)
 
 # Defining the model hyperparameters based on Table 2 in the document
 vocab_size = 50257 # GPT-2 vocabulary size
@@ -119,65 +166,188 @@ depth = 32 # Number of encoder layers for LLaMA-7B model
 heads = 32 # Number of attention heads for LLaMA-7B model
 mlp_dim = 10240 # Feed-forward dimension for LLaMA-7B model
 
-# Creating the model instance
-model = Transformer(vocab_size, dim, depth, heads, mlp_dim)
-
-# params, dimension, n heads, n layers, learning rate, batch size, n tokens
-# 6.7B 4096 32 32 3.0e−4 4M 1.0T
-# 13.0B 5120 40 40 3.0e−4 4M 1.0T
-# 32.5B 6656 52 60 1.5e−4 4M 1.4T
-# 65.2B 8192 64 80 1.5e−4 4M 1.4T
-
 # Defining the optimizer hyperparameters
 lr = 0.0006 # Learning rate for LLaMA-7B model
 wd = 0.1 # Weight decay
 gc = 1.0 # Gradient clipping
 bs = 4096 # Batch size for LLaMA-7B model
 
-# Creating the optimizer instance
-optimizer = AdamW(model.parameters(), lr=lr, weight_decay=wd)
-
-# Defining the learning rate scheduler
-scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=bs, eta_min=lr * 0.1)
-
 # Defining the device (attmepting to use GPU if available)
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# Waits for queued GPU work so the wall-clock phase timings are accurate. Only used when sync_timing is requested, since it stalls the pipeline
+def _sync(device, enabled):
+    if enabled and device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
 # Defining the training loop
-def train(model, optimizer, scheduler, dataloader, epochs):
+# sampler is the DistributedSampler when running under torch.distributed, so it can be reshuffled every epoch
+# is_main controls logging, so only rank 0 prints when several processes train together
+# on_epoch_end(epoch, avg_loss) is called after every epoch, e.g. to write a checkpoint
+# metrics is an optional MetricsLogger (metrics_logger.py). Every log_interval steps it receives tokens/sec, the step time split into
+# data/forward/backward/optimizer, loss, grad norm and learning rate
+# Loss and grad norm are accumulated on the device and only copied to the host at logging intervals, since .item() forces a sync every step
+# On CUDA the phase times only measure the host side unless sync_timing=True
+# profile_steps=(start, count) records a torch.profiler trace of count steps after skipping start steps, written to profile_dir for TensorBoard
+# start_epoch skips the epochs a resumed run has already trained
+def train(model, optimizer, scheduler, dataloader, epochs, device=device, sampler=None, is_main=True, on_epoch_end=None,
+          metrics=None, log_interval=50, sync_timing=False, profile_steps=None, profile_dir='profile', start_epoch=0):
     # Setting the model to training mode
     model.train()
 
+    profiler = None
+    if profile_steps is not None and is_main:
+        start, count = profile_steps
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=1 if start > 0 else 0, active=count, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(profile_dir),
+        )
+        profiler.start()
+
+    step = 0
+
     # Looping over the epochs
-    for epoch in range(epochs):
-        # Initializing the epoch loss
-        epoch_loss = 0
+    for epoch in range(start_epoch, epochs):
+        # Each epoch needs a different shuffle across the ranks
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+
+        # Initializing the epoch loss on the device
+        epoch_loss = torch.zeros((), device=device)
+
+        # Real and padded token counts for the epoch. Batches from bucket_sampler.collate_lm carry the real count,
+        # otherwise every position is assumed to be a real token
+        epoch_tokens = 0
+        epoch_padded = 0
+        epoch_start = time.perf_counter()
+
+        # Running totals for the current logging window
+        window_loss = torch.zeros((), device=device)
+        window_grad_norm = torch.zeros((), device=device)
+        window_steps = 0
+        window_tokens = 0
+        phase_times = {'data': 0.0, 'forward': 0.0, 'backward': 0.0, 'optimizer': 0.0}
+        window_start = time.perf_counter()
 
         # Looping over the batches
+        t0 = time.perf_counter()
         for batch in dataloader:
             # Getting the input and target tokens
             input_ids = batch['input_ids']
             target_ids = batch['target_ids']
 
             # Moving the tensors to the device
-            input_ids = input_ids.to(device)
-            target_ids = target_ids.to(device)
+            input_ids = input_ids.to(device, non_blocking=True)
+            target_ids = target_ids.to(device, non_blocking=True)
+            _sync(device, sync_timing)
+            t1 = time.perf_counter()
 
             # Forward pass through the model
             output = model(input_ids)
 
             # Calculating the loss
-            loss = F.cross_entropy(output.view(-1, vocab_size), target_ids.view(-1))
+            loss = F.cross_entropy(output.view(-1, output.size(-1)), target_ids.view(-1))
+            _sync(device, sync_timing)
+            t2 = time.perf_counter()
 
             # Backward pass and optimization
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
-            nn.utils.clip_grad_norm_(model.parameters(), gc)
+            _sync(device, sync_timing)
+            t3 = time.perf_counter()
+            # An FSDP model only holds its shard of each gradient, so the norm has to come from its own clip_grad_norm_, which
+            # reduces across the ranks; clipping the local shard would scale each rank's gradients by a different factor
+            if hasattr(model, 'clip_grad_norm_'):
+                grad_norm = model.clip_grad_norm_(gc)
+            else:
+                grad_norm = nn.utils.clip_grad_norm_(model.parameters(), gc)
             optimizer.step()
             scheduler.step()
-
-            # Updating the epoch loss
-            epoch_loss += loss.item()
+            _sync(device, sync_timing)
+            t4 = time.perf_counter()
+
+            # Updating the running totals without leaving the device
+            loss = loss.detach()
+            epoch_loss += loss
+            window_loss += loss
+            window_grad_norm += grad_norm.detach()
+            window_steps += 1
+            window_tokens += input_ids.numel()
+            epoch_tokens += batch.get('num_tokens', input_ids.numel())
+            epoch_padded += input_ids.numel()
+            phase_times['data'] += t1 - t0
+            phase_times['forward'] += t2 - t1
+            phase_times['backward'] += t3 - t2
+            phase_times['optimizer'] += t4 - t3
+            step += 1
+
+            if profiler is not None:
+                profiler.step()
+
+            # Synchronising only at the logging interval
+            if metrics is not None and is_main and step % log_interval == 0:
+                elapsed = time.perf_counter() - window_start
+                record = {
+                    'epoch': epoch + 1,
+                    'loss': window_loss.item() / window_steps,
+                    'grad_norm': window_grad_norm.item() / window_steps,
+                    'lr': scheduler.get_last_lr()[0],
+                    'tokens_per_sec': window_tokens / elapsed,
+                    'step_time': elapsed / window_steps,
+                }
+                for phase, total in phase_times.items():
+                    record[phase + '_time'] = total / window_steps
+                metrics.log(step, record, prefix='train/')
+
+                window_loss.zero_()
+                window_grad_norm.zero_()
+                window_steps = 0
+                window_tokens = 0
+                phase_times = dict.fromkeys(phase_times, 0.0)
+                window_start = time.perf_counter()
+
+            t0 = time.perf_counter()
+
+        # Averaging the epoch loss, over all ranks when training is distributed
+        avg_loss = epoch_loss / len(dataloader)
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(avg_loss)
+            avg_loss = avg_loss / dist.get_world_size()
+        avg_loss = avg_loss.item()
+
+        epoch_time = time.perf_counter() - epoch_start
+        padding_ratio = 1.0 - epoch_tokens / epoch_padded if epoch_padded else 0.0
+        effective_tps = epoch_tokens / epoch_time
 
         # Printing the average epoch loss
-        print(f'Epoch {epoch + 1}, Loss: {epoch_loss / len(dataloader)}')
\ No newline at end of file
+        if is_main:
+            print(f'Epoch {epoch + 1}, Loss: {avg_loss}, Padding: {padding_ratio:.1%}, Effective tokens/sec: {effective_tps:.1f}')
+            if metrics is not None:
+                metrics.log(step, {'epoch': epoch + 1, 'epoch_loss': avg_loss, 'padding_ratio': padding_ratio,
+                                   'effective_tokens_per_sec': effective_tps}, prefix='train/')
+
+        if on_epoch_end is not None:
+            on_epoch_end(epoch, avg_loss)
+
+    if profiler is not None:
+        profiler.stop()
+
+if __name__ == "__main__":
+    # Creating the model instance. This is kept out of module import so other scripts (e.g. pseudollama_ddp.py) can reuse the classes without building a 7B model
+    model = Transformer(vocab_size, dim, depth, heads, mlp_dim)
+
+    # params, dimension, n heads, n layers, learning rate, batch size, n tokens
+    # 6.7B 4096 32 32 3.0e−4 4M 1.0T
+    # 13.0B 5120 40 40 3.0e−4 4M 1.0T
+    # 32.5B 6656 52 60 1.5e−4 4M 1.4T
+    # 65.2B 8192 64 80 1.5e−4 4M 1.4T
+
+    # Creating the optimizer instance
+    optimizer = AdamW(model.parameters(), lr=lr, weight_decay=wd)
+
+    # Defining the learning rate scheduler
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=bs, eta_min=lr * 0.1)
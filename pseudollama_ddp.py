@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# Distributed data-parallel training for the pseudollama Transformer
+# Runs pseudollama.train() under torch.distributed with the gloo backend, so it works with plain CPU processes on one machine or across several nodes
+# Each process holds a replica (DDP) or a shard (FSDP) of the model and trains on its own slice of the token dataset
+#
+# Single machine, 4 CPU processes:
+#   python pseudollama_ddp.py --nproc-per-node 4
+# Scaling report (1 process vs 4 processes with the same threads per process):
+#   python pseudollama_ddp.py --nproc-per-node 4 --scaling
+# Two nodes, 4 processes each (run on every node with its own --node-rank):
+#   python pseudollama_ddp.py --nnodes 2 --node-rank 0 --nproc-per-node 4 --master-addr 10.0.0.1
+# torchrun also works, since the rank and world size are then read from the environment:
+#   torchrun --nproc-per-node 4 pseudollama_ddp.py
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.optim import AdamW
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+
+import pseudollama
+from metrics_logger import MetricsLogger
+from pseudollama import Transformer
+
+
+# Token dataset of fixed-length windows. Reads a flat token file (uint16/int32 .npy) through a memory map,
+# or generates a reproducible random corpus when no file is given so the script can be tested without data
+class TokenDataset(Dataset):
+    def __init__(self, seq_len, vocab_size, path=None, num_samples=1024, seed=0):
+        self.seq_len = seq_len
+        if path is not None:
+            self.tokens = np.load(path, mmap_mode='r')
+        else:
+            rng = np.random.default_rng(seed)
+            self.tokens = rng.integers(0, vocab_size, size=num_samples * seq_len + 1, dtype=np.int64)
+        # Each sample needs seq_len inputs plus one extra token for the shifted target
+        self.num_samples = (len(self.tokens) - 1) // seq_len
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        start = idx * self.seq_len
+        window = torch.from_numpy(np.asarray(self.tokens[start:start + self.seq_len + 1], dtype=np.int64))
+        return {'input_ids': window[:-1], 'target_ids': window[1:]}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Distributed CPU training for pseudollama")
+    # Process layout
+    parser.add_argument('--nproc-per-node', type=int, default=2, help="Processes launched on this node")
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node-rank', type=int, default=0)
+    parser.add_argument('--master-addr', default='127.0.0.1')
+    parser.add_argument('--master-port', type=int, default=29500)
+    parser.add_argument('--threads-per-proc', type=int, default=None,
+                        help="torch threads per process, defaults to the cores divided by --nproc-per-node")
+    parser.add_argument('--wrap', choices=['ddp', 'fsdp'], default='ddp', help="Model wrapper")
+    # Model size, small by default so it runs on a laptop. Use the values in pseudollama.py for the full 7B model
+    parser.add_argument('--vocab-size', type=int, default=1024)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--mlp-dim', type=int, default=256)
+    # Data and optimisation
+    parser.add_argument('--data', default=None, help="Token file (.npy). Random tokens are used if omitted")
+    parser.add_argument('--num-samples', type=int, default=512, help="Samples in the random corpus")
+    parser.add_argument('--seq-len', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=8, help="Per-process batch size")
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--lr', type=float, default=pseudollama.lr)
+    parser.add_argument('--seed', type=int, default=0)
+    # Outputs
+    parser.add_argument('--checkpoint', default=None, help="Checkpoint path written by rank 0 after every epoch")
+    parser.add_argument('--resume', action='store_true', help="Continue from --checkpoint if it exists")
+    parser.add_argument('--metrics-file', default=None, help="JSONL file for step metrics (rank 0 only)")
+    parser.add_argument('--tensorboard-dir', default=None, help="TensorBoard log directory for step metrics")
+    parser.add_argument('--log-interval', type=int, default=10, help="Steps between metric logs")
+    parser.add_argument('--profile-steps', type=int, nargs=2, metavar=('START', 'COUNT'), default=None,
+                        help="Record a torch.profiler trace of COUNT steps starting at step START")
+    parser.add_argument('--profile-dir', default='profile')
+    parser.add_argument('--scaling', action='store_true',
+                        help="Run once with 1 process and once with --nproc-per-node processes and report scaling efficiency")
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def wrap_model(model, wrap):
+    if wrap == 'fsdp':
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+        # Each pseudollama encoder layer becomes its own FSDP unit so only one layer is gathered at a time
+        from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+        # device_id pins FSDP to the CPU; without it recent releases look for an accelerator and refuse to start
+        return FSDP(model, auto_wrap_policy=ModuleWrapPolicy({pseudollama.TransformerEncoder}), device_id=torch.device('cpu'))
+    return DDP(model)
+
+
+# The state dicts have to be collected on every rank for FSDP, but only rank 0 writes them. For FSDP the optimizer state is
+# gathered from the shards too, so a resumed run continues with the same AdamW moments
+def save_checkpoint(model, optimizer, scheduler, epoch, loss, path, wrap, is_main):
+    if wrap == 'fsdp':
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+        from torch.distributed.fsdp import FullOptimStateDictConfig, FullStateDictConfig, StateDictType
+        with FSDP.state_dict_type(model, StateDictType.FULL_STATE_DICT,
+                                  FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+                                  FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True)):
+            state = model.state_dict()
+            optim_state = FSDP.optim_state_dict(model, optimizer)
+    else:
+        state = model.module.state_dict()
+        optim_state = optimizer.state_dict()
+
+    if is_main:
+        # Write to a temporary file first so an interrupted save never leaves a half-written checkpoint
+        tmp_path = path + '.tmp'
+        torch.save({'epoch': epoch + 1, 'loss': loss, 'model': state, 'optimizer': optim_state,
+                    'scheduler': scheduler.state_dict()}, tmp_path)
+        os.replace(tmp_path, path)
+        print(f'Checkpoint saved to {path}')
+
+
+# Restores the weights, optimizer and scheduler on every rank and returns the number of epochs already trained.
+# Every rank reads the file, so on several nodes it has to be on a shared filesystem
+def load_checkpoint(model, optimizer, scheduler, path, wrap):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if wrap == 'fsdp':
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+        from torch.distributed.fsdp import FullOptimStateDictConfig, FullStateDictConfig, StateDictType
+        with FSDP.state_dict_type(model, StateDictType.FULL_STATE_DICT,
+                                  FullStateDictConfig(rank0_only=False), FullOptimStateDictConfig(rank0_only=False)):
+            model.load_state_dict(checkpoint['model'])
+            # Each rank keeps only its shard of the full optimizer state
+            optimizer.load_state_dict(FSDP.optim_state_dict_to_load(model, optimizer, checkpoint['optimizer']))
+    else:
+        model.module.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if checkpoint.get('scheduler') is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    return checkpoint['epoch']
+
+
+def worker(local_rank, args, world_size):
+    # torchrun sets RANK and WORLD_SIZE itself, otherwise the rank is derived from the node layout
+    if local_rank is None:
+        rank = int(os.environ['RANK'])
+        world_size = int(os.environ['WORLD_SIZE'])
+        dist.init_process_group('gloo')
+    else:
+        rank = args.node_rank * args.nproc_per_node + local_rank
+        dist.init_process_group('gloo', init_method=f'tcp://{args.master_addr}:{args.master_port}',
+                                rank=rank, world_size=world_size)
+    is_main = rank == 0
+
+    threads = args.threads_per_proc or max(1, (os.cpu_count() or 1) // args.nproc_per_node)
+    torch.set_num_threads(threads)
+
+    # Identical seeds so every replica starts from the same weights
+    torch.manual_seed(args.seed)
+    model = Transformer(args.vocab_size, args.dim, args.depth, args.heads, args.mlp_dim)
+    model = wrap_model(model, args.wrap)
+
+    # The optimizer has to be created after wrapping, since FSDP replaces the parameters with flat shards
+    optimizer = AdamW(model.parameters(), lr=args.lr, weight_decay=pseudollama.wd)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=pseudollama.bs, eta_min=args.lr * 0.1)
+
+    dataset = TokenDataset(args.seq_len, args.vocab_size, path=args.data,
+                           num_samples=args.num_samples, seed=args.seed)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, drop_last=True)
+
+    start_epoch = 0
+    if args.checkpoint and args.resume and os.path.exists(args.checkpoint):
+        start_epoch = load_checkpoint(model, optimizer, scheduler, args.checkpoint, args.wrap)
+        if is_main:
+            print(f'Resumed from {args.checkpoint} at epoch {start_epoch}')
+
+    on_epoch_end = None
+    if args.checkpoint:
+        def on_epoch_end(epoch, loss):
+            save_checkpoint(model, optimizer, scheduler, epoch, loss, args.checkpoint, args.wrap, is_main)
+
+    if is_main:
+        print(f'Training with {world_size} process(es), {threads} thread(s) each, wrapper={args.wrap}')
+
+    metrics = None
+    if is_main and (args.metrics_file or args.tensorboard_dir):
+        metrics = MetricsLogger(args.metrics_file, args.tensorboard_dir)
+
+    dist.barrier()
+    start = time.perf_counter()
+    pseudollama.train(model, optimizer, scheduler, dataloader, args.epochs, device=torch.device('cpu'),
+                      sampler=sampler, is_main=is_main, on_epoch_end=on_epoch_end,
+                      metrics=metrics, log_interval=args.log_interval,
+                      profile_steps=args.profile_steps, profile_dir=args.profile_dir, start_epoch=start_epoch)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if metrics is not None:
+        metrics.close()
+
+    # Every rank processes the same number of batches, so the global token count is the local count times the world size
+    tokens = len(dataloader) * args.batch_size * args.seq_len * max(0, args.epochs - start_epoch) * world_size
+    if is_main:
+        result = {'world_size': world_size, 'threads_per_proc': threads, 'wrap': args.wrap,
+                  'seconds': elapsed, 'tokens': tokens, 'tokens_per_sec': tokens / elapsed}
+        print(f"{tokens} tokens in {elapsed:.2f}s, {result['tokens_per_sec']:.1f} tokens/sec")
+        if args.result_file:
+            with open(args.result_file, 'w') as f:
+                json.dump(result, f)
+
+    dist.destroy_process_group()
+
+
+def launch(args, nproc):
+    world_size = nproc * args.nnodes
+    mp.spawn(worker, args=(args, world_size), nprocs=nproc, join=True)
+
+
+def run_scaling(args):
+    # Both runs use the same threads per process so the comparison measures how well the extra processes scale,
+    # rather than one process getting all the cores
+    args.threads_per_proc = args.threads_per_proc or max(1, (os.cpu_count() or 1) // args.nproc_per_node)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for nproc in (1, args.nproc_per_node):
+            run_args = argparse.Namespace(**vars(args))
+            run_args.nproc_per_node = nproc
+            run_args.nnodes = 1
+            run_args.result_file = os.path.join(tmp, f'result_{nproc}.json')
+            # A fresh port for each run avoids clashes with the socket of the previous group
+            run_args.master_port = args.master_port + nproc
+            launch(run_args, nproc)
+            with open(run_args.result_file) as f:
+                results[nproc] = json.load(f)
+
+    base = results[1]['tokens_per_sec']
+    scaled = results[args.nproc_per_node]['tokens_per_sec']
+    speedup = scaled / base
+    efficiency = speedup / args.nproc_per_node
+    print()
+    print(f"{'processes':>10} {'tokens/sec':>12} {'speedup':>8} {'efficiency':>10}")
+    print(f"{1:>10} {base:>12.1f} {1.0:>8.2f} {1.0:>10.1%}")
+    print(f"{args.nproc_per_node:>10} {scaled:>12.1f} {speedup:>8.2f} {efficiency:>10.1%}")
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # Launched by torchrun, which already started one copy of this script per rank
+        worker(None, args, None)
+    elif args.scaling:
+        run_scaling(args)
+    else:
+        launch(args, args.nproc_per_node)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the pseudollama feed-forward block
+# Compares the original FFN (Linear -> Linear -> slice -> swiglu -> Linear) against the fused SwiGLU module,
+# measuring forward, forward+backward time and the activation memory saved for the backward pass
+#   python pseudollama_ffn_bench.py --dim 1024 --mlp-dim 2560 --batch 4 --seq 256
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from pseudollama import SwiGLU, swiglu
+
+
+# The feed-forward block as it was originally written in pseudollama.py
+class LegacyFFN(nn.Module):
+    def __init__(self, dim, mlp_dim):
+        super().__init__()
+        self.mlp_dim = mlp_dim
+        self.fc1 = nn.Linear(dim, mlp_dim * 4)
+        self.fc2 = nn.Linear(mlp_dim * 4, mlp_dim * 4)
+        self.fc3 = nn.Linear(mlp_dim * 2, dim)
+        self.beta = nn.Parameter(torch.ones(1))
+
+    def forward(self, x):
+        x = self.fc2(self.fc1(x))
+        x = swiglu(x[:, :, :self.mlp_dim * 2], x[:, :, self.mlp_dim * 2:], self.beta)
+        return self.fc3(x)
+
+
+# Adds up the bytes of every distinct storage autograd keeps for the backward pass, i.e. the activation memory of one forward
+def saved_activation_bytes(block, x):
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = block(x)
+    # Parameters are not activations, so their storages are taken back out
+    for p in block.parameters():
+        storages.pop(p.untyped_storage().data_ptr(), None)
+    storages.pop(x.untyped_storage().data_ptr(), None)
+    del out
+    return sum(storages.values())
+
+
+def time_it(fn, iters, warmup=3):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters
+
+
+def bench(name, block, x, iters):
+    def forward():
+        with torch.no_grad():
+            block(x)
+
+    def train_step():
+        block.zero_grad(set_to_none=True)
+        block(x).sum().backward()
+
+    fwd = time_it(forward, iters)
+    fwd_bwd = time_it(train_step, iters)
+    mem = saved_activation_bytes(block, x)
+    params = sum(p.numel() for p in block.parameters())
+    print(f"{name:<16} {params / 1e6:>9.2f}M {fwd * 1e3:>10.2f} {fwd_bwd * 1e3:>12.2f} {mem / 2**20:>12.1f}")
+    return fwd, fwd_bwd, mem
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pseudollama FFN block")
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--mlp-dim', type=int, default=1280)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--seq', type=int, default=128)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--compile', action='store_true', help="Also benchmark the torch.compile'd SwiGLU block")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    x = torch.randn(args.batch, args.seq, args.dim, requires_grad=True)
+
+    print(f"{'block':<16} {'params':>10} {'fwd ms':>10} {'fwd+bwd ms':>12} {'act MiB':>12}")
+    legacy = bench('legacy', LegacyFFN(args.dim, args.mlp_dim), x, args.iters)
+    # Same gated width as LegacyFFN (mlp_dim * 2), as TransformerEncoder builds it, so only the fused projection differs
+    fused_block = SwiGLU(args.dim, args.mlp_dim * 2)
+    fused = bench('swiglu', fused_block, x, args.iters)
+    if args.compile:
+        compiled_block = SwiGLU(args.dim, args.mlp_dim * 2)
+        compiled_block.forward = torch.compile(compiled_block.forward)
+        bench('swiglu+compile', compiled_block, x, args.iters)
+
+    print()
+    print(f"forward speedup {legacy[0] / fused[0]:.2f}x, train step speedup {legacy[1] / fused[1]:.2f}x, "
+          f"activation memory {legacy[2] / max(fused[2], 1):.2f}x smaller")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Load-test client for pseudollama_server.py
+# Opens --concurrency connections that each send requests back to back (closed loop), or with --rate sends requests
+# with Poisson arrivals (open loop), then reports queue time, time to first token, latency and throughput
+#   python pseudollama_loadtest.py --requests 64 --concurrency 16 --prompt-len 32 --max-new-tokens 64
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+
+async def send_request(host, port, prompt, max_new_tokens):
+    reader, writer = await asyncio.open_connection(host, port)
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    writer.write((json.dumps({'prompt': prompt, 'max_new_tokens': max_new_tokens}) + '\n').encode())
+    await writer.drain()
+    result = None
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        event = json.loads(line)
+        if 'error' in event:
+            result = {'error': event['error']}
+            break
+        if 'token' in event:
+            tokens += 1
+            if first_token is None:
+                first_token = time.perf_counter()
+        if event.get('done'):
+            # Queue time comes from the server; time to first token and latency are measured by the client
+            result = {'tokens': tokens, 'queue_time': event['queue_time'],
+                      'ttft': first_token - start, 'latency': time.perf_counter() - start}
+            break
+    writer.close()
+    return result
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    prompts = [[rng.randrange(args.vocab_size) for _ in range(rng.randint(max(1, args.prompt_len // 2), args.prompt_len))]
+               for _ in range(args.requests)]
+    results = []
+    start = time.perf_counter()
+
+    if args.rate:
+        # Open loop: requests arrive independently of how fast the server answers
+        tasks = []
+        for prompt in prompts:
+            tasks.append(asyncio.create_task(send_request(args.host, args.port, prompt, args.max_new_tokens)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        results = await asyncio.gather(*tasks)
+    else:
+        queue = list(prompts)
+
+        async def client():
+            while queue:
+                prompt = queue.pop()
+                results.append(await send_request(args.host, args.port, prompt, args.max_new_tokens))
+
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+
+    elapsed = time.perf_counter() - start
+    ok = [r for r in results if r and 'error' not in r]
+    errors = len(results) - len(ok)
+    total_tokens = sum(r['tokens'] for r in ok)
+
+    print(f"{len(ok)} requests ({errors} errors) in {elapsed:.2f}s")
+    print(f"throughput: {total_tokens / elapsed:.1f} tokens/s, {len(ok) / elapsed:.2f} requests/s")
+    for name in ('queue_time', 'ttft', 'latency'):
+        values = [r[name] for r in ok]
+        if values:
+            print(f"{name:>10}: mean {statistics.mean(values) * 1e3:8.1f} ms  p50 {percentile(values, 0.5) * 1e3:8.1f} ms  "
+                  f"p95 {percentile(values, 0.95) * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the pseudollama inference server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=8, help="Parallel connections in closed-loop mode")
+    parser.add_argument('--rate', type=float, default=None, help="Requests per second for open-loop Poisson arrivals")
+    parser.add_argument('--prompt-len', type=int, default=32, help="Maximum prompt length, prompts vary from half of it up to it")
+    parser.add_argument('--max-new-tokens', type=int, default=32)
+    parser.add_argument('--vocab-size', type=int, default=8192)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# Post-training quantisation for the pseudollama Transformer
+# Linear, attention and embedding weights are stored as int8 with one scale per output channel, or as int4 with one scale per
+# group of input columns (two int4 values packed per byte). No calibration data is needed
+# On CPU the matmuls run through PyTorch's dynamic-quantisation int8 GEMM (fbgemm/x86, or qnnpack on ARM): the weights are
+# packed once on first use and each call quantises its activations to uint8 on the fly. int4 weights are converted to int8
+# per-channel for this, so an int4 model is int4 on disk but the size of the int8 model in memory once it has run.
+# Where no quantised engine is available the weights are dequantised on every call, which saves memory but not time
+#
+# Compare fp32 against int8 and int4 on a small model with random weights:
+#   python pseudollama_quant.py --dim 512 --depth 4 --heads 8 --mlp-dim 1280
+# Quantise a trained checkpoint (as written by pseudollama_ddp.py) and save it:
+#   python pseudollama_quant.py --checkpoint ckpt.pt --bits 8 --save model_int8.pt
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from pseudollama import Transformer
+
+
+# Symmetric int8 quantisation with one scale per output row
+def quantize_int8(weight):
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scales.float()
+
+
+# Symmetric int4 quantisation with one scale per group_size input columns of each row. Values are shifted to 0..15 and packed two per byte
+def quantize_int4(weight, group_size):
+    out_features, in_features = weight.shape
+    if in_features % group_size or group_size % 2:
+        raise ValueError(f"in_features ({in_features}) must be a multiple of an even group_size ({group_size})")
+    grouped = weight.reshape(out_features, in_features // group_size, group_size)
+    scales = grouped.abs().amax(dim=2).clamp(min=1e-8) / 7.0
+    q = torch.round(grouped / scales[:, :, None]).clamp(-8, 7).to(torch.int16) + 8
+    q = q.reshape(out_features, in_features).to(torch.uint8)
+    packed = q[:, 0::2] | (q[:, 1::2] << 4)
+    return packed, scales.float()
+
+
+def dequantize_int4(packed, scales, group_size):
+    low = (packed & 0x0F).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    q = torch.stack((low, high), dim=-1).reshape(packed.shape[0], -1)
+    out_features, in_features = q.shape
+    grouped = q.reshape(out_features, in_features // group_size, group_size).to(scales.dtype)
+    return (grouped * scales[:, :, None]).reshape(out_features, in_features)
+
+
+# Per-channel int8 weight q [out, in] with scales [out] prepacked for torch.ops.quantized.linear_dynamic, or None where
+# PyTorch has no quantised engine for this CPU
+def pack_int8(q, scales, bias):
+    if torch.backends.quantized.engine == 'none':
+        return None
+    try:
+        weight = torch._make_per_channel_quantized_tensor(q, scales.double(), torch.zeros_like(scales, dtype=torch.long), 0)
+        return torch.ops.quantized.linear_prepack(weight, bias)
+    except RuntimeError:
+        return None
+
+
+# Linear layer with quantised weights used at inference
+class QuantLinear(nn.Module):
+    def __init__(self, weight, bias, bits=8, group_size=128):
+        super().__init__()
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+        self.bits = bits
+        self.group_size = group_size
+        # Weights packed for the int8 GEMM: None until the first CPU call, False if they cannot be packed on this machine
+        self._packed = None
+        weight = weight.detach().float()
+        if bits == 8:
+            q, scales = quantize_int8(weight)
+        elif bits == 4:
+            q, scales = quantize_int4(weight, group_size)
+        else:
+            raise ValueError(f"Unsupported bit width: {bits}")
+        self.register_buffer('weight_q', q)
+        self.register_buffer('scales', scales)
+        self.register_buffer('bias', None if bias is None else bias.detach().float().clone())
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=128):
+        return cls(linear.weight, linear.bias, bits, group_size)
+
+    # The packed weights are a cache, so saved models keep only the portable int8/int4 buffers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_packed'] = None
+        return state
+
+    def _pack(self):
+        if self.bits == 8:
+            q, scales = self.weight_q, self.scales
+        else:
+            # The int4 values with their group scales, requantised to one int8 scale per row
+            q, scales = quantize_int8(dequantize_int4(self.weight_q, self.scales, self.group_size))
+        return pack_int8(q, scales, self.bias)
+
+    def forward(self, x):
+        if x.device.type == 'cpu' and x.dtype == torch.float32:
+            if self._packed is None:
+                packed = self._pack()
+                self._packed = False if packed is None else packed
+            if self._packed is not False:
+                # fbgemm/x86 multiply uint8 activations with int8 weights in 16-bit pairs, so activations use 7 bits to avoid saturating
+                reduce_range = torch.backends.quantized.engine in ('fbgemm', 'x86')
+                out = torch.ops.quantized.linear_dynamic(x.reshape(-1, self.in_features), self._packed, reduce_range)
+                return out.reshape(*x.shape[:-1], self.out_features)
+        # No quantised engine (or not fp32 on CPU): dequantise the whole weight on every call
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        if self.bits == 8:
+            out = F.linear(x, self.weight_q.to(x.dtype)) * self.scales.to(x.dtype)
+            return out if bias is None else out + bias
+        weight = dequantize_int4(self.weight_q, self.scales, self.group_size).to(x.dtype)
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+
+# Embedding with int8 rows. Only the looked-up rows are dequantised
+class QuantEmbedding(nn.Module):
+    def __init__(self, weight):
+        super().__init__()
+        q, scales = quantize_int8(weight.detach().float())
+        self.register_buffer('weight_q', q)
+        self.register_buffer('scales', scales)
+
+    @classmethod
+    def from_embedding(cls, embedding):
+        return cls(embedding.weight)
+
+    def forward(self, idx):
+        return F.embedding(idx, self.weight_q).float() * self.scales[idx].unsqueeze(-1)
+
+
+# nn.MultiheadAttention reads its projection weights directly inside F.multi_head_attention_forward, so its Linear layers
+# cannot simply be swapped. This batch-first replacement does the same projections through QuantLinear and uses scaled_dot_product_attention
+class QuantMultiheadAttention(nn.Module):
+    def __init__(self, mha, bits=8, group_size=128):
+        super().__init__()
+        if not mha.batch_first or not mha._qkv_same_embed_dim:
+            raise ValueError("Only batch-first attention with a shared embedding dimension is supported")
+        self.num_heads = mha.num_heads
+        self.embed_dim = mha.embed_dim
+        self.in_proj = QuantLinear(mha.in_proj_weight, mha.in_proj_bias, bits, group_size)
+        self.out_proj = QuantLinear(mha.out_proj.weight, mha.out_proj.bias, bits, group_size)
+
+    # Only the self-attention call made by pseudollama (query is key is value) is supported
+    def forward(self, query, key, value, attn_mask=None, need_weights=False, **kwargs):
+        batch, seq_len, _ = query.shape
+        qkv = self.in_proj(query).reshape(batch, seq_len, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        # nn.MultiheadAttention masks out True positions, while scaled_dot_product_attention keeps them
+        if attn_mask is not None and attn_mask.dtype == torch.bool:
+            attn_mask = ~attn_mask
+        out = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2], attn_mask=attn_mask)
+        out = out.transpose(1, 2).reshape(batch, seq_len, self.embed_dim)
+        return self.out_proj(out), None
+
+
+# Replaces the Linear, MultiheadAttention and Embedding modules of model in place
+def quantize_model(model, bits=8, group_size=128):
+    for name, child in model.named_children():
+        if isinstance(child, nn.MultiheadAttention):
+            setattr(model, name, QuantMultiheadAttention(child, bits, group_size))
+        elif isinstance(child, nn.Linear):
+            setattr(model, name, QuantLinear.from_linear(child, bits, group_size))
+        elif isinstance(child, nn.Embedding):
+            # Embedding rows are looked up rather than multiplied, so int8 is used for both bit widths
+            setattr(model, name, QuantEmbedding.from_embedding(child))
+        else:
+            quantize_model(child, bits, group_size)
+    return model
+
+
+def model_bytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+# Average time to produce one new token with greedy decoding (the full context is re-run each step, as the model has no KV cache)
+@torch.no_grad()
+def per_token_latency(model, prompt, new_tokens):
+    tokens = prompt.clone()
+    model(tokens)  # warm-up
+    start = time.perf_counter()
+    for _ in range(new_tokens):
+        logits = model(tokens)[:, -1]
+        tokens = torch.cat((tokens, logits.argmax(-1, keepdim=True)), dim=1)
+    return (time.perf_counter() - start) / new_tokens
+
+
+# Agreement of the quantised model with the reference on the same batch
+@torch.no_grad()
+def compare_outputs(reference, candidate, tokens, targets):
+    ref_logits = reference(tokens)
+    cand_logits = candidate(tokens)
+    return {
+        'top1_agreement': (ref_logits.argmax(-1) == cand_logits.argmax(-1)).float().mean().item(),
+        'logit_rel_error': ((cand_logits - ref_logits).norm() / ref_logits.norm()).item(),
+        'loss': F.cross_entropy(cand_logits.flatten(0, 1), targets.flatten()).item(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Weight-only int8/int4 quantisation for pseudollama")
+    parser.add_argument('--vocab-size', type=int, default=8192)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--mlp-dim', type=int, default=1280)
+    parser.add_argument('--checkpoint', default=None, help="fp32 checkpoint to quantise ({'model': state_dict} or a bare state_dict)")
+    parser.add_argument('--bits', type=int, choices=[4, 8], nargs='+', default=[8, 4])
+    parser.add_argument('--group-size', type=int, default=128, help="Input columns per int4 scale")
+    parser.add_argument('--prompt-len', type=int, default=32)
+    parser.add_argument('--new-tokens', type=int, default=16)
+    parser.add_argument('--eval-batch', type=int, default=4)
+    parser.add_argument('--eval-len', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--save', default=None, help="Save the quantised model (last entry of --bits) with torch.save")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    model = Transformer(args.vocab_size, args.dim, args.depth, args.heads, args.mlp_dim)
+    if args.checkpoint:
+        state = torch.load(args.checkpoint, map_location='cpu')
+        model.load_state_dict(state.get('model', state))
+    model.eval()
+
+    tokens = torch.randint(0, args.vocab_size, (args.eval_batch, args.eval_len + 1))
+    inputs, targets = tokens[:, :-1], tokens[:, 1:]
+    prompt = torch.randint(0, args.vocab_size, (1, args.prompt_len))
+
+    base_bytes = model_bytes(model)
+    base_latency = per_token_latency(model, prompt, args.new_tokens)
+    base = compare_outputs(model, model, inputs, targets)
+
+    print(f"{'model':<8} {'MiB':>10} {'shrink':>8} {'ms/token':>10} {'speedup':>8} {'top1 agree':>11} {'rel err':>9} {'loss':>8}")
+    print(f"{'fp32':<8} {base_bytes / 2**20:>10.1f} {1.0:>7.2f}x {base_latency * 1e3:>10.2f} {1.0:>7.2f}x "
+          f"{1.0:>11.3f} {0.0:>9.4f} {base['loss']:>8.4f}")
+
+    quantized = None
+    for bits in args.bits:
+        quantized = quantize_model(copy.deepcopy(model), bits, args.group_size).eval()
+        size = model_bytes(quantized)
+        latency = per_token_latency(quantized, prompt, args.new_tokens)
+        result = compare_outputs(model, quantized, inputs, targets)
+        print(f"{'int' + str(bits):<8} {size / 2**20:>10.1f} {base_bytes / size:>7.2f}x {latency * 1e3:>10.2f} "
+              f"{base_latency / latency:>7.2f}x {result['top1_agreement']:>11.3f} {result['logit_rel_error']:>9.4f} {result['loss']:>8.4f}")
+
+    if args.save and quantized is not None:
+        torch.save(quantized, args.save)
+        print(f"Quantised model saved to {args.save}")
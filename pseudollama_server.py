@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# Continuous-batching inference server for the pseudollama Transformer
+# Requests are token-id prompts sent as JSON lines over TCP. The scheduler admits new requests between decoding steps,
+# so requests join and leave the running batch at token granularity instead of waiting for a whole batch to finish.
+# Keys and values of every request live in a KV cache pool that is allocated once at start-up, one slot per concurrent request.
+#
+#   python pseudollama_server.py --port 8765 --max-batch 8 --max-len 512
+#   python pseudollama_loadtest.py --port 8765 --requests 64 --concurrency 16
+#
+# Protocol: the client sends one line {"prompt": [token ids], "max_new_tokens": N}
+# and receives {"token": id} lines as they are generated, then {"done": true, ...timings...}, or {"error": message} if the
+# request could not be served. A client that disconnects mid-stream has its request dropped and its cache slot freed
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from pseudollama import Transformer
+
+
+# Preallocated key/value storage: one [slots, heads, max_len, head_dim] tensor per layer for keys and one for values
+class KVCachePool:
+    def __init__(self, num_layers, slots, heads, max_len, head_dim, dtype=torch.float32, device='cpu'):
+        self.max_len = max_len
+        self.keys = [torch.zeros(slots, heads, max_len, head_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.values = [torch.zeros(slots, heads, max_len, head_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.free_slots = list(range(slots))
+
+    def allocate(self):
+        return self.free_slots.pop() if self.free_slots else None
+
+    def release(self, slot):
+        self.free_slots.append(slot)
+
+
+# Query/key/value projection that works for both nn.MultiheadAttention and the quantised attention from pseudollama_quant.py
+def _project_qkv(attn, h):
+    if hasattr(attn, 'in_proj'):
+        return attn.in_proj(h)
+    return F.linear(h, attn.in_proj_weight, attn.in_proj_bias)
+
+
+def _project_out(attn, out):
+    if isinstance(attn.out_proj, torch.nn.Linear):
+        return F.linear(out, attn.out_proj.weight, attn.out_proj.bias)
+    return attn.out_proj(out)
+
+
+# Positional embedding for arbitrary absolute positions, matching RotaryEmbedding.forward for positions 0..T-1
+def _positional_embedding(rotary_emb, positions):
+    freqs = positions[..., None].to(rotary_emb.inv_freq.dtype) * rotary_emb.inv_freq
+    return torch.cat((freqs, freqs), dim=-1)
+
+
+# Runs tokens [B, T] through the model starting at per-request offsets start [B], writing keys and values to the cache slots
+# and attending over everything cached so far for each request. Returns logits for the last position of every request.
+# Prefill calls this with B=1 and the whole prompt; decoding calls it with T=1 and the whole running batch
+@torch.no_grad()
+def forward_cached(model, pool, tokens, slots, start):
+    batch, seq_len = tokens.shape
+    device = tokens.device
+    positions = start[:, None] + torch.arange(seq_len, device=device)[None, :]
+    total_len = int((start + seq_len).max())
+    slot_index = torch.tensor(slots, device=device)
+
+    # Positions beyond each request's own length are padding in the shared cache window and must not be attended to.
+    # Within the new tokens, attention is causal
+    key_pos = torch.arange(total_len, device=device)
+    keep = key_pos[None, None, :] <= positions[:, :, None]
+    keep = keep[:, None, :, :]
+
+    x = model.embed(tokens)
+    for layer_idx, layer in enumerate(model.layers):
+        x = x + _positional_embedding(layer.rotary_emb, positions)
+        h = layer.norm1(x)
+        attn = layer.attn
+        heads = attn.num_heads
+        qkv = _project_qkv(attn, h).reshape(batch, seq_len, 3, heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        keys = pool.keys[layer_idx]
+        values = pool.values[layer_idx]
+        for i, slot in enumerate(slots):
+            s = int(start[i])
+            keys[slot, :, s:s + seq_len] = k[i]
+            values[slot, :, s:s + seq_len] = v[i]
+
+        cached_k = keys.index_select(0, slot_index)[:, :, :total_len]
+        cached_v = values.index_select(0, slot_index)[:, :, :total_len]
+        out = F.scaled_dot_product_attention(q, cached_k, cached_v, attn_mask=keep)
+        out = out.transpose(1, 2).reshape(batch, seq_len, -1)
+        x = x + _project_out(attn, out)
+        x = x + layer.ffn(layer.norm2(x))
+
+    return model.lm_head(x[:, -1])
+
+
+class GenerationRequest:
+    def __init__(self, prompt, max_new_tokens):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.stream = asyncio.Queue()
+        self.slot = None
+        self.length = 0
+        self.generated = 0
+        self.next_token = None
+        # Set when the client has gone away; the engine drops the request at its next step
+        self.cancelled = False
+        self.arrival = time.perf_counter()
+        self.admitted = None
+        self.first_token = None
+
+
+class ContinuousBatchingEngine:
+    def __init__(self, model, max_batch, max_len, eos_token=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.eos_token = eos_token
+        first = model.layers[0]
+        heads = first.attn.num_heads
+        head_dim = model.dim // heads
+        self.pool = KVCachePool(len(model.layers), max_batch, heads, max_len, head_dim)
+        self.waiting = asyncio.Queue()
+        self.active = []
+        # All model work runs on one background thread so the event loop keeps serving connections
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {'requests': 0, 'tokens': 0, 'queue_time': 0.0, 'ttft': 0.0, 'failed': 0, 'cancelled': 0,
+                      'start': time.perf_counter()}
+
+    async def submit(self, prompt, max_new_tokens):
+        if not prompt or max_new_tokens < 1:
+            raise ValueError("prompt must be non-empty and max_new_tokens at least 1")
+        if len(prompt) + max_new_tokens > self.pool.max_len:
+            raise ValueError(f"prompt plus max_new_tokens exceeds the cache length of {self.pool.max_len}")
+        request = GenerationRequest(prompt, max_new_tokens)
+        await self.waiting.put(request)
+        return request
+
+    def cancel(self, request):
+        request.cancelled = True
+
+    def _prefill(self, request):
+        tokens = torch.tensor([request.prompt], dtype=torch.long)
+        logits = forward_cached(self.model, self.pool, tokens, [request.slot], torch.tensor([0]))
+        request.length = len(request.prompt)
+        return int(logits.argmax(-1))
+
+    def _decode(self, batch):
+        tokens = torch.tensor([[r.next_token] for r in batch], dtype=torch.long)
+        start = torch.tensor([r.length for r in batch])
+        logits = forward_cached(self.model, self.pool, tokens, [r.slot for r in batch], start)
+        for r in batch:
+            r.length += 1
+        return logits.argmax(-1).tolist()
+
+    def _emit(self, request, token):
+        request.next_token = token
+        request.generated += 1
+        request.stream.put_nowait({'token': token})
+        self.stats['tokens'] += 1
+
+    def _finish(self, request):
+        self.pool.release(request.slot)
+        now = time.perf_counter()
+        queue_time = request.admitted - request.arrival
+        ttft = request.first_token - request.arrival
+        self.stats['requests'] += 1
+        self.stats['queue_time'] += queue_time
+        self.stats['ttft'] += ttft
+        request.stream.put_nowait({'done': True, 'tokens': request.generated, 'queue_time': queue_time,
+                                   'ttft': ttft, 'total_time': now - request.arrival})
+
+    # Ends a request that was not served to completion, freeing its slot. Nothing is sent to a cancelled request's client
+    def _drop(self, request, error=None):
+        if request.slot is not None:
+            self.pool.release(request.slot)
+            request.slot = None
+        if error is None:
+            self.stats['cancelled'] += 1
+        else:
+            self.stats['failed'] += 1
+            request.stream.put_nowait({'error': error})
+
+    def _is_finished(self, request):
+        return (request.generated >= request.max_new_tokens
+                or (self.eos_token is not None and request.next_token == self.eos_token))
+
+    async def _admit(self, loop, request):
+        if request.cancelled:
+            self._drop(request)
+            return
+        request.slot = self.pool.allocate()
+        request.admitted = time.perf_counter()
+        try:
+            token = await loop.run_in_executor(self.executor, self._prefill, request)
+        except Exception as e:
+            # Only this request is affected; the running batch carries on
+            self._drop(request, f"prefill failed: {e!r}")
+            return
+        request.first_token = time.perf_counter()
+        self._emit(request, token)
+        if self._is_finished(request):
+            self._finish(request)
+        else:
+            self.active.append(request)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Block while idle, otherwise only take the requests that are already waiting
+            if not self.active and self.waiting.empty():
+                await self._admit(loop, await self.waiting.get())
+
+            # Admit waiting requests into free cache slots. Each is prefilled on its own and produces its first token
+            while len(self.active) < self.max_batch and not self.waiting.empty():
+                await self._admit(loop, self.waiting.get_nowait())
+
+            # Requests whose clients disconnected give up their slots before the step instead of being decoded
+            for request in self.active:
+                if request.cancelled:
+                    self._drop(request)
+            self.active = [r for r in self.active if not r.cancelled]
+            if not self.active:
+                continue
+
+            # One decoding step for every running request. If it fails, every request in the step is failed, since their
+            # caches may be half written, and the server keeps serving the others
+            try:
+                tokens = await loop.run_in_executor(self.executor, self._decode, list(self.active))
+            except Exception as e:
+                for request in self.active:
+                    self._drop(request, f"decoding failed: {e!r}")
+                self.active = []
+                continue
+            still_running = []
+            for request, token in zip(self.active, tokens):
+                self._emit(request, token)
+                if self._is_finished(request):
+                    self._finish(request)
+                else:
+                    still_running.append(request)
+            self.active = still_running
+
+    def report(self):
+        elapsed = time.perf_counter() - self.stats['start']
+        done = max(self.stats['requests'], 1)
+        return (f"requests={self.stats['requests']} failed={self.stats['failed']} cancelled={self.stats['cancelled']} "
+                f"active={len(self.active)} waiting={self.waiting.qsize()} "
+                f"throughput={self.stats['tokens'] / elapsed:.1f} tok/s "
+                f"mean queue={self.stats['queue_time'] / done * 1e3:.1f} ms mean ttft={self.stats['ttft'] / done * 1e3:.1f} ms")
+
+
+async def handle_client(engine, reader, writer):
+    request = None
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+                request = await engine.submit([int(t) for t in message['prompt']], int(message.get('max_new_tokens', 32)))
+            except (ValueError, KeyError, TypeError) as e:
+                writer.write((json.dumps({'error': str(e)}) + '\n').encode())
+                await writer.drain()
+                continue
+            while True:
+                event = await request.stream.get()
+                writer.write((json.dumps(event) + '\n').encode())
+                await writer.drain()
+                if event.get('done') or 'error' in event:
+                    break
+            request = None
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        # The client went away (or this handler was cancelled) while its request was still queued or generating
+        if request is not None:
+            engine.cancel(request)
+        writer.close()
+
+
+async def report_periodically(engine, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(engine.report(), flush=True)
+
+
+async def serve(engine, host, port, report_interval):
+    server = await asyncio.start_server(lambda r, w: handle_client(engine, r, w), host, port)
+    print(f"Serving on {host}:{port}", flush=True)
+    async with server:
+        await asyncio.gather(server.serve_forever(), engine.run(), report_periodically(engine, report_interval))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuous-batching server for pseudollama")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=8, help="Concurrent requests, i.e. KV cache slots")
+    parser.add_argument('--max-len', type=int, default=512, help="Maximum prompt plus generated tokens per request")
+    parser.add_argument('--eos-token', type=int, default=None)
+    parser.add_argument('--vocab-size', type=int, default=8192)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--mlp-dim', type=int, default=640)
+    parser.add_argument('--checkpoint', default=None, help="fp32 state dict ({'model': ...} or bare)")
+    parser.add_argument('--model', default=None, help="Whole model saved with torch.save, e.g. by pseudollama_quant.py --save")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    if args.model:
+        model = torch.load(args.model, map_location='cpu', weights_only=False)
+    else:
+        model = Transformer(args.vocab_size, args.dim, args.depth, args.heads, args.mlp_dim)
+        if args.checkpoint:
+            state = torch.load(args.checkpoint, map_location='cpu')
+            model.load_state_dict(state.get('model', state))
+    model.eval()
+
+    engine = ContinuousBatchingEngine(model, args.max_batch, args.max_len, args.eos_token)
+    try:
+        asyncio.run(serve(engine, args.host, args.port, args.report_interval))
+    except KeyboardInterrupt:
+        print(engine.report())
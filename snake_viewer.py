@@ -0,0 +1,95 @@
+# pygame viewer for neatsnake.py. Replays a trace recorded in training (neatsnake.py --trace-dir), or plays a saved genome
+# and replays its game. A game is played headless first and the window only replays its actions, so what is drawn is
+# exactly the recorded game. Trace replay needs neither neat nor the network.
+#   python snake_viewer.py traces/best.json --fps 30
+#   python snake_viewer.py winner.pkl --seed 7 --save-trace winner_seed7.json
+#   python snake_viewer.py traces/generation_42.json --no-display    (only check the replay matches the recorded result)
+import argparse
+import os
+import random
+
+from snake_engine import (DEFAULT_SENSORS, GRID_SIZE, MAX_STEPS, SENSORS, STARVATION, SnakeGames, load_trace, replay, save_trace,
+                          verify_trace)
+
+BLOCK_SIZE = 20
+
+# Colors
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+
+
+# Draws game g of a SnakeGames batch: the body from head to tail, then the food
+def draw(screen, games, g=0):
+    import pygame
+    screen.fill(BLACK)
+    for i in range(games.length[g]):
+        x, y = games.xy[games.body[g, (games.head[g] - i) % games.cells]]
+        pygame.draw.rect(screen, GREEN, pygame.Rect(x * BLOCK_SIZE, y * BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE))
+    x, y = games.xy[games.food[g]]
+    pygame.draw.rect(screen, RED, pygame.Rect(x * BLOCK_SIZE, y * BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE))
+    pygame.display.flip()
+
+
+# Plays a genome headless, with the same compiled network as in training, and returns the game's trace
+def play_genome(genome_file, config_file, seed, sensors, max_steps, starvation):
+    import pickle
+    from neat_compile import CompiledNetworks
+    from neatsnake import load_config
+    config = load_config(config_file, sensors)
+    with open(genome_file, "rb") as f:
+        genome = pickle.load(f)
+    net = CompiledNetworks([genome], config)
+    games = SnakeGames([seed], max_steps=max_steps, starvation=starvation, sensors=sensors, record=True)
+    while games.alive[0]:
+        games.step(net.activate(games.observe()).argmax(axis=1))
+    return games.trace(0)
+
+
+# Draws a trace tick by tick at fps frames per second (0: as fast as possible). Returns False if the window was closed early
+def show(trace, fps):
+    import pygame
+    pygame.init()
+    pygame.display.set_caption("NEAT Snake")
+    size = trace.get('grid_size', GRID_SIZE) * BLOCK_SIZE
+    screen = pygame.display.set_mode((size, size))
+    clock = pygame.time.Clock()
+    for games in replay(trace):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return False
+        draw(screen, games)
+        if fps:
+            clock.tick(fps)
+    pygame.quit()
+    return True
+
+
+if __name__ == "__main__":
+    local_dir = os.path.dirname(__file__)
+    parser = argparse.ArgumentParser(description="Replay a NEAT Snake trace or watch a saved genome play")
+    parser.add_argument('source', nargs='?', default='winner.pkl', help="A trace (.json) or a pickled genome")
+    parser.add_argument('--config', default=os.path.join(local_dir, "config-feedforward.txt"))
+    parser.add_argument('--seed', type=int, default=None, help="Game seed for a genome. Random by default")
+    parser.add_argument('--fps', type=float, default=10, help="Replay speed in moves per second, 0 for no limit")
+    parser.add_argument('--sensors', nargs='+', choices=sorted(SENSORS), default=list(DEFAULT_SENSORS),
+                        help="Must be the sensors the genome was trained with")
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS)
+    parser.add_argument('--starvation', type=int, default=STARVATION)
+    parser.add_argument('--save-trace', default=None, help="Save the genome's game as a trace")
+    parser.add_argument('--no-display', action='store_true', help="Do not open a window")
+    args = parser.parse_args()
+
+    if args.source.endswith('.json'):
+        trace = load_trace(args.source)
+    else:
+        seed = random.getrandbits(32) if args.seed is None else args.seed
+        trace = play_genome(args.source, args.config, seed, args.sensors, args.max_steps, args.starvation)
+        if args.save_trace:
+            save_trace(trace, args.save_trace)
+    ok = verify_trace(trace)
+    print("seed %d: %d moves, %d food, replay %s" % (
+        trace['seed'], trace['steps'], trace['food_eaten'], "matches" if ok else "DOES NOT match the recorded result"))
+    if not args.no_display:
+        show(trace, args.fps)
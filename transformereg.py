@@ -1,48 +1,77 @@
+import functools
 import math
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
 class Transformer(nn.Module):
-    def __init__(self, input_dim, hidden_dim, num_layers, num_heads):
+    def __init__(self, input_dim, hidden_dim, num_layers, num_heads, pad_token=None):
         super(Transformer, self).__init__()
         
         # Parameters for the self-attention mechanism
         self.num_heads = num_heads
         self.head_dim = hidden_dim // num_heads
+
+        # Token used for padding. When set, key-padding masks are derived from it when none are passed, so padded positions
+        # are skipped. The default None derives no masks, as before, so token 0 keeps being an ordinary token
+        self.pad_token = pad_token
         
         # Input embedding layer. This layer takes the tokenised input integers and converts them to tensors of a fixed size
         self.embedding = nn.Embedding(input_dim, hidden_dim)
+
+        # Sinusoidal positional encoding, precomputed once and kept on the model's device
+        self.pos_encoding = PositionalEncoding(hidden_dim)
         
-        # Encoder layers
-        self.encoder_layers = nn.ModuleList([
-            nn.TransformerEncoderLayer(d_model=hidden_dim, nhead=num_heads)
-            for _ in range(num_layers)
-        ])
+        # Encoder layers. Inputs are laid out [batch, seq, hidden], so the layers are batch-first
+        # Wrapping them in nn.TransformerEncoder enables PyTorch's fused inference fast path and, given a key-padding mask,
+        # converts the batch to a nested tensor so padded positions are not computed at all
+        self.encoder = nn.TransformerEncoder(
+            nn.TransformerEncoderLayer(d_model=hidden_dim, nhead=num_heads, batch_first=True),
+            num_layers=num_layers,
+            enable_nested_tensor=True,
+        )
         
         # Decoder layers
         self.decoder_layers = nn.ModuleList([
-            nn.TransformerDecoderLayer(d_model=hidden_dim, nhead=num_heads)
+            nn.TransformerDecoderLayer(d_model=hidden_dim, nhead=num_heads, batch_first=True)
             for _ in range(num_layers)
         ])
         
         # Output linear layer
         self.linear = nn.Linear(hidden_dim, input_dim)
         
-    def forward(self, src, tgt, src_mask=None, tgt_mask=None):
-        # Embed the source and target sequences
-        src_embed = self.embedding(src)
-        tgt_embed = self.embedding(tgt)
-        
-        # Add the positional encoding matrix to the input embeddings
-        src_pos = positional_encoding(src_embed)
-        tgt_pos = positional_encoding(tgt_embed)
-        
+    @property
+    def encoder_layers(self):
+        return self.encoder.layers
+
+    # Checkpoints saved before the encoder layers moved into nn.TransformerEncoder name them encoder_layers.N.*; they are
+    # now encoder.layers.N.*, so old names are renamed before loading
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        old = prefix + 'encoder_layers.'
+        for key in [key for key in state_dict if key.startswith(old)]:
+            state_dict[prefix + 'encoder.layers.' + key[len(old):]] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Key-padding mask in PyTorch's convention (True marks padding), or None when padding is disabled
+    def padding_mask(self, x):
+        if self.pad_token is None:
+            return None
+        return create_padding_mask(x, self.pad_token)
+
+    def forward(self, src, tgt, src_mask=None, tgt_mask=None, src_key_padding_mask=None, tgt_key_padding_mask=None):
+        # Derive the key-padding masks from the pad token unless they were given
+        if src_key_padding_mask is None:
+            src_key_padding_mask = self.padding_mask(src)
+        if tgt_key_padding_mask is None:
+            tgt_key_padding_mask = self.padding_mask(tgt)
+
         # Run the source sequence through the encoder layers
-        encoder_output = src_pos
-        for encoder_layer in self.encoder_layers:
-            encoder_output = encoder_layer(encoder_output, src_mask=src_mask)
+        encoder_output = self.encode(src, src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+
+        # Embed the target sequence and add the positional encoding matrix
+        tgt_pos = self.pos_encoding(self.embedding(tgt))
         
         # Run the target sequence through the decoder layers with self-attention mechanism
         decoder_output = tgt_pos
@@ -51,34 +80,284 @@ class Transformer(nn.Module):
                 tgt=decoder_output, 
                 memory=encoder_output, 
                 tgt_mask=tgt_mask, 
-                memory_mask=src_mask
+                memory_mask=src_mask,
+                tgt_key_padding_mask=tgt_key_padding_mask,
+                memory_key_padding_mask=src_key_padding_mask,
             )
         
         # Linear layer to generate output predictions
         output = self.linear(decoder_output)
         return output
 
+    # Runs the source sequence through the encoder once. The returned memory ([batch, src_len, hidden]) can be reused
+    # for every decoding step instead of re-encoding the source each time
+    # Padded positions come back as zeros when the encoder ran on a nested tensor
+    def encode(self, src, src_mask=None, src_key_padding_mask=None):
+        src_pos = self.pos_encoding(self.embedding(src))
+        return self.encoder(src_pos, mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+
+    # Sets up incremental decoding for an encoded source: projects the memory into keys and values for every
+    # decoder layer's cross-attention once, and prepares empty self-attention caches
+    def init_decoder_state(self, memory, memory_key_padding_mask=None, max_len=64):
+        return DecoderState(self, memory, memory_key_padding_mask, max_len)
+
+    # Decodes one target position for every sequence in the batch. tokens is [batch] (or [batch, 1]) and holds the token
+    # at the current position; returns logits [batch, vocab] for the next position and appends to the caches in state
+    @torch.no_grad()
+    def decode_step(self, tokens, state):
+        x = self.embedding(tokens.reshape(-1, 1))
+        x = self.pos_encoding(x, offset=state.length)
+        for layer, cache in zip(self.decoder_layers, state.layers):
+            x = _cached_decoder_layer(layer, x, cache, state)
+        state.length += 1
+        return self.linear(x[:, 0])
+
+    # Greedy generation: the source is encoded once and each step only runs the newest target token through the decoder
+    @torch.no_grad()
+    def greedy_decode(self, src, max_len, bos_token, eos_token=None, src_key_padding_mask=None):
+        if src_key_padding_mask is None:
+            src_key_padding_mask = self.padding_mask(src)
+        memory = self.encode(src, src_key_padding_mask=src_key_padding_mask)
+        state = self.init_decoder_state(memory, src_key_padding_mask, max_len)
+        tokens = torch.full((src.shape[0],), bos_token, dtype=torch.long, device=src.device)
+        output = [tokens]
+        finished = torch.zeros(src.shape[0], dtype=torch.bool, device=src.device)
+        for _ in range(max_len - 1):
+            tokens = self.decode_step(tokens, state).argmax(-1)
+            if eos_token is not None:
+                tokens = tokens.masked_fill(finished, eos_token)
+                finished |= tokens == eos_token
+            output.append(tokens)
+            if eos_token is not None and finished.all():
+                break
+        return torch.stack(output, dim=1)
+
+    # Beam search on top of the incremental decoder. Every source sentence keeps beam_size hypotheses; their caches are
+    # reordered with the surviving beams each step. Scores are summed log-probabilities divided by length ** length_penalty.
+    # Returns the best sequence for each source sentence, padded with pad_token
+    @torch.no_grad()
+    def beam_search(self, src, beam_size, max_len, bos_token, eos_token, src_key_padding_mask=None, length_penalty=1.0, pad_token=0):
+        batch = src.shape[0]
+        device = src.device
+        if src_key_padding_mask is None:
+            src_key_padding_mask = self.padding_mask(src)
+        memory = self.encode(src, src_key_padding_mask=src_key_padding_mask)
+
+        # Each source sentence is repeated once per beam, laid out as [batch * beam_size]
+        memory = memory.repeat_interleave(beam_size, dim=0)
+        if src_key_padding_mask is not None:
+            src_key_padding_mask = src_key_padding_mask.repeat_interleave(beam_size, dim=0)
+        state = self.init_decoder_state(memory, src_key_padding_mask, max_len)
+
+        tokens = torch.full((batch * beam_size,), bos_token, dtype=torch.long, device=device)
+        sequences = tokens.unsqueeze(1)
+        # Only the first beam is live at the start, otherwise all beams would pick the same tokens
+        scores = torch.full((batch, beam_size), float('-inf'), device=device)
+        scores[:, 0] = 0.0
+        scores = scores.reshape(-1)
+        finished = torch.zeros(batch * beam_size, dtype=torch.bool, device=device)
+        lengths = torch.ones(batch * beam_size, device=device)
+
+        for _ in range(max_len - 1):
+            log_probs = F.log_softmax(self.decode_step(tokens, state), dim=-1)
+            vocab = log_probs.shape[-1]
+            # Finished hypotheses can only be extended by eos at no cost, so they keep their score
+            log_probs[finished] = float('-inf')
+            log_probs[finished, eos_token] = 0.0
+
+            candidates = (scores.unsqueeze(1) + log_probs).reshape(batch, beam_size * vocab)
+            scores, flat_idx = candidates.topk(beam_size, dim=1)
+            beam_idx = flat_idx // vocab + torch.arange(batch, device=device).unsqueeze(1) * beam_size
+            beam_idx = beam_idx.reshape(-1)
+            tokens = (flat_idx % vocab).reshape(-1)
+            scores = scores.reshape(-1)
+
+            sequences = torch.cat((sequences[beam_idx], tokens.unsqueeze(1)), dim=1)
+            lengths = lengths[beam_idx] + (~finished[beam_idx]).float()
+            finished = finished[beam_idx] | (tokens == eos_token)
+            state.reorder(beam_idx)
+            if finished.all():
+                break
+
+        normalised = (scores / lengths ** length_penalty).reshape(batch, beam_size)
+        best = normalised.argmax(dim=1) + torch.arange(batch, device=device) * beam_size
+        best_sequences = sequences[best]
+        # Everything after the first eos is padding
+        after_eos = (best_sequences == eos_token).long().cumsum(dim=1) - (best_sequences == eos_token).long()
+        return best_sequences.masked_fill(after_eos > 0, pad_token)
+
+# Splits the packed in_proj weight of an nn.MultiheadAttention into query, key and value projections
+def _attn_projections(attn):
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    if attn.in_proj_bias is not None:
+        b_q, b_k, b_v = attn.in_proj_bias.chunk(3)
+    else:
+        b_q = b_k = b_v = None
+    return (w_q, b_q), (w_k, b_k), (w_v, b_v)
+
+def _split_heads(x, num_heads):
+    batch, seq_len, hidden = x.shape
+    return x.reshape(batch, seq_len, num_heads, hidden // num_heads).transpose(1, 2)
+
+# Per-layer caches for incremental decoding
+# Self-attention keys and values are kept in preallocated [batch, heads, max_len, head_dim] buffers that double when full.
+# Cross-attention keys and values depend only on the encoder memory, so they are computed once here
+class DecoderState:
+    def __init__(self, model, memory, memory_key_padding_mask=None, max_len=64):
+        self.length = 0
+        batch = memory.shape[0]
+        self.memory_mask = None
+        if memory_key_padding_mask is not None:
+            # scaled_dot_product_attention keeps True positions, the padding mask marks the ones to drop
+            self.memory_mask = ~memory_key_padding_mask[:, None, None, :]
+        self.layers = []
+        for layer in model.decoder_layers:
+            attn = layer.multihead_attn
+            _, (w_k, b_k), (w_v, b_v) = _attn_projections(attn)
+            heads = layer.self_attn.num_heads
+            head_dim = layer.self_attn.embed_dim // heads
+            self.layers.append({
+                'cross_k': _split_heads(F.linear(memory, w_k, b_k), attn.num_heads),
+                'cross_v': _split_heads(F.linear(memory, w_v, b_v), attn.num_heads),
+                'self_k': memory.new_zeros(batch, heads, max_len, head_dim),
+                'self_v': memory.new_zeros(batch, heads, max_len, head_dim),
+            })
+
+    def _grow(self):
+        for cache in self.layers:
+            for key in ('self_k', 'self_v'):
+                buf = cache[key]
+                bigger = buf.new_zeros(buf.shape[0], buf.shape[1], buf.shape[2] * 2, buf.shape[3])
+                bigger[:, :, :buf.shape[2]] = buf
+                cache[key] = bigger
+
+    # Keeps the caches of the selected batch entries, in the given order (used by beam search)
+    def reorder(self, index):
+        for cache in self.layers:
+            for key in cache:
+                cache[key] = cache[key].index_select(0, index)
+        if self.memory_mask is not None:
+            self.memory_mask = self.memory_mask.index_select(0, index)
+
+# Attention of the new position over cached keys and values, followed by the output projection
+def _attend(attn, q, k, v, mask=None):
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    out = out.transpose(1, 2).reshape(q.shape[0], q.shape[2], -1)
+    return F.linear(out, attn.out_proj.weight, attn.out_proj.bias)
+
+# One nn.TransformerDecoderLayer applied to a single new position x ([batch, 1, hidden]) using the caches.
+# Mirrors the layer's own forward in eval mode (no dropout) for both norm_first settings
+def _cached_decoder_layer(layer, x, cache, state):
+    def self_attention(h):
+        attn = layer.self_attn
+        (w_q, b_q), (w_k, b_k), (w_v, b_v) = _attn_projections(attn)
+        pos = state.length
+        if pos >= cache['self_k'].shape[2]:
+            state._grow()
+        cache['self_k'][:, :, pos:pos + 1] = _split_heads(F.linear(h, w_k, b_k), attn.num_heads)
+        cache['self_v'][:, :, pos:pos + 1] = _split_heads(F.linear(h, w_v, b_v), attn.num_heads)
+        q = _split_heads(F.linear(h, w_q, b_q), attn.num_heads)
+        # Only positions up to the current one are in the cache, so no causal mask is needed
+        return _attend(attn, q, cache['self_k'][:, :, :pos + 1], cache['self_v'][:, :, :pos + 1])
+
+    def cross_attention(h):
+        attn = layer.multihead_attn
+        (w_q, b_q), _, _ = _attn_projections(attn)
+        q = _split_heads(F.linear(h, w_q, b_q), attn.num_heads)
+        return _attend(attn, q, cache['cross_k'], cache['cross_v'], state.memory_mask)
+
+    def feed_forward(h):
+        return layer.linear2(layer.activation(layer.linear1(h)))
+
+    if layer.norm_first:
+        x = x + self_attention(layer.norm1(x))
+        x = x + cross_attention(layer.norm2(x))
+        x = x + feed_forward(layer.norm3(x))
+    else:
+        x = layer.norm1(x + self_attention(x))
+        x = layer.norm2(x + cross_attention(x))
+        x = layer.norm3(x + feed_forward(x))
+    return x
+
 # manually implement a sinusoidal positional encoding that accounts for variable sequence lengths
 # GPT-3 uses learned positional embeddings, but GPT-1 and 2 used sinusoidal positional encoding
-# library implementation may require setting max_seq_len as a parameter
-def positional_encoding(x):
-    # Create a positional encoding matrix
-    seq_len, hidden_dim = x.shape[1], x.shape[2]
-    pos_enc = torch.zeros(seq_len, hidden_dim)
-    pos = torch.arange(0, seq_len, dtype=torch.float).unsqueeze(1)
-    div_term = torch.exp(torch.arange(0, hidden_dim, 2).float() * (-math.log(10000.0) / hidden_dim))
-    pos_enc[:, 0::2] = torch.sin(pos * div_term)
-    pos_enc[:, 1::2] = torch.cos(pos * div_term)
-    
-    # Add the positional encoding matrix to the input embeddings
-    x = x + pos_enc.unsqueeze(0)
-    return x
+# The table is registered as a buffer up to max_len so it moves with the model (.to(device)) and is not recomputed on every call.
+# Longer sequences grow the table lazily, doubling it so repeated growth stays rare
+class PositionalEncoding(nn.Module):
+    def __init__(self, hidden_dim, max_len=512):
+        super().__init__()
+        self.hidden_dim = hidden_dim
+        # Not persistent: the table is derived from hidden_dim, so it does not need to be in the state dict
+        self.register_buffer('pos_enc', self._build(max_len, torch.device('cpu')), persistent=False)
+
+    def _build(self, seq_len, device):
+        pos_enc = torch.zeros(seq_len, self.hidden_dim, device=device)
+        pos = torch.arange(0, seq_len, dtype=torch.float, device=device).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, self.hidden_dim, 2, device=device).float() * (-math.log(10000.0) / self.hidden_dim))
+        pos_enc[:, 0::2] = torch.sin(pos * div_term)
+        pos_enc[:, 1::2] = torch.cos(pos * div_term)
+        return pos_enc
+
+    # offset is the position of the first element of x, used when decoding one position at a time
+    def forward(self, x, offset=0):
+        end = offset + x.shape[1]
+        if end > self.pos_enc.shape[0]:
+            self.pos_enc = self._build(max(end, 2 * self.pos_enc.shape[0]), self.pos_enc.device)
+
+        # Add the positional encoding matrix to the input embeddings
+        return x + self.pos_enc[offset:end].to(x.dtype).unsqueeze(0)
+
+# Lower-triangular "may attend" matrix for a sequence length, cached per (seq_len, device, dtype) so it is only built once
+# The cached tensors are shared between callers and must not be modified in place
+@functools.lru_cache(maxsize=64)
+def future_mask(seq_len, device, dtype=torch.bool):
+    return torch.tril(torch.ones(seq_len, seq_len, dtype=dtype, device=device))
+
+# Causal mask in the convention of nn.TransformerDecoderLayer's tgt_mask: True (bool) or -inf (float) where a position may not attend
+@functools.lru_cache(maxsize=64)
+def causal_mask(seq_len, device, dtype=torch.bool):
+    blocked = torch.triu(torch.ones(seq_len, seq_len, dtype=torch.bool, device=device), diagonal=1)
+    if dtype == torch.bool:
+        return blocked
+    return torch.zeros(seq_len, seq_len, dtype=dtype, device=device).masked_fill(blocked, float('-inf'))
+
+# Key-padding mask for nn.Transformer layers: [batch, seq], True where x holds the pad token
+def create_padding_mask(x, pad_token=0):
+    return x == pad_token
 
 def create_mask(x, pad_token=0):
     # Create a mask to prevent attention to padding tokens and future tokens
     mask = (x != pad_token).unsqueeze(1).unsqueeze(2)
     seq_len = x.shape[1]
-    future_mask = torch.tril(torch.ones(seq_len, seq_len)).unsqueeze(0)
-    mask = mask & future_mask
-    return mask.to(x.device)
+    mask = mask & future_mask(seq_len, x.device).unsqueeze(0)
+    return mask
+
+# One training epoch over batches shaped like bucket_sampler.collate_seq2seq's output
+# Prints the loss, the share of computed positions that were padding, and the effective (non-padding) tokens per second
+def train_epoch(model, dataloader, optimizer, device, epoch=0):
+    model.train()
+    total_loss = torch.zeros((), device=device)
+    num_tokens = 0
+    num_padded = 0
+    start = time.perf_counter()
+    for batch in dataloader:
+        logits = model(
+            batch['src'].to(device, non_blocking=True),
+            batch['tgt'].to(device, non_blocking=True),
+            tgt_mask=batch['tgt_mask'].to(device),
+            src_key_padding_mask=batch['src_key_padding_mask'].to(device, non_blocking=True),
+            tgt_key_padding_mask=batch['tgt_key_padding_mask'].to(device, non_blocking=True),
+        )
+        loss = F.cross_entropy(logits.flatten(0, 1), batch['labels'].to(device, non_blocking=True).flatten(), ignore_index=-100)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.detach()
+        num_tokens += batch['num_tokens']
+        num_padded += batch['num_padded']
 
+    elapsed = time.perf_counter() - start
+    avg_loss = total_loss.item() / max(len(dataloader), 1)
+    padding = 1.0 - num_tokens / num_padded if num_padded else 0.0
+    print(f'Epoch {epoch + 1}, Loss: {avg_loss:.4f}, Padding: {padding:.1%}, Effective tokens/sec: {num_tokens / elapsed:.1f}')
+    return {'loss': avg_loss, 'padding_ratio': padding, 'tokens_per_sec': num_tokens / elapsed}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Forward-pass benchmark for transformereg.Transformer
+# Compares the model against the original per-call positional encoding and mask construction at short sequence lengths,
+# where rebuilding those tables on every call costs about as much as the layers themselves
+#   python transformereg_bench.py --lengths 8 16 32 64 --batch 32
+# With --generate it also compares greedy generation by repeated full forward passes against the incremental decoder
+#   python transformereg_bench.py --generate --gen-lengths 16 32 64 128
+# With --variable it runs inference on variable-length, padded batches with and without key-padding masks.
+# With the masks the encoder runs on nested tensors and skips the padded positions
+#   python transformereg_bench.py --variable --max-len 256 --batch 64
+import argparse
+import math
+import time
+
+import torch
+
+from transformereg import Transformer, causal_mask, create_mask
+
+
+# Positional encoding and mask as originally written: a fresh table on every call, built on the CPU
+def legacy_positional_encoding(x):
+    seq_len, hidden_dim = x.shape[1], x.shape[2]
+    pos_enc = torch.zeros(seq_len, hidden_dim)
+    pos = torch.arange(0, seq_len, dtype=torch.float).unsqueeze(1)
+    div_term = torch.exp(torch.arange(0, hidden_dim, 2).float() * (-math.log(10000.0) / hidden_dim))
+    pos_enc[:, 0::2] = torch.sin(pos * div_term)
+    pos_enc[:, 1::2] = torch.cos(pos * div_term)
+    return x + pos_enc.unsqueeze(0).to(x.device)
+
+
+def legacy_create_mask(x, pad_token=0):
+    mask = (x != pad_token).unsqueeze(1).unsqueeze(2)
+    seq_len = x.shape[1]
+    # The original combined a float tril with a bool mask, which & rejects, so it is converted here
+    future = torch.tril(torch.ones(seq_len, seq_len)).bool().unsqueeze(0)
+    return (mask & future).to(x.device)
+
+
+def legacy_tgt_mask(seq_len, device):
+    blocked = torch.triu(torch.ones(seq_len, seq_len), diagonal=1).bool()
+    return torch.zeros(seq_len, seq_len).masked_fill(blocked, float('-inf')).to(device)
+
+
+# The body of the original Transformer.forward, using the model's own layers
+def legacy_step(model, src, tgt):
+    legacy_create_mask(tgt)
+    tgt_mask = legacy_tgt_mask(tgt.shape[1], tgt.device)
+    memory = legacy_positional_encoding(model.embedding(src))
+    for layer in model.encoder_layers:
+        memory = layer(memory)
+    out = legacy_positional_encoding(model.embedding(tgt))
+    for layer in model.decoder_layers:
+        out = layer(tgt=out, memory=memory, tgt_mask=tgt_mask)
+    return model.linear(out)
+
+
+def cached_step(model, src, tgt):
+    create_mask(tgt)
+    return model(src, tgt, tgt_mask=causal_mask(tgt.shape[1], tgt.device))
+
+
+# Greedy generation the way forward() allows it: re-encode the source and re-decode the whole prefix for every new token
+def naive_greedy(model, src, steps, bos_token=1):
+    tgt = torch.full((src.shape[0], 1), bos_token, dtype=torch.long, device=src.device)
+    for _ in range(steps - 1):
+        logits = model(src, tgt, tgt_mask=causal_mask(tgt.shape[1], tgt.device))[:, -1]
+        tgt = torch.cat((tgt, logits.argmax(-1, keepdim=True)), dim=1)
+    return tgt
+
+
+# Random batch of sequences with lengths between min_len and max_len, right-padded with pad_token
+def variable_length_batch(batch, min_len, max_len, vocab, device, pad_token=0):
+    lengths = torch.randint(min_len, max_len + 1, (batch,))
+    tokens = torch.randint(1, vocab, (batch, max_len))
+    tokens[torch.arange(max_len)[None, :] >= lengths[:, None]] = pad_token
+    return tokens.to(device)
+
+
+def time_it(fn, iters, warmup=5):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transformereg.Transformer forward passes")
+    parser.add_argument('--vocab', type=int, default=1000)
+    parser.add_argument('--hidden', type=int, default=128)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--lengths', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128])
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--generate', action='store_true', help="Also benchmark greedy generation")
+    parser.add_argument('--gen-lengths', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--src-len', type=int, default=32, help="Source length for --generate")
+    parser.add_argument('--variable', action='store_true', help="Also benchmark variable-length padded batches")
+    parser.add_argument('--min-len', type=int, default=8, help="Shortest sequence for --variable")
+    parser.add_argument('--max-len', type=int, default=128, help="Longest sequence (padded length) for --variable")
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = Transformer(args.vocab, args.hidden, args.layers, args.heads, pad_token=0).to(device).eval()
+
+    print(f"{'seq_len':>8} {'legacy ms':>10} {'cached ms':>10} {'speedup':>8}")
+    for seq_len in args.lengths:
+        src = torch.randint(1, args.vocab, (args.batch, seq_len), device=device)
+        tgt = torch.randint(1, args.vocab, (args.batch, seq_len), device=device)
+        legacy = time_it(lambda: legacy_step(model, src, tgt), args.iters)
+        cached = time_it(lambda: cached_step(model, src, tgt), args.iters)
+        print(f"{seq_len:>8} {legacy * 1e3:>10.3f} {cached * 1e3:>10.3f} {legacy / cached:>7.2f}x")
+
+    if args.generate:
+        print()
+        src = torch.randint(1, args.vocab, (args.batch, args.src_len), device=device)
+        print(f"{'out_len':>8} {'naive ms':>10} {'cached ms':>10} {'speedup':>8} {'cached ms/token':>16}")
+        for out_len in args.gen_lengths:
+            naive = time_it(lambda: naive_greedy(model, src, out_len), 3, warmup=1)
+            cached = time_it(lambda: model.greedy_decode(src, out_len, bos_token=1), 3, warmup=1)
+            print(f"{out_len:>8} {naive * 1e3:>10.1f} {cached * 1e3:>10.1f} {naive / cached:>7.2f}x {cached / out_len * 1e3:>16.3f}")
+
+    if args.variable:
+        print()
+        src = variable_length_batch(args.batch, args.min_len, args.max_len, args.vocab, device)
+        tgt = variable_length_batch(args.batch, args.min_len, args.max_len, args.vocab, device)
+        tgt_mask = causal_mask(tgt.shape[1], device)
+        padding = (src == 0).float().mean().item()
+
+        def dense():
+            # pad_token=None disables the key-padding masks, so every padded position is computed like before
+            model.pad_token = None
+            try:
+                model(src, tgt, tgt_mask=tgt_mask)
+            finally:
+                model.pad_token = 0
+
+        masked_forward = time_it(lambda: model(src, tgt, tgt_mask=tgt_mask), args.iters)
+        dense_forward = time_it(dense, args.iters)
+        masked_encode = time_it(lambda: model.encode(src, src_key_padding_mask=model.padding_mask(src)), args.iters)
+        dense_encode = time_it(lambda: model.encode(src), args.iters)
+        print(f"variable-length batch: {args.batch} x {args.max_len}, {padding:.0%} padding")
+        print(f"{'':>8} {'dense ms':>10} {'masked ms':>10} {'speedup':>8}")
+        print(f"{'encode':>8} {dense_encode * 1e3:>10.2f} {masked_encode * 1e3:>10.2f} {dense_encode / masked_encode:>7.2f}x")
+        print(f"{'forward':>8} {dense_forward * 1e3:>10.2f} {masked_forward * 1e3:>10.2f} {dense_forward / masked_forward:>7.2f}x")
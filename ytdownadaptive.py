@@ -1,159 +1,196 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 import os
-import re
-import threading
-import yt_dlp
+
+from progress_channel import ProgressChannel, format_bytes, format_eta, format_speed, percent
+from ytdownload_engine import DownloadEngine, is_valid_youtube_url
+
+# Download queue: paste any number of URLs (one per line), playlists are expanded into their videos, and up to
+# "Parallel downloads" videos download at once, each fetching up to "Fragments per video" DASH/HLS fragments in parallel.
+# The downloading is done by ytdownload_engine.DownloadEngine, which also runs without a window. Its worker threads never
+# touch Tk: they record the latest state of their item in a ProgressChannel, and the Tk thread redraws the changed rows FPS
+# times per second
+FPS = 15
+FINISHED = ('done', 'failed', 'invalid')
 
 class YouTubeDownloaderApp:
     def __init__(self, root):
         self.root = root
         self.root.title('YouTube High Quality Downloader')
-        self.root.geometry('600x400')
+        self.root.geometry('800x560')
+        self.channel = ProgressChannel()
+        self.item_status = {}
+        self.item_speed = {}
+        self.engine = None
+        self.active = 0
+        self.failed = 0
         self.setup_ui()
-        
+        self.channel.pump(self.root, self.apply_progress, fps=FPS, on_frame=self.update_summary)
+
     def setup_ui(self):
         # URL input section
         url_frame = tk.Frame(self.root, pady=10)
         url_frame.pack(fill='x', padx=20)
-        
-        tk.Label(url_frame, text='YouTube URL:').pack(anchor='w')
-        self.url_entry = tk.Entry(url_frame, width=70)
-        self.url_entry.pack(fill='x', pady=5)
-        
+
+        tk.Label(url_frame, text='YouTube URLs or playlists (one per line):').pack(anchor='w')
+        self.url_text = tk.Text(url_frame, width=70, height=6)
+        self.url_text.pack(fill='x', pady=5)
+
         # Output folder section
         folder_frame = tk.Frame(self.root, pady=10)
         folder_frame.pack(fill='x', padx=20)
-        
+
         tk.Label(folder_frame, text='Output Folder:').pack(anchor='w')
-        
+
         path_frame = tk.Frame(folder_frame)
         path_frame.pack(fill='x', pady=5)
-        
+
         self.folder_path = tk.StringVar()
         self.folder_entry = tk.Entry(path_frame, textvariable=self.folder_path, width=50)
         self.folder_entry.pack(side='left', fill='x', expand=True)
-        
+
         browse_btn = tk.Button(path_frame, text='Browse...', command=self.select_folder)
         browse_btn.pack(side='right', padx=5)
-        
+
+        # Concurrency options
+        options_frame = tk.Frame(self.root)
+        options_frame.pack(fill='x', padx=20)
+
+        tk.Label(options_frame, text='Parallel downloads:').pack(side='left')
+        self.concurrency_var = tk.IntVar(value=3)
+        tk.Spinbox(options_frame, from_=1, to=16, width=4, textvariable=self.concurrency_var).pack(side='left', padx=5)
+        tk.Label(options_frame, text='Fragments per video:').pack(side='left', padx=(15, 0))
+        self.fragments_var = tk.IntVar(value=4)
+        tk.Spinbox(options_frame, from_=1, to=32, width=4, textvariable=self.fragments_var).pack(side='left', padx=5)
+        self.playlist_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(options_frame, text='Expand playlists', variable=self.playlist_var).pack(side='left', padx=15)
+
         # Download button
         btn_frame = tk.Frame(self.root, pady=10)
         btn_frame.pack(fill='x', padx=20)
-        
-        self.download_btn = tk.Button(btn_frame, text='Download', command=self.start_download, 
+
+        self.download_btn = tk.Button(btn_frame, text='Download', command=self.start_download,
                                      bg='#4CAF50', fg='white', height=2)
         self.download_btn.pack(fill='x')
-        
-        # Progress and status
+
+        # Per-item progress
+        list_frame = tk.Frame(self.root)
+        list_frame.pack(fill='both', expand=True, padx=20)
+        self.item_list = ttk.Treeview(list_frame, columns=('title', 'status', 'progress', 'speed', 'eta'), show='headings', height=8)
+        self.item_list.heading('title', text='Video')
+        self.item_list.heading('status', text='Status')
+        self.item_list.heading('progress', text='Progress')
+        self.item_list.heading('speed', text='Speed')
+        self.item_list.heading('eta', text='ETA')
+        self.item_list.column('title', width=300)
+        self.item_list.column('status', width=200)
+        self.item_list.column('progress', width=70, anchor='e')
+        self.item_list.column('speed', width=90, anchor='e')
+        self.item_list.column('eta', width=60, anchor='e')
+        scrollbar = ttk.Scrollbar(list_frame, orient='vertical', command=self.item_list.yview)
+        self.item_list.configure(yscrollcommand=scrollbar.set)
+        self.item_list.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+
+        # Overall status
         status_frame = tk.Frame(self.root, pady=10)
         status_frame.pack(fill='x', padx=20)
-        
+
         self.status_var = tk.StringVar(value="Ready")
         status_label = tk.Label(status_frame, textvariable=self.status_var, anchor='w')
         status_label.pack(fill='x')
-        
-        self.progress_var = tk.DoubleVar()
-        self.progress_bar = tk.Scale(status_frame, variable=self.progress_var, from_=0, to=100, 
-                                    orient='horizontal', state='disabled')
-        self.progress_bar.pack(fill='x')
-    
+
     def select_folder(self):
         folder = filedialog.askdirectory()
         if folder:
             self.folder_path.set(folder)
-    
+
     def start_download(self):
-        url = self.url_entry.get().strip()
+        urls = [line.strip() for line in self.url_text.get('1.0', 'end').splitlines() if line.strip()]
         output_path = self.folder_path.get().strip()
-        
+
         # Validate inputs
-        if not url:
+        if not urls:
             messagebox.showerror("Error", "Please enter a YouTube URL")
             return
-        
-        if not self.is_valid_youtube_url(url):
-            messagebox.showerror("Error", "Invalid YouTube URL format")
+
+        invalid = [url for url in urls if not is_valid_youtube_url(url)]
+        if invalid:
+            messagebox.showerror("Error", "Invalid YouTube URL format:\n" + "\n".join(invalid))
             return
-        
+
         if not output_path:
             messagebox.showerror("Error", "Please select an output folder")
             return
-        
+
         if not os.path.exists(output_path):
             messagebox.showerror("Error", "Selected output folder does not exist")
             return
-        
-        # Disable UI during download
+
+        # Disable UI until the whole queue is done
         self.download_btn.config(state='disabled')
-        self.status_var.set("Starting download...")
-        
-        # Start download in a separate thread
-        download_thread = threading.Thread(target=self.download_video, args=(url, output_path))
-        download_thread.daemon = True
-        download_thread.start()
-    
-    def download_video(self, url, output_path):
-        try:
-            def progress_hook(d):
-                if d['status'] == 'downloading':
-                    # Update progress
-                    p = d.get('_percent_str', '0%').replace('%', '')
-                    try:
-                        self.progress_var.set(float(p))
-                    except ValueError:
-                        pass
-                    self.status_var.set(f"Downloading: {d.get('_percent_str', '0%')}")
-                elif d['status'] == 'finished':
-                    self.status_var.set("Download finished. Processing...")
-                elif d['status'] == 'error':
-                    self.status_var.set(f"Error: {d.get('error')}")
-            
-            ydl_opts = {
-                'format': 'bestvideo+bestaudio/best',  # Download best quality
-                'ffmpeg_location': r'C:\ffmpeg\bin\ffmpeg.exe',  # Use your actual path here
-                'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
-                'merge_output_format': 'mp4',  # Merge into mp4
-                'postprocessors': [{
-                    'key': 'FFmpegVideoConvertor', 
-                    'preferedformat': 'mp4',
-                }],
-                'progress_hooks': [progress_hook],
-                'noplaylist': True,  # Don't download playlists
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            
-            # Enable UI after download
-            self.root.after(0, lambda: self.status_var.set("Download completed successfully!"))
-            self.root.after(0, lambda: self.download_btn.config(state='normal'))
-            self.root.after(0, lambda: messagebox.showinfo("Success", "Video downloaded successfully!"))
-        
-        except Exception as e:
-            # Error handling
-            error_message = str(e)
-            self.root.after(0, lambda: self.status_var.set(f"Error: {error_message}"))
-            self.root.after(0, lambda: self.download_btn.config(state='normal'))
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Download failed: {error_message}"))
-    
-    def is_valid_youtube_url(self, url):
-        # Handle various YouTube URL formats
-        youtube_regex = (
-            r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
-            r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-        )
-        youtube_regex_match = re.match(youtube_regex, url)
-        
-        # Handle YouTube shortened URLs
-        youtube_short_regex = r'(https?://)?(www\.)?youtu\.be/([^&=%\?]{11})'
-        youtube_short_regex_match = re.match(youtube_short_regex, url)
-        
-        # Handle YouTube share URLs
-        youtube_share_regex = r'(https?://)?(www\.)?youtube\.com/shorts/([^&=%\?]{11})'
-        youtube_share_regex_match = re.match(youtube_share_regex, url)
-        
-        return bool(youtube_regex_match or youtube_short_regex_match or youtube_share_regex_match)
+        self.status_var.set("Resolving URLs...")
+        self.item_list.delete(*self.item_list.get_children())
+        self.item_status = {}
+        self.item_speed = {}
+        self.active = 0
+        self.failed = 0
+
+        # Item ids restart with every engine, so the states of the last batch are dropped
+        self.channel.clear()
+        self.engine = DownloadEngine(output_path, concurrency=self.concurrency_var.get(),
+                                     fragments=self.fragments_var.get(), expand_playlists=self.playlist_var.get(),
+                                     on_update=self.channel.update)
+        self.engine.start(urls)
+
+    # Runs on the Tk thread, at most FPS times per second, with the latest state of each item that changed
+    def apply_progress(self, item, state):
+        status = state.get('status', 'queued')
+        if not self.item_list.exists(item):
+            self.item_list.insert('', 'end', iid=item, values=(state.get('title', ''), '', '', '', ''))
+            self.active += 1
+        previous = self.item_status.get(item)
+        self.item_status[item] = status
+        if status in FINISHED and previous not in FINISHED:
+            self.active -= 1
+            self.failed += status != 'done'
+        self.item_speed[item] = (state.get('speed') or 0.0) if status == 'downloading' else 0.0
+
+        done = percent(state)
+        if status in ('failed', 'invalid'):
+            text = f"Failed: {state.get('error')}"
+        elif status == 'downloading' and state.get('total'):
+            text = f"{format_bytes(state.get('downloaded'))} of {format_bytes(state['total'])}"
+        else:
+            text = status.capitalize()
+        self.item_list.item(item, values=(
+            state.get('title', ''),
+            text,
+            '100%' if status == 'done' else ('' if done is None else f"{done:.1f}%"),
+            format_speed(state.get('speed')),
+            format_eta(state.get('eta')),
+        ))
+
+    def update_summary(self):
+        if self.engine is None:
+            return
+        total = len(self.item_list.get_children())
+        speed = sum(self.item_speed.values())
+        if self.engine.expanding:
+            self.status_var.set(f"Resolving URLs... {total} queued")
+        elif self.active > 0 or total < self.engine.queued:
+            self.status_var.set(f"{total - self.active} of {total} finished, {format_speed(speed) or 'waiting'}")
+        else:
+            # The queue is done: every item has reported its result, so this only stops the idle worker threads
+            self.engine.wait()
+            self.engine = None
+            self.download_btn.config(state='normal')
+            self.status_var.set(f"Finished: {total - self.failed} downloaded, {self.failed} failed")
+            if self.failed:
+                messagebox.showerror("Error", f"{self.failed} of {total} downloads failed")
+            else:
+                messagebox.showinfo("Success", f"{total} videos downloaded successfully!")
+
 
 if __name__ == "__main__":
     root = tk.Tk()
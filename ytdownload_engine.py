@@ -0,0 +1,259 @@
+# YouTube download engine shared by ytdownadaptive.py, YTdownload.py and the command line. No Tk, so it runs in cron jobs
+# and on servers.
+# DownloadEngine takes a list of URLs, expands playlists into their videos on a background thread, and downloads up to
+# `concurrency` videos at once, each fetching up to `fragments` DASH/HLS fragments in parallel. Progress is reported through
+# on_update(item, **fields), which has the signature of ProgressChannel.update, so a GUI passes its channel's update method.
+# Every finished item is written as one JSON line to the result log:
+#   {"item": "3", "url": ..., "title": ..., "status": "done" | "failed" | "invalid", "file": ..., "error": ...,
+#    "bytes": ..., "seconds": ..., "finished_at": "2024-01-01T12:00:00"}
+#
+#   engine = DownloadEngine('downloads', concurrency=3, log_file='results.jsonl')
+#   engine.start(urls)
+#   results = engine.wait()
+#
+# Command line, with URLs as arguments, from a file, or one per line on stdin (blank lines and # comments are skipped):
+#   python ytdownload_engine.py -o downloads -i urls.txt --log results.jsonl
+#   cat urls.txt | python ytdownload_engine.py -o downloads --concurrency 4
+import argparse
+import datetime
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yt_dlp
+
+# Used when it exists; otherwise yt-dlp looks for ffmpeg on the PATH
+FFMPEG_LOCATION = r'C:\ffmpeg\bin\ffmpeg.exe'  # Use your actual path here
+
+# Best video and audio streams merged into an mp4 (needs ffmpeg), or the best single file with both (no ffmpeg needed)
+BEST_QUALITY = 'bestvideo+bestaudio/best'
+SINGLE_FILE = 'best'
+
+
+def is_valid_youtube_url(url):
+    # Handle various YouTube URL formats
+    youtube_regex = (
+        r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
+        r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
+    )
+    youtube_regex_match = re.match(youtube_regex, url)
+
+    # Handle YouTube shortened URLs
+    youtube_short_regex = r'(https?://)?(www\.)?youtu\.be/([^&=%\?]{11})'
+    youtube_short_regex_match = re.match(youtube_short_regex, url)
+
+    # Handle YouTube share URLs
+    youtube_share_regex = r'(https?://)?(www\.)?youtube\.com/shorts/([^&=%\?]{11})'
+    youtube_share_regex_match = re.match(youtube_share_regex, url)
+
+    # Handle YouTube playlist URLs
+    youtube_playlist_regex = r'(https?://)?(www\.|m\.)?youtube\.com/playlist\?list=([\w-]+)'
+    youtube_playlist_regex_match = re.match(youtube_playlist_regex, url)
+
+    return bool(youtube_regex_match or youtube_short_regex_match or youtube_share_regex_match
+                or youtube_playlist_regex_match)
+
+
+# Lists the videos behind a URL as (url, title). A playlist is listed without fetching each video's page
+def expand_url(url, expand_playlists=True):
+    opts = {'extract_flat': 'in_playlist', 'quiet': True, 'skip_download': True, 'noplaylist': not expand_playlists}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('_type') == 'playlist':
+        return [(entry.get('url') or entry['id'], entry.get('title') or entry.get('id'))
+                for entry in info.get('entries') or [] if entry]
+    return [(url, info.get('title') or url)]
+
+
+# Downloads one video into output_path and returns the path of the file written. progress(**fields) is called from
+# yt-dlp's progress hook with status and byte counts
+def download_video(url, output_path, fragments=4, progress=None, fmt=BEST_QUALITY, ffmpeg_location=FFMPEG_LOCATION):
+    # Called by yt-dlp for every chunk
+    def progress_hook(d):
+        if progress is None:
+            return
+        if d['status'] == 'downloading':
+            progress(status='downloading', downloaded=d.get('downloaded_bytes'),
+                     total=d.get('total_bytes') or d.get('total_bytes_estimate'))
+        elif d['status'] == 'finished':
+            progress(status='processing', eta=None)
+
+    ydl_opts = {
+        'format': fmt,
+        'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
+        'progress_hooks': [progress_hook],
+        'noplaylist': True,  # Each item is one video; playlists were expanded when queued
+        'concurrent_fragment_downloads': fragments,  # Fetch fragments of DASH/HLS formats in parallel
+        'quiet': True,
+        'noprogress': True,
+    }
+    if ffmpeg_location and os.path.exists(ffmpeg_location):
+        ydl_opts['ffmpeg_location'] = ffmpeg_location
+    if '+' in fmt:
+        # Separate video and audio streams are merged into mp4
+        ydl_opts['merge_output_format'] = 'mp4'
+        ydl_opts['postprocessors'] = [{
+            'key': 'FFmpegVideoConvertor',
+            'preferedformat': 'mp4',
+        }]
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        downloads = info.get('requested_downloads') or []
+        return downloads[-1].get('filepath') if downloads else ydl.prepare_filename(info)
+
+
+class DownloadEngine:
+    def __init__(self, output_path, concurrency=3, fragments=4, expand_playlists=True, fmt=BEST_QUALITY,
+                 ffmpeg_location=FFMPEG_LOCATION, log_file=None, on_update=None, on_result=None):
+        self.output_path = output_path
+        self.concurrency = max(1, concurrency)
+        self.fragments = fragments
+        self.expand_playlists = expand_playlists
+        self.fmt = fmt
+        self.ffmpeg_location = ffmpeg_location
+        self.log_file = log_file
+        self.on_update = on_update
+        self.on_result = on_result
+        self.results = []
+        # Set once every URL has been expanded: the number of items that will be reported
+        self.queued = 0
+        self.expanding = False
+        self._items = itertools.count()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._expand_thread = None
+
+    # Validates and queues the URLs and returns at once. Playlists are expanded on a separate thread, and every video is
+    # submitted as soon as it is known
+    def start(self, urls):
+        os.makedirs(self.output_path, exist_ok=True)
+        self.results = []
+        self.queued = 0
+        self.expanding = True
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._expand_thread = threading.Thread(target=self._queue_urls, args=(list(urls),), daemon=True)
+        self._expand_thread.start()
+
+    # Blocks until every queued video has finished and returns the results, in the order they finished
+    def wait(self):
+        if self._expand_thread is not None:
+            self._expand_thread.join()
+            self._expand_thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return self.results
+
+    def run(self, urls):
+        self.start(urls)
+        return self.wait()
+
+    def _queue_urls(self, urls):
+        count = 0
+        for url in urls:
+            if not is_valid_youtube_url(url):
+                self._finish(self._new_item(url, url), url, url, 'invalid', error='Invalid YouTube URL format')
+                count += 1
+                continue
+            try:
+                videos = expand_url(url, self.expand_playlists)
+            except Exception as e:
+                self._finish(self._new_item(url, url), url, url, 'failed', error=str(e))
+                count += 1
+                continue
+            for video_url, title in videos:
+                item = self._new_item(video_url, title)
+                self._executor.submit(self._download, item, video_url, title)
+                count += 1
+        self.queued = count
+        self.expanding = False
+
+    def _new_item(self, url, title):
+        item = str(next(self._items))
+        self._update(item, url=url, title=title, status='queued')
+        return item
+
+    def _update(self, item, **fields):
+        if self.on_update is not None:
+            self.on_update(item, **fields)
+
+    def _download(self, item, url, title):
+        start = time.perf_counter()
+        sizes = {}
+
+        def progress(**fields):
+            if fields.get('total'):
+                sizes['total'] = fields['total']
+            self._update(item, **fields)
+
+        self._update(item, status='starting')
+        try:
+            path = download_video(url, self.output_path, self.fragments, progress, self.fmt, self.ffmpeg_location)
+        except Exception as e:
+            self._finish(item, url, title, 'failed', error=str(e), seconds=time.perf_counter() - start)
+            return
+        size = os.path.getsize(path) if path and os.path.exists(path) else sizes.get('total')
+        self._finish(item, url, title, 'done', file=path, size=size, seconds=time.perf_counter() - start)
+
+    # Reports the final state of an item and appends it to the results and the log
+    def _finish(self, item, url, title, status, file=None, error=None, size=None, seconds=0.0):
+        result = {
+            'item': item, 'url': url, 'title': title, 'status': status, 'file': file, 'error': error,
+            'bytes': size, 'seconds': round(seconds, 3),
+            'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        with self._lock:
+            self.results.append(result)
+            if self.log_file:
+                with open(self.log_file, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+        self._update(item, status=status, error=error, file=file, speed=None, eta=None)
+        if self.on_result is not None:
+            self.on_result(result)
+
+
+# URLs from a file or stream, one per line; blank lines and # comments are skipped
+def read_urls(f):
+    return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download YouTube videos and playlists without a window")
+    parser.add_argument('urls', nargs='*', help="Videos or playlists. Read from --input or stdin if none are given")
+    parser.add_argument('-i', '--input', default=None, help="File with one URL per line, - for stdin")
+    parser.add_argument('-o', '--output', default='.', help="Output folder, created if missing")
+    parser.add_argument('--concurrency', type=int, default=3, help="Videos downloaded at once")
+    parser.add_argument('--fragments', type=int, default=4, help="Fragments fetched in parallel per video")
+    parser.add_argument('--no-playlists', action='store_true', help="Download only the video of a playlist URL")
+    parser.add_argument('--single-file', action='store_true',
+                        help="Download the best single file instead of merging the best video and audio (no ffmpeg)")
+    parser.add_argument('--ffmpeg', default=FFMPEG_LOCATION, help="Path to ffmpeg, if it is not on the PATH")
+    parser.add_argument('--log', default=None, help="Append one JSON line per finished video to this file")
+    args = parser.parse_args()
+
+    urls = list(args.urls)
+    if args.input == '-' or (args.input is None and not urls):
+        urls += read_urls(sys.stdin)
+    elif args.input:
+        with open(args.input) as f:
+            urls += read_urls(f)
+    if not urls:
+        parser.error("no URLs given")
+
+    def report(result):
+        print("%-7s %s%s" % (result['status'], result['title'], f" ({result['error']})" if result['error'] else ''),
+              flush=True)
+
+    engine = DownloadEngine(args.output, concurrency=args.concurrency, fragments=args.fragments,
+                            expand_playlists=not args.no_playlists, fmt=SINGLE_FILE if args.single_file else BEST_QUALITY,
+                            ffmpeg_location=args.ffmpeg, log_file=args.log, on_result=report)
+    results = engine.run(urls)
+    failed = sum(r['status'] != 'done' for r in results)
+    print("%d downloaded, %d failed" % (len(results) - failed, failed))
+    sys.exit(1 if failed else 0)